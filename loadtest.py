@@ -0,0 +1,326 @@
+import os
+import json
+import logging
+import time
+import asyncio
+import argparse
+import itertools
+import tempfile
+from functools import wraps
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import BaseRequest
+
+import main
+
+# -----------------------------------------------------------------------------
+# Load Test
+# Drives the real Application (handlers, lanes, persistence, outbox, DB thread)
+# with synthetic updates from many virtual users against an in-process fake
+# Bot API, then reports throughput, per-handler latency and DB queue waits.
+# Runs offline on a throwaway database:
+#
+#     python loadtest.py --users 2000 --api-latency 30 --json before.json
+#
+# Each virtual user starts the bot, browses to a sub-category, buys a regular
+# product, buys a quantity product and requests a top-up; an admin then
+# accepts every pending top-up and order from the admin groups.
+# -----------------------------------------------------------------------------
+
+ADMIN_ID = next(iter(main.ADMIN_IDS))
+ORDERS_GROUP = -100
+TOPUP_GROUP = -200
+FIRST_USER_ID = 1_000_000
+STARTING_BALANCE = 1_000_000.0
+PERCENTILES = (50, 95, 99)
+
+# --- Fake Bot API ------------------------------------------------------------
+
+class FakeBotRequest(BaseRequest):
+    """In-process Bot API that answers every call after a fixed latency and counts the calls."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self) -> float:
+        return 5.0
+
+    async def initialize(self):
+        """Nothing to set up."""
+
+    async def shutdown(self):
+        """Nothing to release."""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> tuple[int, bytes]:
+        """Answers a Bot API call with a plausible result."""
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api_method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": True}
+        elif api_method in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            chat_id = int(params.get("chat_id", 1))
+            result = {"message_id": next(self._message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                      "text": params.get("text", "")}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# --- Synthetic updates -------------------------------------------------------
+
+_update_ids = itertools.count(1)
+
+def user_json(user_id: int) -> dict:
+    """The sender of a synthetic update."""
+    return {"id": user_id, "is_bot": False, "first_name": "u", "username": f"u{user_id}"}
+
+def message_update(user_id: int, text: str, chat_id: int | None = None) -> dict:
+    """A text message (or command) from a user."""
+    update_id = next(_update_ids)
+    message = {"message_id": update_id, "date": int(time.time()), "from": user_json(user_id), "text": text,
+               "chat": {"id": chat_id or user_id, "type": "private" if chat_id is None else "group"}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+def callback_update(user_id: int, data: str, chat_id: int | None = None) -> dict:
+    """A button press from a user."""
+    update_id = next(_update_ids)
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "chat_instance": "load", "data": data, "from": user_json(user_id),
+        "message": {"message_id": update_id, "date": int(time.time()), "text": "msg",
+                    "chat": {"id": chat_id or user_id, "type": "private" if chat_id is None else "group"}}}}
+
+def user_session(user_id: int, catalog: dict) -> list[dict]:
+    """The updates one virtual user sends, in order."""
+    cb = main.encode_callback
+    return [
+        message_update(user_id, "/start"),
+        callback_update(user_id, cb("BUY")),
+        callback_update(user_id, cb("BUY_CAT", catalog["main"])),
+        callback_update(user_id, cb("BUY_CAT", catalog["sub"])),
+        callback_update(user_id, cb("BUY_PROD", catalog["regular"])),
+        message_update(user_id, f"player{user_id}"),
+        callback_update(user_id, cb("BUY_CONFIRM")),
+        callback_update(user_id, cb("BUY_PROD", catalog["quantity"])),
+        message_update(user_id, "10"),
+        message_update(user_id, f"player{user_id}"),
+        callback_update(user_id, cb("BUY_CONFIRM")),
+        callback_update(user_id, cb("TOPUP_START")),
+        message_update(user_id, f"OP{user_id}"),
+        message_update(user_id, "5000"),
+    ]
+
+def admin_session(topup_ids: list[int], order_ids: list[int]) -> list[dict]:
+    """The admin accepting every pending top-up and order from the admin groups."""
+    return ([callback_update(ADMIN_ID, main.encode_callback("TP_ACCEPT", i), TOPUP_GROUP) for i in topup_ids]
+            + [callback_update(ADMIN_ID, main.encode_callback("ORD_ACCEPT", i), ORDERS_GROUP) for i in order_ids])
+
+def interleave(sessions: list[list[dict]]) -> list[dict]:
+    """Orders the sessions' updates round-robin, as if the users were active at once."""
+    return [update for step in itertools.zip_longest(*sessions) for update in step if update is not None]
+
+# --- Measurements ------------------------------------------------------------
+
+class Recorder:
+    """Collects raw latency samples per name."""
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        """Records one sample."""
+        self.samples.setdefault(name, []).append(seconds)
+
+    def wrap_metric(self, metric: main.LatencyMetric):
+        """Also records every observation of one of the bot's latency metrics."""
+        observe = metric.observe
+
+        @wraps(observe)
+        def recording_observe(value: str, seconds: float, error: bool = False):
+            self.add(value, seconds)
+            observe(value, seconds, error)
+        metric.observe = recording_observe
+
+def percentile(sorted_samples: list[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted samples."""
+    index = max(0, min(len(sorted_samples) - 1, int(round(pct / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+def summarize(samples: list[float]) -> dict:
+    """Count, percentiles and maximum of a list of samples, in milliseconds."""
+    ordered = sorted(samples)
+    summary = {"count": len(ordered), "total_ms": sum(ordered) * 1000}
+    for pct in PERCENTILES:
+        summary[f"p{pct}_ms"] = percentile(ordered, pct) * 1000
+    summary["max_ms"] = ordered[-1] * 1000
+    return summary
+
+def install_db_wait_probe(recorder: Recorder):
+    """Records how long each run_db() call waits for the DB thread before it starts."""
+    run_db = main.run_db
+
+    @wraps(run_db)
+    async def probed_run_db(fn, *args, **kwargs):
+        submitted = time.perf_counter()
+
+        @wraps(fn)
+        def started(*fn_args):
+            recorder.add("wait", time.perf_counter() - submitted)
+            return fn(*fn_args)
+        return await run_db(started, *args, **kwargs)
+    main.run_db = probed_run_db
+
+# --- Setup and run -----------------------------------------------------------
+
+def seed_database(users: int) -> dict:
+    """Creates the catalog, the admin group settings and funded users; returns the catalog ids."""
+    main.init_db()
+    conn = main.db()
+    if conn.execute("SELECT EXISTS(SELECT 1 FROM users) OR EXISTS(SELECT 1 FROM categories)").fetchone()[0]:
+        raise SystemExit(f"{main.DB_PATH} already holds data; pass a new or empty file to --db.")
+    main_cat = main.add_category("Games")
+    sub_cat = main.add_category("PUBG", main_cat)
+    catalog = {
+        "main": main_cat,
+        "sub": sub_cat,
+        "regular": main.add_product(sub_cat, "60 UC", 1000),
+        "quantity": main.add_product(sub_cat, "Coins", 10, "quantity", 5, 50),
+    }
+    main.set_setting(main.SETTING_GROUP_ORDERS, str(ORDERS_GROUP))
+    main.set_setting(main.SETTING_GROUP_TOPUP, str(TOPUP_GROUP))
+    with main.transaction():
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+            main.db().execute("INSERT INTO users(user_id, username) VALUES(?,?)", (user_id, f"u{user_id}"))
+            main.post_ledger(user_id, main.to_minor(STARTING_BALANCE), 'credit')
+    return catalog
+
+async def feed(app, updates: list[dict], timeout: float) -> dict:
+    """Queues the updates, waits until every one was handled and returns the phase's results."""
+    done = asyncio.Event()
+    remaining = len(updates)
+    errors = 0
+
+    async def handled(update: Update, context):
+        nonlocal remaining
+        remaining -= 1
+        if remaining == 0:
+            done.set()
+
+    async def failed(update: object, context):
+        nonlocal errors
+        errors += 1
+
+    handler = TypeHandler(Update, handled)
+    app.add_handler(handler, group=1000)
+    app.add_error_handler(failed)
+    started = time.perf_counter()
+    for data in updates:
+        await app.update_queue.put(Update.de_json(data, app.bot))
+    try:
+        await asyncio.wait_for(done.wait(), timeout)
+    finally:
+        app.remove_handler(handler, group=1000)
+        app.remove_error_handler(failed)
+    seconds = time.perf_counter() - started
+    return {"updates": len(updates), "seconds": seconds, "updates_per_sec": len(updates) / seconds,
+            "errors": errors}
+
+def pending_ids(table: str) -> list[int]:
+    """The ids of a table's pending top-ups or orders."""
+    return [row["id"] for row in main.db().execute(f"SELECT id FROM {table} WHERE status='pending' ORDER BY id")]
+
+async def run(args) -> dict:
+    """Runs both phases of the load test and returns the results."""
+    main.UPDATE_CONCURRENCY = args.concurrency
+    catalog = seed_database(args.users)
+    bot_api = FakeBotRequest(args.api_latency / 1000)
+    app = main.build_application(ApplicationBuilder().request(bot_api).get_updates_request(FakeBotRequest()))
+
+    handlers, db_calls, db_waits = Recorder(), Recorder(), Recorder()
+    handlers.wrap_metric(main.HANDLER_METRICS)
+    db_calls.wrap_metric(main.DB_METRICS)
+    install_db_wait_probe(db_waits)
+
+    results = {"users": args.users, "api_latency_ms": args.api_latency, "concurrency": args.concurrency,
+               "phases": {}}
+    sessions = [user_session(user_id, catalog) for user_id in range(FIRST_USER_ID, FIRST_USER_ID + args.users)]
+    async with app:
+        await app.start()
+        main.start_outbox_worker(app.bot)
+        results["phases"]["users"] = await feed(app, interleave(sessions), args.timeout)
+        results["pending"] = await main.run_db(main.count_pending)
+        admin_updates = admin_session(pending_ids("topups"), pending_ids("orders"))
+        results["phases"]["admin"] = await feed(app, admin_updates, args.timeout)
+        await app.stop()
+        await main.on_stop(app)
+    await main.on_shutdown(app)
+    for task in asyncio.all_tasks() - {asyncio.current_task()}:
+        task.cancel()
+
+    results["handlers"] = {name: summarize(s) for name, s in sorted(handlers.samples.items())}
+    results["db_helpers"] = {name: summarize(s) for name, s in sorted(db_calls.samples.items())}
+    results["db_wait"] = summarize(db_waits.samples["wait"]) if db_waits.samples else None
+    results["bot_api_calls"] = dict(sorted(bot_api.calls.items()))
+    return results
+
+# --- Report ------------------------------------------------------------------
+
+def latency_table(title: str, rows: dict[str, dict], limit: int | None = None) -> list[str]:
+    """Formats latency summaries as a table, slowest total first."""
+    ordered = sorted(rows.items(), key=lambda item: -item[1]["total_ms"])[:limit]
+    lines = [f"\n{title:<40}{'calls':>8}" + "".join(f"{f'p{p} ms':>10}" for p in PERCENTILES) + f"{'max ms':>10}"]
+    for name, s in ordered:
+        lines.append(f"{name:<40}{s['count']:>8}" + "".join(f"{s[f'p{p}_ms']:>10.2f}" for p in PERCENTILES)
+                     + f"{s['max_ms']:>10.2f}")
+    return lines
+
+def report(results: dict) -> str:
+    """The human-readable load test report."""
+    lines = [f"{results['users']} virtual users, Bot API latency {results['api_latency_ms']} ms, "
+             f"up to {results['concurrency']} concurrent updates"]
+    lines.append(f"pending after the users phase: {results['pending']['topup']} top-ups, "
+                 f"{results['pending']['order']} orders")
+    for name, phase in results["phases"].items():
+        lines.append(f"{name:>6}: {phase['updates']} updates in {phase['seconds']:.2f} s = "
+                     f"{phase['updates_per_sec']:.1f} updates/s, {phase['errors']} errors")
+    lines += latency_table("handler", results["handlers"])
+    lines += latency_table("database helper", results["db_helpers"], limit=15)
+    if results["db_wait"]:
+        lines += latency_table("DB thread wait (per run_db call)", {"run_db": results["db_wait"]})
+    lines.append("\nBot API calls: " + ", ".join(f"{m}={n}" for m, n in results["bot_api_calls"].items()))
+    return "\n".join(lines)
+
+def main_cli():
+    """Parses the options, runs the load test and prints (and optionally saves) the results."""
+    parser = argparse.ArgumentParser(description="Offline load test of the bot's handlers.")
+    parser.add_argument("--users", type=int, default=1000, help="virtual users (default 1000)")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="fake Bot API latency in ms")
+    parser.add_argument("--concurrency", type=int, default=main.UPDATE_CONCURRENCY,
+                        help="updates processed at once (default: the bot's setting)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="seconds allowed per phase")
+    parser.add_argument("--db", help="new or empty database file (default: a temporary one)")
+    parser.add_argument("--json", help="also write the results to this file, e.g. to compare branches")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main.DB_PATH = args.db or os.path.join(tmp, "loadtest.db")
+        main.METRICS_PORT = 0
+        results = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    print(report(results))
+
+if __name__ == '__main__':
+    main_cli()
@@ -1,11 +1,32 @@
+import os
+import csv
+import html
+import json
+import math
 import sqlite3
 import logging
+import logging.handlers
 import re
+import threading
+import time
+import asyncio
+import tempfile
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from functools import wraps
 from datetime import datetime, timedelta
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
-from telegram.constants import ParseMode
+from telegram import (Update, InlineKeyboardMarkup, InlineKeyboardButton, InlineQueryResultArticle,
+                      InputTextMessageContent)
+from telegram.ext import (ApplicationBuilder, BasePersistence, BaseUpdateProcessor, ContextTypes, CommandHandler,
+                          CallbackQueryHandler, InlineQueryHandler, MessageHandler, PersistenceInput, TypeHandler,
+                          filters)
+from telegram.constants import ChatType, ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 
 # -----------------------------------------------------------------------------
 # Bot Configuration and Initialization
@@ -19,9 +40,21 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Essential Bot Credentials and Database Path.
-BOT_TOKEN = "8439068545:AAFe_SlJuLJp7-ue4rZQljN6WVl_GFPT_l4"
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "8439068545:AAFe_SlJuLJp7-ue4rZQljN6WVl_GFPT_l4")
 DB_PATH = "bot_data.db"
 
+# Update delivery. BOT_MODE=polling (default) long-polls Telegram; BOT_MODE=webhook
+# serves updates from a local HTTP listener that the reverse proxy forwards
+# WEBHOOK_URL to. Telegram sends WEBHOOK_SECRET with every request and requests
+# without it are rejected.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")              # public URL, e.g. https://example.com/telegram
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+
 # User state management dictionary to track multi-step conversations.
 user_states = {}
 
@@ -39,25 +72,119 @@ SETTING_GROUP_ORDERS = "group_orders"
 SETTING_ADMINS = "admins"
 SETTING_GROUP_SUBS = "group_subscriptions"
 SETTING_GROUP_EXPIRE = "group_subscription_expire"
+SETTING_NEWS = "news_message"
+SETTING_SUPPORT_MESSAGE = "support_message"
 
 # -----------------------------------------------------------------------------
 # Database Helper Functions
 # These functions provide a clean interface for all database operations.
 # -----------------------------------------------------------------------------
 
-def db():
-    """Connect to the SQLite database and set the row factory to dict-like objects."""
-    conn = sqlite3.connect(DB_PATH)
+# Connection tuning. Connections are kept open for the lifetime of the process
+# (one per thread), so the pragmas, page cache and prepared statement cache stay
+# warm instead of being rebuilt on every query.
+DB_BUSY_TIMEOUT = 10.0              # seconds a writer waits for the lock
+DB_CACHE_SIZE_KB = 16 * 1024        # page cache per connection
+DB_MMAP_SIZE = 64 * 1024 * 1024     # memory-mapped I/O window
+DB_STATEMENT_CACHE = 256            # prepared statements kept per connection
+
+_db_local = threading.local()
+_db_connections: list[sqlite3.Connection] = []
+_db_connections_lock = threading.Lock()
+
+# Arabic search normalization: strip diacritics and tatweel, then fold the
+# letter variants people type interchangeably (alef forms, alef maqsura and
+# ya, ta marbuta and ha). Applied both when indexing and when querying.
+ARABIC_DIACRITICS = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+ARABIC_LETTER_FOLDS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي", "ؤ": "و", "ة": "ه",
+})
+
+def normalize_arabic(text: str | None) -> str | None:
+    """Normalizes text for the search index (also exposed to SQL as normalize_ar())."""
+    if text is None:
+        return None
+    return ARABIC_DIACRITICS.sub("", text).translate(ARABIC_LETTER_FOLDS).casefold()
+
+def _open_connection() -> sqlite3.Connection:
+    """Opens a new connection with WAL journaling and the tuned pragmas applied."""
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=DB_STATEMENT_CACHE,
+    )
     conn.row_factory = sqlite3.Row
+    conn.create_function("normalize_ar", 1, normalize_arabic, deterministic=True)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    if sql_tracer is not None:
+        sql_tracer.install(conn)
     return conn
 
-def init_db():
-    """Initializes the database by creating all necessary tables."""
+def db() -> sqlite3.Connection:
+    """Returns the calling thread's pooled connection, opening it on first use.
+
+    Connections run in autocommit mode: single statements commit on their own and
+    multi-statement writes must be wrapped in `transaction()`.
+    """
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction(immediate: bool = False):
+    """Runs the enclosed statements in a single transaction on the pooled connection.
+
+    `immediate=True` takes the write lock up front (BEGIN IMMEDIATE) so that a
+    read-then-write sequence cannot fail half way with SQLITE_BUSY. Nested uses
+    join the outer transaction.
+    """
     conn = db()
-    cur = conn.cursor()
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
 
+def close_db():
+    """Closes every pooled connection. Called once when the bot shuts down."""
+    with _db_connections_lock:
+        while _db_connections:
+            conn = _db_connections.pop()
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+    _db_local.__dict__.pop("conn", None)
+
+# -----------------------------------------------------------------------------
+# Schema Migrations
+# Each migration upgrades the schema by one version. init_db() applies, in order
+# and each in its own transaction, every migration newer than the highest version
+# recorded in the schema_version table, so existing bot_data.db files are
+# upgraded in place.
+# -----------------------------------------------------------------------------
+
+def _migration_base_tables(conn: sqlite3.Connection):
+    """Version 1: the original tables, created if they do not exist yet."""
     # Users table to store user information, balance, and admin status.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -67,7 +194,7 @@ def init_db():
     """)
 
     # Categories table for product organization (main and sub-categories).
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS categories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -77,7 +204,7 @@ def init_db():
     """)
 
     # Products table to store product details, price, and stock.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             category_id INTEGER NOT NULL,
@@ -91,16 +218,8 @@ def init_db():
         );
     """)
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-    """)
-    
-
     # Top-ups table to log all top-up requests.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS topups (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -111,16 +230,9 @@ def init_db():
             FOREIGN KEY(user_id) REFERENCES users(user_id)
         );
     """)
-    
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS settings (
-            key TEXT PRIMARY KEY,
-            value TEXT
-        );
-    """)
 
     # Orders table to log all product purchase orders.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -135,15 +247,15 @@ def init_db():
     """)
 
     # Settings table for storing key-value pairs of bot settings.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS settings (
             key TEXT PRIMARY KEY,
             value TEXT
         );
     """)
-    
+
     # Subscriptions table for managing time-based services.
-    cur.execute("""
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS subscriptions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER NOT NULL,
@@ -155,32 +267,282 @@ def init_db():
         );
     """)
 
-    # Commits all changes and closes the connection.
-    conn.commit()
-    conn.close()
+def _migration_lookup_indexes(conn: sqlite3.Connection):
+    """Version 2: indexes for the catalog tree and the per-user/per-status lookups."""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_categories_parent ON categories(parent_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_status ON orders(user_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topups_status ON topups(status)")
+
+def _migration_admins_table(conn: sqlite3.Connection):
+    """Version 3: the admins table used by add_admin()/remove_admin()."""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        );
+    """)
+
+def _migration_epoch_timestamps(conn: sqlite3.Connection):
+    """Version 4: stores orders/topups created_at as indexed epoch seconds.
+
+    SQLite cannot change a column's type in place, so both tables are rebuilt.
+    The rebuilt orders table also lets product_id become NULL when a product is
+    deleted, so that old orders no longer block deleting products.
+    """
+    conn.execute("""
+        CREATE TABLE topups_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            op_number TEXT NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+    """)
+    conn.execute("""
+        INSERT INTO topups_new(id, user_id, op_number, amount, status, created_at)
+        SELECT id, user_id, op_number, amount, status,
+               COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+        FROM topups
+    """)
+    conn.execute("DROP TABLE topups")
+    conn.execute("ALTER TABLE topups_new RENAME TO topups")
+
+    conn.execute("""
+        CREATE TABLE orders_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NULL,
+            price REAL NOT NULL,
+            contact TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id),
+            FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
+        );
+    """)
+    # Before foreign keys were enforced, deleting a product left its orders
+    # pointing at a missing id; those orders keep their history with no product.
+    conn.execute("""
+        INSERT INTO orders_new(id, user_id, product_id, price, contact, status, created_at)
+        SELECT id, user_id,
+               CASE WHEN product_id IN (SELECT id FROM products) THEN product_id END,
+               price, contact, status,
+               COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)
+        FROM orders
+    """)
+    conn.execute("DROP TABLE orders")
+    conn.execute("ALTER TABLE orders_new RENAME TO orders")
+
+    conn.execute("CREATE INDEX idx_orders_user_status ON orders(user_id, status)")
+    conn.execute("CREATE INDEX idx_orders_created ON orders(created_at)")
+    conn.execute("CREATE INDEX idx_topups_status ON topups(status)")
+    conn.execute("CREATE INDEX idx_topups_created ON topups(created_at)")
+
+def _migration_balance_ledger(conn: sqlite3.Connection):
+    """Version 5: append-only balance ledger with integer minor-unit amounts.
+
+    users.balance_minor becomes the materialized balance. Every existing balance
+    is carried over as an 'opening' ledger entry, so the ledger sums to it.
+    """
+    conn.execute("ALTER TABLE users ADD COLUMN balance_minor INTEGER NOT NULL DEFAULT 0")
+    conn.execute("UPDATE users SET balance_minor = CAST(ROUND(COALESCE(balance, 0) * ?) AS INTEGER)",
+                 (MINOR_UNITS,))
+    if sqlite3.sqlite_version_info >= (3, 35, 0):
+        conn.execute("ALTER TABLE users DROP COLUMN balance")
+
+    conn.execute("""
+        CREATE TABLE ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount_minor INTEGER NOT NULL,
+            balance_after_minor INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            ref_id INTEGER NULL,
+            created_at INTEGER NOT NULL,
+            FOREIGN KEY(user_id) REFERENCES users(user_id)
+        );
+    """)
+    conn.execute("CREATE INDEX idx_ledger_user ON ledger(user_id, id)")
+
+    # Per-user balance as verified by the last consistency check.
+    conn.execute("""
+        CREATE TABLE ledger_snapshots (
+            user_id INTEGER PRIMARY KEY,
+            ledger_id INTEGER NOT NULL,
+            balance_minor INTEGER NOT NULL,
+            taken_at INTEGER NOT NULL
+        );
+    """)
+
+    conn.execute("""
+        INSERT INTO ledger(user_id, amount_minor, balance_after_minor, kind, created_at)
+        SELECT user_id, balance_minor, balance_minor, 'opening', ?
+        FROM users WHERE balance_minor != 0
+    """, (int(time.time()),))
+
+def _migration_broadcasts(conn: sqlite3.Connection):
+    """Version 6: broadcasts with checkpointed progress so they survive restarts."""
+    conn.execute("""
+        CREATE TABLE broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER NULL,
+            status TEXT NOT NULL,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at INTEGER NOT NULL,
+            finished_at INTEGER NULL
+        );
+    """)
+    conn.execute("CREATE INDEX idx_broadcasts_status ON broadcasts(status)")
+
+def _migration_reachability(conn: sqlite3.Connection):
+    """Version 7: per-user delivery outcome and last-seen time, and broadcast segments."""
+    conn.execute("ALTER TABLE users ADD COLUMN reachable INTEGER NOT NULL DEFAULT 1")
+    conn.execute("ALTER TABLE users ADD COLUMN last_seen INTEGER NULL")
+    conn.execute("ALTER TABLE users ADD COLUMN delivery_failed_at INTEGER NULL")
+    conn.execute("CREATE INDEX idx_users_reachable ON users(reachable, user_id)")
+    conn.execute("CREATE INDEX idx_users_last_seen ON users(last_seen)")
+
+    # Covers "who bought since X" without touching the orders rows.
+    conn.execute("DROP INDEX idx_orders_created")
+    conn.execute("CREATE INDEX idx_orders_created_user ON orders(created_at, user_id)")
+
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN segment TEXT NOT NULL DEFAULT 'all'")
+    conn.execute("ALTER TABLE broadcasts ADD COLUMN segment_since INTEGER NULL")
+
+def _migration_conversation_state(conn: sqlite3.Connection):
+    """Version 8: persisted user_data/chat_data so multi-step flows survive restarts."""
+    conn.execute("""
+        CREATE TABLE conversation_state (
+            kind TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            updated_at INTEGER NOT NULL,
+            PRIMARY KEY(kind, id)
+        ) WITHOUT ROWID;
+    """)
+
+# Search text for a product's category: its own name followed by its parent's.
+SEARCH_CATEGORY_TEXT = """(SELECT normalize_ar(c.name || ' ' || COALESCE(p.name, ''))
+                           FROM categories c LEFT JOIN categories p ON p.id = c.parent_id
+                           WHERE c.id = {})"""
+
+def _migration_product_search(conn: sqlite3.Connection):
+    """Version 9: FTS5 index over normalized product and category names, kept in sync by triggers."""
+    conn.execute("CREATE VIRTUAL TABLE product_search USING fts5(name, category, tokenize='unicode61 remove_diacritics 2')")
+    conn.execute(f"""
+        INSERT INTO product_search(rowid, name, category)
+        SELECT id, normalize_ar(name), {SEARCH_CATEGORY_TEXT.format('products.category_id')} FROM products
+    """)
+    conn.executescript(f"""
+        CREATE TRIGGER product_search_insert AFTER INSERT ON products BEGIN
+            INSERT INTO product_search(rowid, name, category)
+            VALUES (new.id, normalize_ar(new.name), {SEARCH_CATEGORY_TEXT.format('new.category_id')});
+        END;
+        CREATE TRIGGER product_search_update AFTER UPDATE OF name, category_id ON products BEGIN
+            UPDATE product_search
+            SET name = normalize_ar(new.name), category = {SEARCH_CATEGORY_TEXT.format('new.category_id')}
+            WHERE rowid = new.id;
+        END;
+        CREATE TRIGGER product_search_delete AFTER DELETE ON products BEGIN
+            DELETE FROM product_search WHERE rowid = old.id;
+        END;
+        CREATE TRIGGER product_search_category AFTER UPDATE OF name, parent_id ON categories BEGIN
+            UPDATE product_search
+            SET category = (SELECT {SEARCH_CATEGORY_TEXT.format('products.category_id')}
+                            FROM products WHERE products.id = product_search.rowid)
+            WHERE rowid IN (SELECT id FROM products WHERE category_id = new.id
+                            OR category_id IN (SELECT id FROM categories WHERE parent_id = new.id));
+        END;
+    """)
+
+def _migration_pending_queue(conn: sqlite3.Connection):
+    """Version 10: index for paging through orders by status (rowid follows status in the index)."""
+    conn.execute("CREATE INDEX idx_orders_status ON orders(status)")
+
+def _migration_outbox(conn: sqlite3.Connection):
+    """Version 11: outbox of user notifications, written with the change they report."""
+    conn.execute("""
+        CREATE TABLE outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT NULL,
+            created_at INTEGER NOT NULL
+        );
+    """)
+    conn.execute("CREATE INDEX idx_outbox_due ON outbox(status, next_attempt_at)")
+    conn.execute("CREATE INDEX idx_outbox_chat ON outbox(chat_id, status, id)")
+
+MIGRATIONS = [
+    _migration_base_tables,
+    _migration_lookup_indexes,
+    _migration_admins_table,
+    _migration_epoch_timestamps,
+    _migration_balance_ledger,
+    _migration_broadcasts,
+    _migration_reachability,
+    _migration_conversation_state,
+    _migration_product_search,
+    _migration_pending_queue,
+    _migration_outbox,
+]
+
+def schema_version() -> int:
+    """Returns the highest migration version applied to the database."""
+    row = db().execute("SELECT MAX(version) AS version FROM schema_version").fetchone()
+    return row['version'] or 0
+
+def migrate_db():
+    """Applies all pending migrations, each in its own transaction."""
+    db().execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at INTEGER NOT NULL
+        );
+    """)
+    current = schema_version()
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if version <= current:
+            continue
+        logger.info("Applying schema migration %d: %s", version, migration.__name__)
+        with transaction(immediate=True) as conn:
+            migration(conn)
+            conn.execute("INSERT INTO schema_version(version, applied_at) VALUES(?,?)",
+                         (version, int(time.time())))
+
+def init_db():
+    """Brings the database schema up to date and loads the settings into memory."""
+    migrate_db()
 
-    # Update the in-memory admin list from the database.
+    # Load the settings and the admin list derived from them into memory.
+    load_settings()
     update_admins_list()
 
 def add_admin(user_id: int):
     """Adds a user ID to the administrators list in the database."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    db().execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
+    ADMIN_IDS.add(user_id)
 
 def remove_admin(user_id: int):
     """Removes a user ID from the administrators list."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM admins WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+    db().execute("DELETE FROM admins WHERE user_id=?", (user_id,))
+    ADMIN_IDS.discard(user_id)
 
 def update_admins_list():
     """Fetches the admin IDs from the database and updates the global set."""
     global ADMIN_IDS
+    ADMIN_IDS.update(row['user_id'] for row in db().execute("SELECT user_id FROM admins"))
     admins_str = get_setting(SETTING_ADMINS)
     if admins_str:
         try:
@@ -194,70 +556,151 @@ def is_admin(user_id: int) -> bool:
 
 def ensure_user(user):
     """Ensures a user exists in the database. Adds them if they don't."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM users WHERE user_id=?", (user.id,))
-    existing_user = cur.fetchone()
+    conn = db()
+    existing_user = conn.execute("SELECT username FROM users WHERE user_id=?", (user.id,)).fetchone()
 
     if existing_user is None:
-        cur.execute("INSERT INTO users(user_id, username) VALUES(?,?)",
-                    (user.id, user.username))
-        conn.commit()
+        conn.execute("INSERT OR IGNORE INTO users(user_id, username) VALUES(?,?)",
+                     (user.id, user.username))
     elif existing_user['username'] != user.username:
-        cur.execute("UPDATE users SET username=? WHERE user_id=?",
-                    (user.username, user.id))
-        conn.commit()
-
-    conn.close()
+        conn.execute("UPDATE users SET username=? WHERE user_id=?",
+                     (user.username, user.id))
 
 def get_user(user_id: int) -> sqlite3.Row | None:
     """Retrieves a single user's information by their ID."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return db().execute("SELECT * FROM users WHERE user_id=?", (user_id,)).fetchone()
+
+# -----------------------------------------------------------------------------
+# Balance Ledger
+# Balances are kept in integer minor units (1/100 of the currency). Every change
+# is appended to the ledger table in the same transaction that updates the
+# materialized users.balance_minor column, so the ledger explains each balance.
+# -----------------------------------------------------------------------------
+
+MINOR_UNITS = 100
+MAX_AMOUNT = 1e12  # largest price or amount accepted; keeps minor units far inside SQLite's 64-bit integers
+LEDGER_CHECK_INTERVAL = 6 * 60 * 60  # seconds between snapshot/consistency checks
+
+def to_minor(amount: float) -> int:
+    """Converts a currency amount to integer minor units."""
+    return int(round(amount * MINOR_UNITS))
+
+def parse_amount(text: str) -> float:
+    """Parses a typed price or amount: a finite number above zero and at most MAX_AMOUNT.
+
+    Raises ValueError otherwise (nan and inf included), so it doubles as a flow validator.
+    """
+    value = float(text)
+    if not (math.isfinite(value) and 0 < value <= MAX_AMOUNT):
+        raise ValueError(text)
+    return round(value, 2)
+
+def from_minor(amount_minor: int) -> float:
+    """Converts integer minor units back to a currency amount."""
+    return amount_minor / MINOR_UNITS
 
 def get_balance(user_id):
     """Retrieves the current balance of a user."""
     user = get_user(user_id)
-    return user['balance'] if user else 0.0
+    return from_minor(user['balance_minor']) if user else 0.0
+
+def post_ledger(user_id: int, amount_minor: int, kind: str, ref_id: int | None = None,
+                require_funds: bool = False) -> int | None:
+    """Appends a ledger entry and applies it to the user's balance atomically.
+
+    Returns the new balance in minor units, or None when the user does not exist
+    or (with require_funds) the balance would go negative.
+    """
+    with transaction() as conn:
+        sql = "UPDATE users SET balance_minor = balance_minor + ? WHERE user_id=?"
+        params = (amount_minor, user_id)
+        if require_funds:
+            sql += " AND balance_minor + ? >= 0"
+            params += (amount_minor,)
+        if conn.execute(sql, params).rowcount == 0:
+            return None
+        balance_minor = conn.execute("SELECT balance_minor FROM users WHERE user_id=?",
+                                     (user_id,)).fetchone()['balance_minor']
+        conn.execute(
+            "INSERT INTO ledger(user_id, amount_minor, balance_after_minor, kind, ref_id, created_at) VALUES(?,?,?,?,?,?)",
+            (user_id, amount_minor, balance_minor, kind, ref_id, int(time.time())),
+        )
+    return balance_minor
+
+def change_balance(user_id: int, amount: float, kind: str = 'adjustment', ref_id: int | None = None) -> float:
+    """Adds or subtracts an amount from a user's balance, recording it in the ledger."""
+    balance_minor = post_ledger(user_id, to_minor(amount), kind, ref_id)
+    return from_minor(balance_minor) if balance_minor is not None else 0.0
+
+def adjust_balance(user_id: int, amount: float, notice: str) -> float | None:
+    """Credits (or, with a negative amount, debits) a user and queues `notice` for them.
+
+    `notice` is formatted with the absolute amount and the new balance. Returns
+    the new balance, or None when the user does not exist.
+    """
+    with transaction(immediate=True) as conn:
+        balance_minor = post_ledger(user_id, to_minor(amount), 'credit' if amount >= 0 else 'debit')
+        if balance_minor is None:
+            return None
+        new_balance = from_minor(balance_minor)
+        enqueue_message(user_id, notice.format(amount=money(abs(amount)), balance=money(new_balance)))
+    return new_balance
+
+def get_ledger(user_id: int, limit: int = 20) -> list[sqlite3.Row]:
+    """Returns a user's most recent ledger entries, newest first."""
+    return db().execute(
+        "SELECT * FROM ledger WHERE user_id=? ORDER BY id DESC LIMIT ?", (user_id, limit)
+    ).fetchall()
+
+def check_ledger() -> list[sqlite3.Row]:
+    """Verifies every balance against its last snapshot plus the newer ledger entries.
+
+    Users whose balance matches get a fresh snapshot, so the next check only
+    has to sum the entries written since. Returns the rows that do not match.
+    """
+    with transaction(immediate=True) as conn:
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) AS id FROM ledger").fetchone()['id']
+        mismatches = conn.execute("""
+            SELECT u.user_id, u.balance_minor,
+                   COALESCE(s.balance_minor, 0) + COALESCE(
+                       (SELECT SUM(l.amount_minor) FROM ledger l
+                        WHERE l.user_id = u.user_id AND l.id > COALESCE(s.ledger_id, 0)), 0
+                   ) AS expected_minor
+            FROM users u LEFT JOIN ledger_snapshots s ON s.user_id = u.user_id
+            WHERE u.balance_minor != expected_minor
+        """).fetchall()
+        bad_ids = [row['user_id'] for row in mismatches]
+        conn.execute(
+            f"""INSERT OR REPLACE INTO ledger_snapshots(user_id, ledger_id, balance_minor, taken_at)
+                SELECT user_id, ?, balance_minor, ? FROM users
+                WHERE user_id NOT IN ({','.join('?' * len(bad_ids))})""",
+            (last_id, int(time.time()), *bad_ids),
+        )
+    return mismatches
 
-def change_balance(user_id: int, amount: float) -> float:
-    """Adds or subtracts an amount from a user's balance."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET balance = balance + ? WHERE user_id=?",
-                (amount, user_id))
-    conn.commit()
-    conn.close()
-    u = get_user(user_id)
-    return u['balance'] if u else 0.0
+# In-memory copy of the settings table. It is filled once by load_settings() and
+# kept current by set_setting(), so reading a setting never touches the disk.
+_settings: dict[str, str] | None = None
+
+def load_settings():
+    """Reads the whole settings table into memory."""
+    global _settings
+    _settings = {row['key']: row['value'] for row in db().execute("SELECT key, value FROM settings")}
 
 def get_setting(key: str) -> str | None:
-    """Retrieves a specific setting's value from the database."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key=?", (key,))
-    row = cur.fetchone()
-    conn.close()
-    return row['value'] if row else None
+    """Retrieves a specific setting's value from the in-memory settings map."""
+    if _settings is None:
+        load_settings()
+    return _settings.get(key)
 
 def set_setting(key: str, value: str):
-    """Sets or updates a specific setting's value in the database."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO settings(key, value) VALUES(?,?)",
-                (key, value))
-    conn.commit()
-    conn.close()
+    """Sets or updates a specific setting's value in the database and in memory."""
+    db().execute("INSERT OR REPLACE INTO settings(key, value) VALUES(?,?)",
+                 (key, value))
+    if _settings is None:
+        load_settings()
+    else:
+        _settings[key] = value
     if key == SETTING_ADMINS:
         update_admins_list()
 
@@ -268,76 +711,844 @@ def money(amount):
     else:
         return f"{amount} $"
 
-def get_categories(parent_id: int | None = None) -> list[sqlite3.Row]:
-    """Retrieves a list of categories based on their parent ID."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    if parent_id is None:
-        cur.execute("SELECT * FROM categories WHERE parent_id IS NULL ORDER BY id ASC")
-    else:
-        cur.execute("SELECT * FROM categories WHERE parent_id=? ORDER BY id ASC", (parent_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def get_sub_categories(parent_id: int) -> list[sqlite3.Row]:
-    """Retrieves all sub-categories for a given parent ID."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM categories WHERE parent_id=? ORDER BY id ASC", (parent_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def get_category(cat_id: int) -> sqlite3.Row | None:
-    """Retrieves a single category by its ID."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM categories WHERE id=?", (cat_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+def add_category(name: str, parent_id: int | None = None) -> int:
+    """Creates a main category (or a sub-category when parent_id is given)."""
+    cat_id = db().execute("INSERT INTO categories(name, parent_id) VALUES(?,?)", (name, parent_id)).lastrowid
+    catalog_cache.invalidate()
+    return cat_id
+
+def rename_category(cat_id: int, name: str):
+    """Renames a category."""
+    db().execute("UPDATE categories SET name=? WHERE id=?", (name, cat_id))
+    catalog_cache.invalidate()
+
+def move_category(cat_id: int, parent_id: int):
+    """Attaches a sub-category to a different parent category."""
+    db().execute("UPDATE categories SET parent_id=? WHERE id=?", (parent_id, cat_id))
+    catalog_cache.invalidate()
+
+def delete_category(cat_id: int):
+    """Deletes a category together with its sub-categories and products."""
+    db().execute("DELETE FROM categories WHERE id=?", (cat_id,))
+    catalog_cache.invalidate()
+
+def add_product(cat_id: int, name: str, price: float, product_type: str = 'regular',
+                min_qty: int | None = None, max_qty: int | None = None, stock: int | None = None) -> int:
+    """Creates a product in a category. A NULL stock means unlimited quantity."""
+    cur = db().execute(
+        "INSERT INTO products(category_id, name, price, stock, min_qty, max_qty, product_type) VALUES(?,?,?,?,?,?,?)",
+        (cat_id, name, price, stock, min_qty, max_qty, product_type),
+    )
+    catalog_cache.invalidate()
+    return cur.lastrowid
+
+def rename_product(prod_id: int, name: str):
+    """Renames a product."""
+    db().execute("UPDATE products SET name=? WHERE id=?", (name, prod_id))
+    catalog_cache.invalidate()
+
+def reprice_product(prod_id: int, price: float):
+    """Changes a product's price."""
+    db().execute("UPDATE products SET price=? WHERE id=?", (price, prod_id))
+    catalog_cache.invalidate()
+
+# Bulk repricing works on a category subtree, or on the whole store when the
+# category is NULL (every main category seeds the walk). New prices are
+# price * :factor + :delta, rounded to the nearest multiple of :step, all
+# computed inside SQLite. A change that would leave any price at zero or below
+# is refused, as typed prices must be above zero too.
+REPRICE_SUBTREE = """
+    WITH RECURSIVE subtree(id) AS (
+        SELECT id FROM categories WHERE id = :cat_id OR (:cat_id IS NULL AND parent_id IS NULL)
+        UNION ALL
+        SELECT categories.id FROM categories JOIN subtree ON categories.parent_id = subtree.id
+    )
+"""
+# Without a step (NULL) prices are only rounded to the currency's minor units.
+REPRICE_NEW_PRICE = "MAX(0, ROUND(COALESCE(ROUND((price * :factor + :delta) / :step) * :step, price * :factor + :delta), 2))"
 
-def get_products_by_cat(cat_id: int) -> list[sqlite3.Row]:
-    """Retrieves all products belonging to a specific category."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE category_id=?", (cat_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
-
-def get_product(prod_id: int) -> sqlite3.Row | None:
-    """Retrieves a single product by its ID."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id=?", (prod_id,))
-    row = cur.fetchone()
-    conn.close()
+def preview_reprice(cat_id: int | None, factor: float, delta: float, step: float | None) -> tuple[sqlite3.Row, list[sqlite3.Row]]:
+    """Returns the product count, price totals before/after and lowest/highest new price of a bulk reprice, plus a few examples."""
+    params = {"cat_id": cat_id, "factor": factor, "delta": delta, "step": step}
+    conn = db()
+    totals = conn.execute(REPRICE_SUBTREE + f"""
+        SELECT COUNT(*) AS products, TOTAL(price) AS before, TOTAL({REPRICE_NEW_PRICE}) AS after,
+               MIN({REPRICE_NEW_PRICE}) AS lowest, MAX({REPRICE_NEW_PRICE}) AS highest
+        FROM products WHERE category_id IN subtree
+    """, params).fetchone()
+    samples = conn.execute(REPRICE_SUBTREE + f"""
+        SELECT name, price AS before, {REPRICE_NEW_PRICE} AS after
+        FROM products WHERE category_id IN subtree ORDER BY id LIMIT 5
+    """, params).fetchall()
+    return totals, samples
+
+def apply_reprice(cat_id: int | None, factor: float, delta: float, step: float | None) -> int | None:
+    """Reprices a category subtree (or every product) in one statement; returns the number of products.
+
+    Returns None without changing anything when a new price would not be above
+    zero, which can happen if prices changed since the preview.
+    """
+    params = {"cat_id": cat_id, "factor": factor, "delta": delta, "step": step}
+    with transaction(immediate=True) as conn:
+        lowest = conn.execute(REPRICE_SUBTREE + f"""
+            SELECT MIN({REPRICE_NEW_PRICE}) FROM products WHERE category_id IN subtree
+        """, params).fetchone()[0]
+        if lowest is not None and lowest <= 0:
+            return None
+        conn.execute(REPRICE_SUBTREE + f"""
+            UPDATE products SET price = {REPRICE_NEW_PRICE} WHERE category_id IN subtree
+        """, params)
+        # Cursor.rowcount is not set for statements starting with WITH.
+        count = conn.execute("SELECT changes()").fetchone()[0]
+    catalog_cache.invalidate()
+    return count
+
+def move_product(prod_id: int, cat_id: int):
+    """Moves a product to another category."""
+    db().execute("UPDATE products SET category_id=? WHERE id=?", (cat_id, prod_id))
+    catalog_cache.invalidate()
+
+def delete_product(prod_id: int):
+    """Deletes a product."""
+    db().execute("DELETE FROM products WHERE id=?", (prod_id,))
+    catalog_cache.invalidate()
+
+# Bulk catalog files: one product per CSV row or JSON Lines object. The category
+# is a path of names from the main category down, e.g. "ألعاب > ببجي"; missing
+# categories are created. A ">" or "\" inside a category name is written with
+# a backslash before it, so that such names survive an export and re-import. A
+# product is matched to an existing one by its name within that category. An
+# empty stock means unlimited.
+CATALOG_FIELDS = ("category", "name", "price", "type", "min_qty", "max_qty", "stock")
+CATALOG_PATH_SEPARATOR = " > "
+CATALOG_PATH_ESCAPE = "\\"
+CATALOG_FORMATS = ("csv", "jsonl")
+
+class CatalogImportError(Exception):
+    """Raised when an uploaded catalog file cannot be read at all."""
+
+class CatalogImportPlan:
+    """The changes an import would make, computed without writing anything."""
+    __slots__ = ("category_ids", "new_categories", "inserts", "updates", "unchanged", "errors")
+
+    def __init__(self):
+        self.category_ids: dict[tuple[str, ...], int | None] = {}  # path -> id, None until created
+        self.new_categories: list[tuple[str, ...]] = []
+        self.inserts: list[tuple[tuple[str, ...], tuple]] = []  # (path, product values)
+        self.updates: list[tuple[int, tuple, list[str]]] = []  # (product id, values, changed fields)
+        self.unchanged = 0
+        self.errors: list[tuple[int, str]] = []  # (line number, reason)
+
+def _catalog_field(raw: dict, key: str) -> str:
+    """Returns a field of an uploaded row as stripped text ('' when missing)."""
+    value = raw.get(key)
+    return "" if value is None else str(value).strip()
+
+def join_catalog_path(names) -> str:
+    """Writes category names as a path, escaping the separator inside names."""
+    separator, escape = CATALOG_PATH_SEPARATOR.strip(), CATALOG_PATH_ESCAPE
+    return CATALOG_PATH_SEPARATOR.join(
+        name.replace(escape, escape * 2).replace(separator, escape + separator) for name in names)
+
+def split_catalog_path(text: str) -> tuple[str, ...]:
+    """Reads a category path written by join_catalog_path() (or by hand) into stripped names."""
+    parts, part = [], []
+    chars = iter(text)
+    for char in chars:
+        if char == CATALOG_PATH_ESCAPE:
+            part.append(next(chars, CATALOG_PATH_ESCAPE))
+        elif char == CATALOG_PATH_SEPARATOR.strip():
+            parts.append("".join(part).strip())
+            part = []
+        else:
+            part.append(char)
+    parts.append("".join(part).strip())
+    return tuple(parts)
+
+def parse_catalog_row(raw: dict) -> tuple[tuple[str, ...], tuple]:
+    """Validates one uploaded row into (category path, (name, price, type, min_qty, max_qty, stock))."""
+    path = split_catalog_path(_catalog_field(raw, "category"))
+    if not all(path):
+        raise ValueError("مسار القسم غير صالح")
+    name = _catalog_field(raw, "name")
+    if not name:
+        raise ValueError("اسم المنتج فارغ")
+    try:
+        price = parse_amount(_catalog_field(raw, "price"))
+    except ValueError:
+        raise ValueError("السعر غير صالح") from None
+    product_type = _catalog_field(raw, "type") or "regular"
+    if product_type not in ("regular", "quantity"):
+        raise ValueError("النوع يجب أن يكون regular أو quantity")
+    try:
+        min_qty, max_qty, stock = (int(_catalog_field(raw, key)) if _catalog_field(raw, key) else None
+                                   for key in ("min_qty", "max_qty", "stock"))
+    except ValueError:
+        raise ValueError("الكميات يجب أن تكون أرقاماً صحيحة") from None
+    if product_type == "quantity" and (min_qty is None or max_qty is None or not 1 <= min_qty <= max_qty):
+        raise ValueError("نطاق الكمية غير صالح")
+    return path, (name, price, product_type, min_qty, max_qty, stock)
+
+def read_catalog_file(path: str, fmt: str):
+    """Yields (line number, raw row) from an uploaded file without loading it whole."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        if fmt == "csv":
+            reader = csv.DictReader(f)
+            missing = {"category", "name", "price"} - set(reader.fieldnames or ())
+            if missing:
+                raise CatalogImportError(f"أعمدة ناقصة: {', '.join(sorted(missing))}")
+            for raw in reader:
+                yield reader.line_num, raw
+        else:
+            for line_num, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    raw = json.loads(line)
+                except ValueError:
+                    raw = None
+                yield line_num, raw if isinstance(raw, dict) else None
+
+def plan_catalog_import(path: str, fmt: str) -> CatalogImportPlan:
+    """Compares an uploaded catalog file against the current catalog."""
+    snapshot = catalog_cache.get()
+    plan = CatalogImportPlan()
+    plan.category_ids[()] = None
+    existing: dict[int, dict[str, sqlite3.Row]] = {}  # category id -> products by name
+    seen: set[tuple[tuple[str, ...], str]] = set()
+    try:
+        for line_num, raw in read_catalog_file(path, fmt):
+            if raw is None:
+                plan.errors.append((line_num, "سطر JSON غير صالح"))
+                continue
+            try:
+                cat_path, values = parse_catalog_row(raw)
+            except ValueError as e:
+                plan.errors.append((line_num, str(e)))
+                continue
+            if (cat_path, values[0]) in seen:
+                plan.errors.append((line_num, "منتج مكرر في الملف"))
+                continue
+            seen.add((cat_path, values[0]))
+
+            # Resolve the category path, queueing the categories that do not exist yet.
+            for depth in range(1, len(cat_path) + 1):
+                prefix = cat_path[:depth]
+                if prefix in plan.category_ids:
+                    continue
+                parent_id = plan.category_ids[prefix[:-1]]
+                match = None
+                if parent_id is not None or depth == 1:
+                    match = next((c for c in snapshot.categories_under(parent_id) if c['name'] == prefix[-1]), None)
+                plan.category_ids[prefix] = match['id'] if match else None
+                if match is None:
+                    plan.new_categories.append(prefix)
+
+            cat_id = plan.category_ids[cat_path]
+            current = None
+            if cat_id is not None:
+                if cat_id not in existing:
+                    existing[cat_id] = {p['name']: p for p in snapshot.products_in(cat_id)}
+                current = existing[cat_id].get(values[0])
+            if current is None:
+                plan.inserts.append((cat_path, values))
+                continue
+            changed = [field for field, value in zip(CATALOG_FIELDS[2:], values[1:])
+                       if current['product_type' if field == 'type' else field] != value]
+            if changed:
+                plan.updates.append((current['id'], values, changed))
+            else:
+                plan.unchanged += 1
+    except (UnicodeDecodeError, csv.Error) as e:
+        raise CatalogImportError(f"تعذرت قراءة الملف: {e}") from None
+    return plan
+
+def apply_catalog_import(path: str, fmt: str) -> CatalogImportPlan:
+    """Applies an uploaded catalog file in one transaction and invalidates the cache once."""
+    with transaction(immediate=True) as conn:
+        plan = plan_catalog_import(path, fmt)
+        for cat_path in plan.new_categories:
+            plan.category_ids[cat_path] = conn.execute(
+                "INSERT INTO categories(name, parent_id) VALUES(?,?)",
+                (cat_path[-1], plan.category_ids[cat_path[:-1]]),
+            ).lastrowid
+        conn.executemany(
+            "INSERT INTO products(category_id, name, price, product_type, min_qty, max_qty, stock) VALUES(?,?,?,?,?,?,?)",
+            ((plan.category_ids[cat_path], *values) for cat_path, values in plan.inserts),
+        )
+        conn.executemany(
+            "UPDATE products SET price=?, product_type=?, min_qty=?, max_qty=?, stock=? WHERE id=?",
+            ((*values[1:], prod_id) for prod_id, values, _ in plan.updates),
+        )
+    catalog_cache.invalidate()
+    return plan
+
+def export_catalog(fmt: str) -> str:
+    """Writes every product to a temporary catalog file and returns its path."""
+    snapshot = catalog_cache.get()
+    paths: dict[int, str] = {}
+
+    def category_path(cat_id: int) -> str:
+        if cat_id not in paths:
+            names = []
+            cat = snapshot.category(cat_id)
+            while cat is not None:
+                names.append(cat['name'])
+                cat = snapshot.category(cat['parent_id']) if cat['parent_id'] is not None else None
+            paths[cat_id] = join_catalog_path(reversed(names))
+        return paths[cat_id]
+
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    with open(fd, "w", newline="", encoding="utf-8-sig" if fmt == "csv" else "utf-8") as f:
+        writer = csv.writer(f) if fmt == "csv" else None
+        if writer:
+            writer.writerow(CATALOG_FIELDS)
+        # Iterate the cursor so rows are written as they are read.
+        for row in db().execute("SELECT * FROM products ORDER BY category_id, id"):
+            values = (category_path(row['category_id']), row['name'], row['price'], row['product_type'],
+                      row['min_qty'], row['max_qty'], row['stock'])
+            if writer:
+                writer.writerow(["" if v is None else v for v in values])
+            else:
+                f.write(json.dumps(dict(zip(CATALOG_FIELDS, values)), ensure_ascii=False) + "\n")
+    return path
+
+SEARCH_MAX_TERMS = 8
+
+def search_products(query: str, limit: int) -> list[sqlite3.Row]:
+    """Returns the products best matching a free-text query, by name and category."""
+    terms = normalize_arabic(query).split()[:SEARCH_MAX_TERMS]
+    if not terms:
+        return []
+    # Quote every term so user input is never parsed as FTS syntax; match prefixes.
+    match = " ".join('"' + term.replace('"', '""') + '"*' for term in terms)
+    return db().execute("""
+        SELECT products.* FROM product_search
+        JOIN products ON products.id = product_search.rowid
+        WHERE product_search MATCH ?
+        ORDER BY bm25(product_search, 2.0, 1.0)
+        LIMIT ?
+    """, (match, limit)).fetchall()
+
+# Broadcast audiences: segment key -> (button label, users WHERE clause). Every
+# clause is served by an index; :since is the buyers' cut-off time.
+BROADCAST_BUYER_DAYS = 30
+BROADCAST_SEGMENTS = {
+    'reachable': ("👥 المستخدمون المتاحون", "reachable = 1"),
+    'buyers': (f"🛒 المشترون خلال {BROADCAST_BUYER_DAYS} يوماً",
+               "reachable = 1 AND user_id IN (SELECT user_id FROM orders WHERE created_at >= :since)"),
+    'funded': ("💰 من لديهم رصيد", "reachable = 1 AND balance_minor > 0"),
+    'all': ("📋 جميع المستخدمين", "1 = 1"),
+}
+
+def create_broadcast(text: str, admin_chat_id: int, status_message_id: int | None, segment: str = 'reachable') -> int:
+    """Queues a broadcast to the users of a segment and returns its ID."""
+    now = int(time.time())
+    since = now - BROADCAST_BUYER_DAYS * 86400
+    where = BROADCAST_SEGMENTS[segment][1]
+    total = db().execute(f"SELECT COUNT(*) AS n FROM users WHERE {where}", {'since': since}).fetchone()['n']
+    return db().execute(
+        "INSERT INTO broadcasts(text, admin_chat_id, status_message_id, status, total, segment, segment_since, created_at) VALUES(?,?,?,?,?,?,?,?)",
+        (text, admin_chat_id, status_message_id, 'running', total, segment, since, now),
+    ).lastrowid
+
+def get_broadcast(broadcast_id: int) -> sqlite3.Row | None:
+    """Retrieves a single broadcast by its ID."""
+    return db().execute("SELECT * FROM broadcasts WHERE id=?", (broadcast_id,)).fetchone()
+
+def get_running_broadcast_ids() -> list[int]:
+    """Returns the IDs of broadcasts that have not finished yet."""
+    return [row['id'] for row in db().execute("SELECT id FROM broadcasts WHERE status='running'")]
+
+def get_segment_user_ids(segment: str, since: int | None, last_user_id: int, limit: int) -> list[int]:
+    """Returns up to `limit` IDs of a segment's users greater than `last_user_id`, in ascending order."""
+    where = BROADCAST_SEGMENTS[segment][1]
+    return [row['user_id'] for row in db().execute(
+        f"SELECT user_id FROM users WHERE user_id > :after AND ({where}) ORDER BY user_id LIMIT :limit",
+        {'after': last_user_id, 'since': since, 'limit': limit})]
+
+def checkpoint_broadcast(broadcast_id: int, last_user_id: int, sent: int, failed: int, done: bool = False,
+                         delivered: list[int] = (), unreachable: list[int] = ()):
+    """Records a broadcast's progress and the delivery outcome of the users just handled."""
+    now = int(time.time())
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE broadcasts SET last_user_id=?, sent=?, failed=?, status=?, finished_at=? WHERE id=?",
+            (last_user_id, sent, failed, 'done' if done else 'running', now if done else None, broadcast_id),
+        )
+        conn.executemany("UPDATE users SET reachable=1, delivery_failed_at=NULL WHERE user_id=? AND reachable=0",
+                         ((uid,) for uid in delivered))
+        conn.executemany("UPDATE users SET reachable=0, delivery_failed_at=? WHERE user_id=?",
+                         ((now, uid) for uid in unreachable))
+
+def mark_seen(user, seen_at: int):
+    """Records that a user talked to the bot, which also proves they are reachable again.
+
+    Runs before any handler, so a first-time user's row is created here.
+    """
+    db().execute(
+        "INSERT INTO users(user_id, username, last_seen) VALUES(?,?,?) "
+        "ON CONFLICT(user_id) DO UPDATE SET last_seen=excluded.last_seen, reachable=1, delivery_failed_at=NULL",
+        (user.id, user.username, seen_at),
+    )
+
+def enqueue_message(chat_id: int, text: str, parse_mode: str | None = None) -> int:
+    """Queues a message in the outbox; call it inside the transaction of the change it reports."""
+    cur = db().execute(
+        "INSERT INTO outbox(chat_id, text, parse_mode, next_attempt_at, created_at) VALUES(?,?,?,?,?)",
+        (chat_id, text, parse_mode, time.time(), int(time.time())),
+    )
+    return cur.lastrowid
+
+def get_due_outbox(now: float, limit: int) -> list[sqlite3.Row]:
+    """Returns due outbox messages, at most one per chat: the oldest it has pending."""
+    return db().execute("""
+        SELECT * FROM outbox o
+        WHERE status='pending' AND next_attempt_at <= ?
+          AND id = (SELECT MIN(id) FROM outbox WHERE chat_id = o.chat_id AND status='pending')
+        ORDER BY next_attempt_at LIMIT ?
+    """, (now, limit)).fetchall()
+
+def record_outbox_results(delivered: list[int], retried: list[tuple[int, float, int, str]],
+                          failed: list[tuple[int, str]], unreachable: list[int]):
+    """Records one dispatch round: removes delivered messages and reschedules or fails the rest.
+
+    `retried` holds (id, next attempt time, attempts used, error) and `failed`
+    holds (id, error). Chats in `unreachable` are flagged like after a broadcast.
+    """
+    now = int(time.time())
+    with transaction() as conn:
+        conn.executemany("DELETE FROM outbox WHERE id=?", ((mid,) for mid in delivered))
+        conn.executemany("UPDATE outbox SET next_attempt_at=?, attempts=attempts+?, last_error=? WHERE id=?",
+                         ((at, used, error, mid) for mid, at, used, error in retried))
+        conn.executemany("UPDATE outbox SET status='failed', attempts=attempts+1, last_error=? WHERE id=?",
+                         ((error, mid) for mid, error in failed))
+        conn.executemany("UPDATE users SET reachable=0, delivery_failed_at=? WHERE user_id=?",
+                         ((now, uid) for uid in unreachable))
+
+def load_conversation_state(kind: str) -> dict[int, dict]:
+    """Returns every persisted entry of a kind ('user' or 'chat') keyed by ID."""
+    return {row['id']: json.loads(row['data']) for row in db().execute(
+        "SELECT id, data FROM conversation_state WHERE kind=?", (kind,))}
+
+def save_conversation_state(entries: dict[tuple[str, int], dict | None]):
+    """Writes a batch of (kind, id) -> data entries in one transaction; empty data deletes the entry."""
+    now = int(time.time())
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO conversation_state(kind, id, data, updated_at) VALUES(?,?,?,?)",
+            ((kind, key, json.dumps(data, ensure_ascii=False, default=str), now)
+             for (kind, key), data in entries.items() if data),
+        )
+        conn.executemany(
+            "DELETE FROM conversation_state WHERE kind=? AND id=?",
+            ((kind, key) for (kind, key), data in entries.items() if not data),
+        )
+
+class PurchaseError(Exception):
+    """Raised when a purchase cannot be completed; reason is 'product', 'stock' or 'balance'."""
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+def purchase(user_id: int, prod_id: int, quantity: int, contact: str) -> tuple[int, float]:
+    """Buys a product in one immediate transaction and returns (order ID, new balance).
+
+    The balance debit and the stock decrement are conditional UPDATEs, so two
+    concurrent buyers can never overdraw a balance or oversell stock. Nothing is
+    written when a PurchaseError is raised.
+    """
+    with transaction(immediate=True) as conn:
+        prow = conn.execute("SELECT price, stock, product_type FROM products WHERE id=?", (prod_id,)).fetchone()
+        if prow is None:
+            raise PurchaseError('product')
+        price = float(prow['price']) * quantity
+
+        # A NULL stock means unlimited quantity; quantity products are not stocked.
+        stocked = prow['product_type'] == 'regular' and prow['stock'] is not None
+        if stocked:
+            cur = conn.execute("UPDATE products SET stock = stock - ? WHERE id=? AND stock >= ?",
+                               (quantity, prod_id, quantity))
+            if cur.rowcount == 0:
+                raise PurchaseError('stock')
+
+        order_id = conn.execute(
+            "INSERT INTO orders(user_id, product_id, price, contact, status, created_at) VALUES(?,?,?,?,?,?)",
+            (user_id, prod_id, price, contact, "pending", int(time.time())),
+        ).lastrowid
+        balance_minor = post_ledger(user_id, -to_minor(price), 'purchase', order_id, require_funds=True)
+        if balance_minor is None:
+            raise PurchaseError('balance')
+    if stocked:
+        catalog_cache.refresh_product(prod_id)
+    return order_id, from_minor(balance_minor)
+
+def create_topup(user_id: int, op_number: str, amount: float) -> int:
+    """Logs a pending top-up request and returns its ID."""
+    cur = db().execute(
+        "INSERT INTO topups(user_id, op_number, amount, status, created_at) VALUES(?,?,?,?,?)",
+        (user_id, op_number, amount, "pending", int(time.time())),
+    )
+    return cur.lastrowid
+
+def settled_notice(kind: str, row: sqlite3.Row, approve: bool, new_bal: float | None) -> str:
+    """The message telling a user that their top-up or order was settled."""
+    if kind == 'topup':
+        if approve:
+            return f"✅ تم شحن حسابك بمبلغ {money(row['amount'])}. رصيدك الحالي: {money(new_bal)}"
+        return "❌ تم رفض طلب الشحن."
+    return "✅ تم تنفيذ طلبك." if approve else "❌ تم رفض طلبك وتم إرجاع الرصيد."
+
+def settle_topup(topup_id: int, approve: bool) -> tuple[sqlite3.Row | None, float | None]:
+    """Approves (crediting the user) or rejects a pending top-up in one transaction.
+
+    Returns the top-up row as it was before settling and the user's new balance
+    when it was credited. A row whose status is not 'pending' is returned untouched.
+    The user's notification is queued in the outbox in the same transaction.
+    """
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT * FROM topups WHERE id=?", (topup_id,)).fetchone()
+        if row is None or row['status'] != 'pending':
+            return row, None
+        conn.execute("UPDATE topups SET status=? WHERE id=?", ('approved' if approve else 'rejected', topup_id))
+        new_bal = change_balance(row['user_id'], float(row['amount']), 'topup', topup_id) if approve else None
+        enqueue_message(row['user_id'], settled_notice('topup', row, approve, new_bal))
+    return row, new_bal
+
+def settle_order(order_id: int, approve: bool) -> sqlite3.Row | None:
+    """Approves or rejects (refunding the user) a pending order in one transaction.
+
+    Returns the order row as it was before settling; a row whose status is not
+    'pending' is returned untouched. The user's notification is queued in the
+    outbox in the same transaction.
+    """
+    with transaction(immediate=True) as conn:
+        row = conn.execute("SELECT * FROM orders WHERE id=?", (order_id,)).fetchone()
+        if row is None or row['status'] != 'pending':
+            return row
+        conn.execute("UPDATE orders SET status=? WHERE id=?", ('approved' if approve else 'rejected', order_id))
+        if not approve:
+            change_balance(row['user_id'], float(row['price']), 'refund', order_id)
+        enqueue_message(row['user_id'], settled_notice('order', row, approve, None))
     return row
 
-def decrement_product_stock(prod_id: int, quantity: int = 1) -> bool:
-    """Decrements the stock of a product by a given quantity."""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT stock FROM products WHERE id=?", (prod_id,))
-    stock_row = cur.fetchone()
-    if stock_row is None:
-        conn.close()
-        return False
-    stock = stock_row[0]
-    if stock >= quantity:
-        cur.execute("UPDATE products SET stock = stock - ? WHERE id=?", (quantity, prod_id,))
-        conn.commit()
-        conn.close()
-        return True
-    conn.close()
-    return False
+# Pending queue queries: kind -> SELECT returning one page of pending rows after an id.
+PENDING_QUERIES = {
+    'topup': "SELECT * FROM topups WHERE status='pending' AND id > ? ORDER BY id LIMIT ?",
+    'order': """SELECT orders.*, products.name AS product_name FROM orders
+                LEFT JOIN products ON products.id = orders.product_id
+                WHERE orders.status='pending' AND orders.id > ? ORDER BY orders.id LIMIT ?""",
+}
+
+def get_pending(kind: str, after_id: int, limit: int) -> list[sqlite3.Row]:
+    """Returns up to `limit` pending top-ups or orders with an id above `after_id`."""
+    return db().execute(PENDING_QUERIES[kind], (after_id, limit)).fetchall()
+
+def count_pending() -> dict[str, int]:
+    """Returns the number of pending top-ups and orders."""
+    conn = db()
+    return {
+        'topup': conn.execute("SELECT COUNT(*) FROM topups WHERE status='pending'").fetchone()[0],
+        'order': conn.execute("SELECT COUNT(*) FROM orders WHERE status='pending'").fetchone()[0],
+    }
+
+def get_queue_sizes() -> dict:
+    """Returns the pending requests, outbox messages by status and running broadcasts."""
+    conn = db()
+    return {
+        'pending': count_pending(),
+        'outbox': dict(conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()),
+        'broadcasts': conn.execute("SELECT id, total, sent, failed FROM broadcasts WHERE status='running'").fetchall(),
+    }
+
+def settle_many(kind: str, ids: list[int], approve: bool) -> list[tuple[sqlite3.Row, float | None]]:
+    """Settles several pending top-ups or orders in one transaction.
+
+    Returns (row, new balance) for each item that was still pending; the new
+    balance is only set for credited top-ups. The users' notifications are
+    queued in the outbox by the same transaction.
+    """
+    settled = []
+    with transaction(immediate=True):
+        for item_id in ids:
+            if kind == 'topup':
+                row, new_bal = settle_topup(item_id, approve)
+            else:
+                row, new_bal = settle_order(item_id, approve), None
+            if row is not None and row['status'] == 'pending':
+                settled.append((row, new_bal))
+    return settled
+
+# -----------------------------------------------------------------------------
+# SQL Tracing
+# Opt-in with SQL_TRACE=1. Every connection then reports its statements through
+# sqlite's trace callback and counts virtual machine steps with a progress
+# handler. Statements run by database helpers through run_db() are timed until
+# the next one starts or the helper returns, and aggregated under their
+# normalized text (literals replaced by ?) together with the handlers that ran
+# them; /sqltop lists the most expensive. Statements slower than SQL_SLOW_MS go to a rotating slow-query log.
+# -----------------------------------------------------------------------------
+
+SQL_TRACE = os.environ.get("SQL_TRACE") == "1"
+SQL_SLOW_MS = float(os.environ.get("SQL_SLOW_MS", "100"))
+SQL_SLOW_LOG = os.environ.get("SQL_SLOW_LOG", "sql_slow.log")
+SQL_SLOW_LOG_BYTES = 1024 * 1024   # size at which the slow-query log rotates
+SQL_SLOW_LOG_BACKUPS = 3
+SQL_PROGRESS_STEPS = 1000          # virtual machine steps between progress callbacks
+SQL_TOP_DEFAULT = 10
+SQL_TOP_MAX = 20
+SQL_TOP_TEXT_LIMIT = 160           # characters of each statement shown by /sqltop
+SQL_MAX_CALLERS = 5                # callers remembered per statement
+
+SQL_LITERAL = re.compile(r"'(?:[^']|'')*'|\bx'[0-9a-f]*'|(?<![\w.])-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+SQL_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+def normalize_sql(sql: str) -> str:
+    """Replaces a statement's literals with ? so that its executions share one entry."""
+    sql = SQL_LITERAL.sub("?", sql)
+    sql = SQL_LIST.sub("(?, ...)", sql)
+    return " ".join(sql.split())
+
+class SQLTracer:
+    """Aggregates statement timings reported by sqlite's trace and progress callbacks."""
+
+    def __init__(self):
+        # normalized statement -> [calls, total seconds, slowest, VM steps, callers]
+        self.stats: dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.slow_log = logging.getLogger(f"{__name__}.slow_sql")
+        self.slow_log.propagate = False
+        handler = logging.handlers.RotatingFileHandler(SQL_SLOW_LOG, maxBytes=SQL_SLOW_LOG_BYTES,
+                                                       backupCount=SQL_SLOW_LOG_BACKUPS, encoding="utf-8")
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        self.slow_log.addHandler(handler)
+
+    def install(self, conn: sqlite3.Connection):
+        """Reports a connection's statements to the tracer."""
+        conn.set_trace_callback(self._on_statement)
+        conn.set_progress_handler(self._on_progress, SQL_PROGRESS_STEPS)
+
+    def _on_statement(self, sql: str):
+        """Trace callback: a statement starts, so the previous one on this thread is done.
+
+        Trigger and virtual-table sub-statements are reported while the statement
+        that fired them is still running, either as "-- ..." text or (depending on
+        the Python version) as that statement's own text again; both are counted
+        as part of it. An immediate rerun with identical text is therefore merged
+        into one call.
+        """
+        if sql.lstrip().startswith("--"):
+            return
+        current = getattr(self._local, "current", None)
+        if current is not None and current[0] == sql:
+            return
+        self.finish()
+        if getattr(self._local, "caller", None) is not None:
+            self._local.current = [sql, time.perf_counter(), 0]
+
+    def _on_progress(self) -> int:
+        """Progress callback: counts the running statement's steps; 0 lets it continue."""
+        current = getattr(self._local, "current", None)
+        if current is not None:
+            current[2] += SQL_PROGRESS_STEPS
+        return 0
+
+    def finish(self):
+        """Records the statement in progress on this thread, if any."""
+        current = getattr(self._local, "current", None)
+        if current is None:
+            return
+        self._local.current = None
+        sql, started, steps = current
+        elapsed = time.perf_counter() - started
+        caller = self._local.caller
+        key = normalize_sql(sql)
+        with self._lock:
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0.0, 0.0, 0, set()]
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+            entry[3] += steps
+            if len(entry[4]) < SQL_MAX_CALLERS:
+                entry[4].add(caller)
+        if elapsed * 1000 >= SQL_SLOW_MS:
+            self.slow_log.warning("%.1f ms, %d steps, %s: %s", elapsed * 1000, steps, caller, key)
+
+    @contextmanager
+    def scope(self, caller: str):
+        """Attributes the statements run inside the block to `caller`."""
+        self._local.caller = caller
+        try:
+            yield
+        finally:
+            self.finish()
+            self._local.caller = None
+
+    def top(self, limit: int) -> list[tuple[str, int, float, float, int, list[str]]]:
+        """The `limit` statements with the most total time, as (sql, calls, total, slowest, steps, callers)."""
+        with self._lock:
+            rows = [(sql, calls, total, slowest, steps, sorted(callers))
+                    for sql, (calls, total, slowest, steps, callers) in self.stats.items()]
+        return sorted(rows, key=lambda row: -row[2])[:limit]
+
+sql_tracer = SQLTracer() if SQL_TRACE else None
+
+# -----------------------------------------------------------------------------
+# Asynchronous Database Access
+# sqlite3 calls block, so handlers never run them on the event loop. They go
+# through run_db(), which executes them one at a time on a dedicated DB thread.
+# -----------------------------------------------------------------------------
+
+DB_QUEUE_SIZE = 256     # calls allowed to wait for the DB thread at once
+DB_CALL_TIMEOUT = 15.0  # seconds a call may wait to start before it is abandoned
+
+class DatabaseBusyError(Exception):
+    """Raised when a database call could not be started in time; it then never runs."""
+
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+_db_slots = asyncio.Semaphore(DB_QUEUE_SIZE)
+
+def _measured_db_call(fn, args: tuple, handler: str):
+    """Runs a database helper on the DB thread, recording how long it took."""
+    with DB_METRICS.measure(fn.__name__):
+        if sql_tracer is None:
+            return fn(*args)
+        with sql_tracer.scope(f"{handler}/{fn.__name__}"):
+            return fn(*args)
+
+async def run_db(fn, *args, timeout: float = DB_CALL_TIMEOUT):
+    """Runs a blocking database helper on the DB thread and awaits its result.
+
+    At most DB_QUEUE_SIZE calls may be pending; further callers wait for a free
+    slot. `timeout` bounds only the wait until the call starts: a call that has
+    not started by then is withdrawn and DatabaseBusyError is raised, while a
+    call that has started is always awaited, so a committed write is never
+    reported to the caller as a failure.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        await asyncio.wait_for(_db_slots.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise DatabaseBusyError(f"database queue full, {fn.__name__} not started") from None
+    call = _db_executor.submit(_measured_db_call, fn, args, current_handler.get())
+    fut = asyncio.wrap_future(call)
+    fut.add_done_callback(lambda _: _db_slots.release())
+    try:
+        return await asyncio.wait_for(asyncio.shield(fut), max(deadline - loop.time(), 0))
+    except asyncio.TimeoutError:
+        if call.cancel():
+            raise DatabaseBusyError(f"{fn.__name__} not started within {timeout}s") from None
+    return await fut
+
+# -----------------------------------------------------------------------------
+# Catalog Cache
+# The category/product tree changes only when an admin edits it, so it is read
+# once into memory and browsing is served from there. Every catalog write helper
+# invalidates the cache; the next reader reloads it.
+# -----------------------------------------------------------------------------
+
+class CatalogSnapshot:
+    """An in-memory copy of the category/product tree, indexed by id and by parent."""
+
+    def __init__(self, version: int, categories: list[sqlite3.Row], products: list[sqlite3.Row]):
+        self.version = version
+        self._categories = {row['id']: row for row in categories}
+        self._products = {row['id']: row for row in products}
+        children: dict[int | None, list[sqlite3.Row]] = {}
+        for row in categories:
+            children.setdefault(row['parent_id'], []).append(row)
+        self._children = {parent: tuple(rows) for parent, rows in children.items()}
+        self._sub_categories = tuple(row for row in categories if row['parent_id'] is not None)
+        by_cat: dict[int, list[sqlite3.Row]] = {}
+        for row in products:
+            by_cat.setdefault(row['category_id'], []).append(row)
+        self._by_cat = {cat_id: tuple(rows) for cat_id, rows in by_cat.items()}
+        # Rendered listing keyboards, keyed by (view, category id, page start). See catalog_kb().
+        self.keyboards: dict[tuple[str, int | None, int], InlineKeyboardMarkup] = {}
+
+    def category(self, cat_id: int) -> sqlite3.Row | None:
+        return self._categories.get(cat_id)
+
+    def categories_under(self, parent_id: int | None) -> tuple[sqlite3.Row, ...]:
+        return self._children.get(parent_id, ())
+
+    def sub_categories(self) -> tuple[sqlite3.Row, ...]:
+        return self._sub_categories
+
+    def product(self, prod_id: int) -> sqlite3.Row | None:
+        return self._products.get(prod_id)
+
+    def products_in(self, cat_id: int) -> tuple[sqlite3.Row, ...]:
+        return self._by_cat.get(cat_id, ())
+
+    def _replace_product(self, row: sqlite3.Row):
+        """Swaps in a fresher copy of a product whose category did not change."""
+        self._products[row['id']] = row
+        siblings = self._by_cat.get(row['category_id'], ())
+        self._by_cat[row['category_id']] = tuple(row if p['id'] == row['id'] else p for p in siblings)
+
+class CatalogCache:
+    """Process-wide holder of the current CatalogSnapshot.
+
+    Readers never take the lock on a hit. On a miss the first caller loads the
+    tree while concurrent callers wait on the lock and then reuse its result, so
+    simultaneous misses cost a single load.
+    """
+
+    def __init__(self):
+        self._snapshot: CatalogSnapshot | None = None
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def peek(self) -> CatalogSnapshot | None:
+        """Returns the cached snapshot without loading it."""
+        return self._snapshot
+
+    def get(self) -> CatalogSnapshot:
+        """Returns the cached snapshot, loading it from the database on a miss."""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None:
+                conn = db()
+                categories = conn.execute("SELECT * FROM categories ORDER BY id ASC").fetchall()
+                products = conn.execute("SELECT * FROM products ORDER BY id ASC").fetchall()
+                self._snapshot = CatalogSnapshot(self.version, categories, products)
+            return self._snapshot
+
+    def invalidate(self):
+        """Drops the snapshot after a catalog write."""
+        with self._lock:
+            self.version += 1
+            self._snapshot = None
+
+    def refresh_product(self, prod_id: int):
+        """Re-reads one product in place (e.g. after a stock change) without a full reload."""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                return
+            row = db().execute("SELECT * FROM products WHERE id=?", (prod_id,)).fetchone()
+            current = snapshot.product(prod_id)
+            if row is None or current is None or row['category_id'] != current['category_id']:
+                self.version += 1
+                self._snapshot = None
+            else:
+                snapshot._replace_product(row)
+
+catalog_cache = CatalogCache()
+
+async def catalog() -> CatalogSnapshot:
+    """Returns the catalog snapshot, loading it on the DB thread if it is not cached."""
+    snapshot = catalog_cache.peek()
+    if snapshot is None:
+        snapshot = await run_db(catalog_cache.get)
+    return snapshot
 
 # -----------------------------------------------------------------------------
 # Inline Keyboard Markup Definitions
@@ -347,7 +1558,7 @@ def decrement_product_stock(prod_id: int, quantity: int = 1) -> bool:
 MAIN_MENU = InlineKeyboardMarkup([
     [InlineKeyboardButton("🛍️ شراء منتج", callback_data="BUY"), InlineKeyboardButton("💳 شحن شام كاش", callback_data="TOPUP_MENU")],
     [InlineKeyboardButton("🆘 التواصل مع الدعم", callback_data="SUPPORT_CONTACT"), InlineKeyboardButton("👤 معلومات الحساب", callback_data="ACCOUNT")],
-    [InlineKeyboardButton("🗞️ الأخبار", callback_data="NEWS")],
+    [InlineKeyboardButton("🗞️ الأخبار", callback_data="NEWS"), InlineKeyboardButton("🔍 بحث عن منتج", switch_inline_query_current_chat="")],
 ])
 
 def admin_menu_kb() -> InlineKeyboardMarkup:
@@ -356,8 +1567,16 @@ def admin_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("📂 إدارة القوائم", callback_data="ADM_CATS"), InlineKeyboardButton("📦 إدارة المنتجات", callback_data="ADM_PRODS")],
         [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data="ADM_USERS"), InlineKeyboardButton("⚙️ الإعدادات", callback_data="ADM_SETTINGS")],
         [InlineKeyboardButton("📢 بث رسالة", callback_data="ADM_BROADCAST") , InlineKeyboardButton("📝 تعديل الأخبار", callback_data="EDIT_NEWS")],
+        [InlineKeyboardButton("⏳ الطلبات المعلقة", callback_data="ADM_PENDING")],
     ])
 
+def broadcast_segments_kb() -> InlineKeyboardMarkup:
+    """Keyboard for choosing a broadcast's audience."""
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(label, callback_data=encode_callback("ADM_BCAST_SEG", key))]
+         for key, (label, _) in BROADCAST_SEGMENTS.items()]
+    )
+
 def cats_menu_kb() -> InlineKeyboardMarkup:
     """Admin categories menu keyboard."""
     return InlineKeyboardMarkup([
@@ -392,6 +1611,8 @@ def prods_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("💲 تعديل سعر منتج", callback_data="PROD_EDIT_PRICE_LIST")],
         [InlineKeyboardButton("🔄 نقل منتج لقائمة أخرى", callback_data="PROD_MOVE_LIST")],
         [InlineKeyboardButton("🗑 حذف منتج", callback_data="PROD_DEL_LIST")],
+        [InlineKeyboardButton("📥 استيراد منتجات", callback_data="PROD_IMPORT"),
+         InlineKeyboardButton("📤 تصدير المنتجات", callback_data="PROD_EXPORT")],
         [InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")],
     ])
 
@@ -412,6 +1633,97 @@ def settings_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")],
     ])
 
+# Catalog listing keyboards: view -> (source, button action, label prefix, back action).
+# "root" lists the main categories, "children" the sub-categories of the given
+# category, "subs" every sub-category, and "products"/"priced" the products of the
+# given category (the latter with their price, as shown to buyers).
+CATALOG_VIEWS = {
+    "buy_root": ("root", "BUY_CAT", " ", "BACK_TO_MAIN"),
+    "buy_sub": ("children", "BUY_CAT", " ", "BUY_BACK"),
+    "buy_prods": ("priced", "BUY_PROD", " ", "BUY_BACK"),
+    "cat_edit_main": ("root", "CAT_EDIT", "✏️ ", "ADM_BACK_CATS"),
+    "cat_del_main": ("root", "CAT_DEL", "🗑️ ", "ADM_BACK_CATS"),
+    "cat_add_sub": ("root", "CAT_LIST_ADD_SUB", "", "ADM_BACK_CATS"),
+    "cat_edit_sub": ("subs", "CAT_EDIT", "", "ADM_BACK_CATS"),
+    "cat_del_sub": ("subs", "CAT_DEL", "", "ADM_BACK_CATS"),
+    "cat_move_sub": ("subs", "CAT_MOVE", "", "ADM_BACK_CATS"),
+    "cat_move_target": ("root", "TARGET_CAT", "", "ADM_BACK_CATS"),
+    "prod_add_regular": ("root", "PROD_ADD_REGULAR_CAT", "", "PROD_ADD"),
+    "prod_add_regular_sub": ("children", "PROD_ADD_REGULAR_CAT", "", "ADD_PROD_REGULAR"),
+    "prod_add_quantity": ("root", "PROD_ADD_QUANTITY_CAT", "", "PROD_ADD"),
+    "prod_add_quantity_sub": ("children", "PROD_ADD_QUANTITY_CAT", "", "ADD_PROD_QUANTITY"),
+    "prod_rename_root": ("root", "EDIT_PROD_NAME_CAT", "", "ADM_PRODS"),
+    "prod_rename_sub": ("children", "EDIT_PROD_NAME_CAT", "", "PROD_EDIT_NAME_LIST"),
+    "prod_rename": ("products", "PROD_EDIT_NAME", "", "PROD_EDIT_NAME_LIST"),
+    "prod_reprice_root": ("root", "EDIT_PROD_PRICE_CAT", "", "ADM_PRODS"),
+    "prod_reprice_sub": ("children", "EDIT_PROD_PRICE_CAT", "", "PROD_EDIT_PRICE_LIST"),
+    "prod_reprice": ("products", "PROD_REPRICE", "", "PROD_EDIT_PRICE_LIST"),
+    "prod_del_root": ("root", "DEL_PROD_CAT", "", "ADM_PRODS"),
+    "prod_del_sub": ("children", "DEL_PROD_CAT", "", "PROD_DEL_LIST"),
+    "prod_del": ("products", "PROD_DEL", "", "PROD_DEL_LIST"),
+    "prod_move_root": ("root", "MOVE_PROD_CAT", "", "ADM_PRODS"),
+    "prod_move_sub": ("children", "MOVE_PROD_CAT", "", "PROD_MOVE_LIST"),
+    "prod_move": ("products", "PROD_MOVE", "", "PROD_MOVE_LIST"),
+    "prod_move_target": ("root", "PROD_MOVE_TARGET", "", "ADM_PRODS"),
+}
+
+# Listings are paged so that large categories stay within Telegram's markup
+# limits. Pages are keyed by the id of their first item rather than an offset,
+# so a page stays put when items are added or removed before it.
+CATALOG_PAGE_SIZE = 20
+PUBLIC_CATALOG_VIEWS = {"buy_root", "buy_sub", "buy_prods"}
+
+def catalog_kb(snapshot: CatalogSnapshot, view: str, cat_id: int | None = None, start_id: int = 0) -> InlineKeyboardMarkup:
+    """Returns the two-buttons-per-row listing keyboard for one page of a catalog view.
+
+    The page holds up to CATALOG_PAGE_SIZE items starting at the first item whose
+    id is at least `start_id`. Finished keyboards are memoized on the snapshot
+    they were built from, keyed by the page's actual first item so that any
+    `start_id` landing on the same page shares one entry; they are only rebuilt
+    after the catalog changes and a new snapshot is loaded.
+    """
+    source, action, prefix, back = CATALOG_VIEWS[view]
+    if source == "root":
+        items = snapshot.categories_under(None)
+    elif source == "subs":
+        items = snapshot.sub_categories()
+    elif source == "children":
+        items = snapshot.categories_under(cat_id)
+    else:
+        items = snapshot.products_in(cat_id)
+
+    # Items are kept in id order, so the page start is a binary search.
+    start = bisect_left(items, start_id, key=lambda item: item['id'])
+    key = (view, cat_id, items[start]['id'] if start < len(items) else None)
+    kb = snapshot.keyboards.get(key)
+    if kb is not None:
+        return kb
+    page = items[start:start + CATALOG_PAGE_SIZE]
+
+    buttons = []
+    for item in page:
+        label = f"{prefix}{item['name']}"
+        if source == "priced":
+            label += f" /-/ {money(item['price'])}"
+            if item['product_type'] != 'regular':
+                label += " للواحدة"
+        buttons.append(InlineKeyboardButton(label, callback_data=encode_callback(action, item['id'])))
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
+    page_action = "BUY_PAGE" if view in PUBLIC_CATALOG_VIEWS else "ADM_PAGE"
+    nav = []
+    if start > 0:
+        prev_id = items[max(0, start - CATALOG_PAGE_SIZE)]['id']
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=encode_callback(page_action, view, cat_id or 0, prev_id)))
+    if start + CATALOG_PAGE_SIZE < len(items):
+        next_id = items[start + CATALOG_PAGE_SIZE]['id']
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=encode_callback(page_action, view, cat_id or 0, next_id)))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data=back)])
+    kb = snapshot.keyboards[key] = InlineKeyboardMarkup(rows)
+    return kb
+
 # -----------------------------------------------------------------------------
 # Text Helper Functions
 # -----------------------------------------------------------------------------
@@ -427,9 +1739,12 @@ def start_text(u_row: sqlite3.Row) -> str:
 # -----------------------------------------------------------------------------
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles the /start command."""
-    ensure_user(update.effective_user)
-    u = get_user(update.effective_user.id)
+    """Handles the /start command, including product deep links from search results."""
+    await run_db(ensure_user, update.effective_user)
+    if context.args and context.args[0].startswith(SEARCH_DEEP_LINK_PREFIX):
+        await start_deep_link_purchase(update, context, context.args[0][len(SEARCH_DEEP_LINK_PREFIX):])
+        return
+    u = await run_db(get_user, update.effective_user.id)
     welcome_message = (
         f"🖐🏻أهلًا بك في متجرنا🖐🏻\n"+"\n✍🏻الصانع : علي حاج مرعي✍🏻\n" + "\n👇🏻اختر من القائمة بالأسفل👇🏻"
     )
@@ -448,10 +1763,86 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("أهلاً بك أيها المدير! اختر من القائمة:", reply_markup=admin_menu_kb())
 
+async def cmd_ledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /ledger <user_id>, listing a user's latest balance movements (admins only)."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("غير مصرح لك بالوصول إلى لوحة التحكم هذه.")
+        return
+    try:
+        user_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("الاستخدام: /ledger <آيدي المستخدم>")
+        return
+    rows = await run_db(get_ledger, user_id)
+    if not rows:
+        await update.message.reply_text("لا توجد حركات على رصيد هذا المستخدم.")
+        return
+    lines = [f"📒 آخر حركات رصيد <code>{user_id}</code>:"]
+    for row in rows:
+        when = datetime.utcfromtimestamp(row['created_at']).strftime('%Y-%m-%d %H:%M')
+        ref = f" #{row['ref_id']}" if row['ref_id'] else ""
+        lines.append(f"• {when} {row['kind']}{ref}: {from_minor(row['amount_minor']):+g} ← {from_minor(row['balance_after_minor']):g}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+REPRICE_USAGE = ("الاستخدام: /reprice <آيدي القسم أو all> <التغيير> [التقريب]\n"
+                 "التغيير نسبة مثل +10% أو -5%، أو مبلغ مثل +500 أو -250.\n"
+                 "التقريب اختياري، مثلاً 100 لتقريب الأسعار لأقرب 100 (الافتراضي بدون تقريب).\n"
+                 "مثال: /reprice all +12% 500")
+REPRICE_NOT_POSITIVE = "⛔ هذا التعديل يجعل سعر منتج واحد على الأقل صفراً أو أقل. اختر تغييراً أصغر."
+REPRICE_CHANGE = re.compile(r"^([+-]?\d+(?:\.\d+)?)(%?)$")
+
+async def reply_reprice_usage(update: Update, snapshot: CatalogSnapshot):
+    """Explains /reprice and lists the main categories to choose from."""
+    roots = "\n".join(f"• {c['id']}: {c['name']}" for c in snapshot.categories_under(None))
+    await update.message.reply_text(f"{REPRICE_USAGE}\n\nالأقسام الرئيسية:\n{roots}")
+
+async def cmd_reprice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /reprice <category|all> <change> [step], previewing a bulk price change (admins only)."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("غير مصرح لك بالوصول إلى لوحة التحكم هذه.")
+        return
+    snapshot = await catalog()
+    try:
+        scope, change = context.args[0], REPRICE_CHANGE.match(context.args[1])
+        cat_id = None if scope.lower() == "all" else int(scope)
+        step = float(context.args[2]) if len(context.args) > 2 else None
+        if change is None or (cat_id is not None and snapshot.category(cat_id) is None):
+            raise ValueError(scope)
+        amount, is_percent = float(change.group(1)), bool(change.group(2))
+        factor, delta = (1 + amount / 100, 0.0) if is_percent else (1.0, amount)
+        if not (math.isfinite(factor) and math.isfinite(delta)) or (
+                step is not None and not (math.isfinite(step) and step > 0)):
+            raise ValueError(scope)
+    except (IndexError, ValueError):
+        await reply_reprice_usage(update, snapshot)
+        return
+
+    totals, samples = await run_db(preview_reprice, cat_id, factor, delta, step)
+    if not totals['products']:
+        await update.message.reply_text("لا توجد منتجات في هذا القسم.")
+        return
+    if not math.isfinite(totals['after']) or totals['highest'] > MAX_AMOUNT:
+        await reply_reprice_usage(update, snapshot)
+        return
+    if totals['lowest'] <= 0:
+        await update.message.reply_text(REPRICE_NOT_POSITIVE)
+        return
+
+    scope_name = "كل المنتجات" if cat_id is None else snapshot.category(cat_id)['name']
+    lines = [f"💱 معاينة تعديل الأسعار ({scope_name}):",
+             f"• عدد المنتجات: {totals['products']}",
+             f"• مجموع الأسعار قبل: {money(totals['before'])}",
+             f"• مجموع الأسعار بعد: {money(totals['after'])}"]
+    lines += [f"• {row['name']}: {money(row['before'])} ← {money(row['after'])}" for row in samples]
+    context.user_data["reprice"] = [cat_id, factor, delta, step]
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ تطبيق", callback_data="REPRICE_APPLY"),
+                                InlineKeyboardButton("❌ إلغاء", callback_data="REPRICE_CANCEL")]])
+    await update.message.reply_text("\n".join(lines), reply_markup=kb)
+
 async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE, as_new: bool = True):
     """Displays the user's account information."""
-    ensure_user(update.effective_user)
-    u = get_user(update.effective_user.id)
+    await run_db(ensure_user, update.effective_user)
+    u = await run_db(get_user, update.effective_user.id)
     if as_new:
         await update.effective_chat.send_message(account_text(u), parse_mode=ParseMode.HTML)
     else:
@@ -459,1470 +1850,2723 @@ async def show_account(update: Update, context: ContextTypes.DEFAULT_TYPE, as_ne
         await q.message.edit_text(account_text(u), parse_mode=ParseMode.HTML, reply_markup=MAIN_MENU)
 
 # -----------------------------------------------------------------------------
-# Callback Query Handlers (General User Flow)
-# These functions handle button clicks from the main user menu.
+# Product Search
+# Products are found through an FTS5 index of normalized product and category
+# names (see _migration_product_search), either with /search in the chat or
+# through inline mode. Inline results link back to the bot with a /start
+# payload that opens the purchase of the chosen product.
 # -----------------------------------------------------------------------------
 
-async def on_main_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles main menu button callbacks."""
-    q = update.callback_query
-    await q.answer()
-    data = q.data
-
-    if data == "ACCOUNT":
-        user_id = q.from_user.id
-        user_data = get_user(user_id)
-
-        if user_data:
-            username = user_data['username'] if user_data['username'] else "لا يوجد"
-            balance = user_data['balance']
+SEARCH_RESULTS_LIMIT = 10
+INLINE_RESULTS_LIMIT = 20
+INLINE_CACHE_TIME = 30  # seconds Telegram may reuse the results of a query
+SEARCH_DEEP_LINK_PREFIX = "BUY_PROD-"
+
+def search_results_kb(rows: list[sqlite3.Row]) -> InlineKeyboardMarkup:
+    """One buy button per search result, with the same labels as the category listings."""
+    rows_kb = []
+    for row in rows:
+        label = f"{row['name']} /-/ {money(row['price'])}"
+        if row['product_type'] != 'regular':
+            label += " للواحدة"
+        rows_kb.append([InlineKeyboardButton(label, callback_data=encode_callback("BUY_PROD", row['id']))])
+    rows_kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")])
+    return InlineKeyboardMarkup(rows_kb)
+
+async def reply_search_results(update: Update, query: str):
+    """Searches the catalog and replies with the matching products."""
+    rows = await run_db(search_products, query, SEARCH_RESULTS_LIMIT)
+    if not rows:
+        await update.message.reply_text("🔍 لا توجد منتجات مطابقة لبحثك.")
+        return
+    await update.message.reply_text("🔍 نتائج البحث:", reply_markup=search_results_kb(rows))
 
-            # تم تعديل النص بالكامل ليناسب تنسيق HTML بشكل صحيح
-            message_text = (
-                f"👤 <b>معلومات حسابك:</b>\n"
-                f"• الآيدي: {user_id}\n"
-                f"• اليوزر: @{username}\n"
-                f"• الرصيد: {balance} ل.س"
-            )
+async def cmd_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /search <text>; without text it asks for the search terms."""
+    if context.args:
+        await reply_search_results(update, " ".join(context.args))
+        return
+    context.user_data.clear()
+    context.user_data["flow"] = "search"
+    await update.message.reply_text("🔍 أرسل اسم المنتج أو القسم الذي تبحث عنه:")
+
+async def on_inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answers inline queries with matching products that link back to the bot."""
+    inline_query = update.inline_query
+    rows = await run_db(search_products, inline_query.query, INLINE_RESULTS_LIMIT) if inline_query.query.strip() else []
+    results = []
+    for row in rows:
+        link = f"https://t.me/{context.bot.username}?start={SEARCH_DEEP_LINK_PREFIX}{row['id']}"
+        price = money(row['price']) + (" للواحدة" if row['product_type'] != 'regular' else "")
+        results.append(InlineQueryResultArticle(
+            id=str(row['id']),
+            title=row['name'],
+            description=price,
+            input_message_content=InputTextMessageContent(f"🛍️ {row['name']}\n💰 {price}"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 شراء", url=link)]]),
+        ))
+    await inline_query.answer(results, cache_time=INLINE_CACHE_TIME)
+
+async def start_deep_link_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, payload: str):
+    """Opens the purchase of the product named by a /start deep link."""
+    prow = (await catalog()).product(int(payload)) if payload.isdigit() else None
+    if not prow:
+        await update.message.reply_text(PRODUCT_NOT_FOUND_MESSAGE, reply_markup=MAIN_MENU)
+        return
+    if is_out_of_stock(prow):
+        await update.message.reply_text(OUT_OF_STOCK_MESSAGE, reply_markup=MAIN_MENU)
+        return
+    await start_purchase(update, context, prow)
 
-            # تأكد أن parse_mode هو HTML
-            await context.bot.send_message(
-                chat_id=q.message.chat_id,
-                text=message_text,
-                parse_mode="HTML"
-            )
-        else:
-            await context.bot.send_message(
-                chat_id=q.message.chat_id,
-                text="لم يتم العثور على معلومات حسابك. يرجى التواصل مع الدعم."
-            )
+# -----------------------------------------------------------------------------
+# Callback Router
+# Every button routes through a single CallbackQueryHandler. Handlers register
+# under their action name with the types of their arguments, and on_callback
+# finds the route with one dictionary lookup on the action, converts the
+# arguments and checks admin access before calling it.
+# Buttons built by encode_callback() carry an explicit format version:
+# "1|ACTION.arg.arg", with integers in base 36 to stay well inside Telegram's
+# 64-byte callback_data limit. decode_callback() dispatches on the version, so a
+# later format gets its own decoder next to this one. Payloads without a version
+# are the legacy "ACTION" and "ACTION:arg" forms with decimal integers, still
+# accepted so that buttons on older messages keep working.
+# -----------------------------------------------------------------------------
 
+CALLBACK_MAX_BYTES = 64  # Telegram's limit for callback_data
+CALLBACK_VERSION = "1"
+CALLBACK_VERSION_SEPARATOR = "|"
+CALLBACK_SEPARATOR = "."
+LEGACY_CALLBACK_SEPARATOR = ":"
+GROUP_ACTION_DENIED = "هذا الإجراء للأدمن فقط."
+ADMIN_PANEL_DENIED = "لوحة الأدمن: الوصول مرفوض."
+BASE36_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class CallbackRoute:
+    """A registered callback action and how to call its handler."""
+    __slots__ = ("handler", "arg_types", "admin", "answer")
+
+    def __init__(self, handler, arg_types: tuple, admin: str | None, answer: bool):
+        self.handler = handler
+        self.arg_types = arg_types
+        self.admin = admin
+        self.answer = answer
+
+CALLBACK_ROUTES: dict[str, CallbackRoute] = {}
+
+def callback(action: str, *arg_types, admin: str | None = None, answer: bool = True):
+    """Registers a callback handler for an action; `admin` is the denial message for admin-only routes."""
+    def register(handler):
+        if action in CALLBACK_ROUTES:
+            raise ValueError(f"Callback action {action} is already registered")
+        CALLBACK_ROUTES[action] = CallbackRoute(handler, arg_types, admin, answer)
+        return handler
+    return register
+
+def to_base36(n: int) -> str:
+    """Formats an integer in base 36."""
+    if n < 0:
+        return "-" + to_base36(-n)
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = BASE36_DIGITS[r] + digits
+        if not n:
+            return digits
+
+def encode_callback(action: str, *args) -> str:
+    """Builds a compact, versioned callback_data payload for an action and its arguments."""
+    parts = [action]
+    for arg in args:
+        part = to_base36(arg) if isinstance(arg, int) else str(arg)
+        if any(sep in part for sep in (CALLBACK_SEPARATOR, LEGACY_CALLBACK_SEPARATOR, CALLBACK_VERSION_SEPARATOR)):
+            raise ValueError(f"Callback argument {part!r} contains a separator")
+        parts.append(part)
+    data = CALLBACK_VERSION + CALLBACK_VERSION_SEPARATOR + CALLBACK_SEPARATOR.join(parts)
+    if len(data.encode()) > CALLBACK_MAX_BYTES:
+        raise ValueError(f"Callback data {data!r} exceeds {CALLBACK_MAX_BYTES} bytes")
+    return data
+
+def _convert_callback_args(action: str, raw_args: list[str], base: int) -> tuple[CallbackRoute, list] | None:
+    """Looks up an action's route and converts its raw arguments to the registered types."""
+    route = CALLBACK_ROUTES.get(action)
+    if route is None or len(raw_args) != len(route.arg_types):
+        return None
+    try:
+        args = [int(raw, base) if arg_type is int else arg_type(raw)
+                for arg_type, raw in zip(route.arg_types, raw_args)]
+    except ValueError:
+        return None
+    return route, args
+
+def _decode_callback_v1(body: str) -> tuple[CallbackRoute, list] | None:
+    """Version 1: "ACTION.arg.arg" with integers in base 36."""
+    action, *raw_args = body.split(CALLBACK_SEPARATOR)
+    return _convert_callback_args(action, raw_args, 36)
+
+def _decode_callback_legacy(data: str) -> tuple[CallbackRoute, list] | None:
+    """Unversioned payloads: "ACTION" or "ACTION:arg" with a decimal integer.
+
+    Buttons sent before the version prefix existed may also hold the version 1
+    body on its own, so a dotted payload is decoded as version 1.
+    """
+    if CALLBACK_SEPARATOR in data:
+        return _decode_callback_v1(data)
+    action, sep, raw = data.partition(LEGACY_CALLBACK_SEPARATOR)
+    return _convert_callback_args(action, [raw] if sep else [], 10)
+
+# Callback format version -> decoder of the payload after the version prefix.
+CALLBACK_DECODERS = {
+    "1": _decode_callback_v1,
+}
+
+def callback_action(data: str) -> str:
+    """The action name of a payload in any format, without decoding its arguments."""
+    version, sep, body = data.partition(CALLBACK_VERSION_SEPARATOR)
+    return re.split(r"[.:]", body if sep else data, maxsplit=1)[0]
+
+def decode_callback(data: str) -> tuple[CallbackRoute, list] | None:
+    """Finds the route for a payload and converts its arguments; None for unknown or malformed data."""
+    version, sep, body = data.partition(CALLBACK_VERSION_SEPARATOR)
+    if not sep:
+        return _decode_callback_legacy(data)
+    decoder = CALLBACK_DECODERS.get(version)
+    return decoder(body) if decoder is not None else None
+
+async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Dispatches every callback query to its registered route."""
+    q = update.callback_query
+    decoded = decode_callback(q.data or "")
+    if decoded is None:
         await q.answer()
+        logger.warning("Unknown callback data %r from user %s", q.data, q.from_user.id)
         return
-        
-    if data == "SUPPORT_CONTACT":
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key=?", (SETTING_SUPPORT,))
-        support_user = cur.fetchone()
-        conn.close()
-
-        support_text = "لا يوجد دعم متاح حالياً." # رسالة افتراضية
-        if support_user and support_user[0]:
-            support_text = f"<b>💬 التواصل مع الدعم</b>\n\nللتواصل مع الدعم الفني، يرجى مراسلة:\n\n@{support_user[0]}\n"
-
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]])
-        await q.message.edit_text(support_text, reply_markup=kb, parse_mode='HTML')
+    route, args = decoded
+    if route.answer:
+        await q.answer()
+    if route.admin is not None and not is_admin(q.from_user.id):
+        if not route.answer:
+            await q.answer()
+        await q.message.reply_text(route.admin)
         return
+    with handler_scope(route.handler.__name__):
+        await route.handler(update, context, *args)
 
-    if data == "TOPUP_MENU":
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("📮 كود شام كاش", callback_data="SHOW_SHAM_CODE"), InlineKeyboardButton("📍 عنوان شام كاش", callback_data="SHOW_SHAM_ADDR")],
-            [InlineKeyboardButton("➕ شحن الحساب", callback_data="TOPUP_START")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]
-        ])
-        await q.message.edit_text("اختر من خيارات الشحن:", reply_markup=kb)
-        return
+# -----------------------------------------------------------------------------
+# Callback Query Handlers (General User Flow)
+# These functions handle button clicks from the main user menu.
+# -----------------------------------------------------------------------------
 
-    if data == "BACK_TO_MAIN":
-        welcome_message = (
-            f"🖐🏻أهلًا بك في متجرنا🖐🏻\n"+"\n✍🏻الصانع : علي حاج مرعي✍🏻\n" + "\n👇🏻اختر من القائمة بالأسفل👇🏻"
+@callback("ACCOUNT")
+async def cb_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the user's account details."""
+    q = update.callback_query
+    user_id = q.from_user.id
+    user_data = await run_db(get_user, user_id)
+
+    if user_data:
+        username = user_data['username'] if user_data['username'] else "لا يوجد"
+        balance = from_minor(user_data['balance_minor'])
+
+        # تم تعديل النص بالكامل ليناسب تنسيق HTML بشكل صحيح
+        message_text = (
+            f"👤 <b>معلومات حسابك:</b>\n"
+            f"• الآيدي: {user_id}\n"
+            f"• اليوزر: @{username}\n"
+            f"• الرصيد: {balance} ل.س"
         )
-        await q.message.edit_text(welcome_message, reply_markup=MAIN_MENU, parse_mode=ParseMode.HTML)
-        return
 
-    if data == "BUY":
-        cats = get_categories()
-        if not cats:
-            await q.message.edit_text("لا توجد قوائم بعد. الرجاء مراجعة الأدمن.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]]))
-            return
+        # تأكد أن parse_mode هو HTML
+        await context.bot.send_message(
+            chat_id=q.message.chat_id,
+            text=message_text,
+            parse_mode="HTML"
+        )
+    else:
+        await context.bot.send_message(
+            chat_id=q.message.chat_id,
+            text="لم يتم العثور على معلومات حسابك. يرجى التواصل مع الدعم."
+        )
+
+@callback("SUPPORT_CONTACT")
+async def cb_support_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows how to reach support."""
+    q = update.callback_query
+    support_user = get_setting(SETTING_SUPPORT)
 
-        # New code to group 2 buttons per row
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f" {cats[i]['name']}", callback_data=f"BUY_CAT:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f" {cats[i+1]['name']}", callback_data=f"BUY_CAT:{cats[i+1]['id']}"))
-            rows.append(row)
+    support_text = "لا يوجد دعم متاح حالياً." # رسالة افتراضية
+    if support_user:
+        support_text = f"<b>💬 التواصل مع الدعم</b>\n\nللتواصل مع الدعم الفني، يرجى مراسلة:\n\n@{support_user}\n"
 
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")])
-        await q.message.edit_text("👇🏻 اختر اي قائمة تريد 👇🏻:", reply_markup=InlineKeyboardMarkup(rows))
-        return
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]])
+    await q.message.edit_text(support_text, reply_markup=kb, parse_mode='HTML')
+
+@callback("TOPUP_MENU")
+async def cb_topup_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the top-up options."""
+    q = update.callback_query
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("📮 كود شام كاش", callback_data="SHOW_SHAM_CODE"), InlineKeyboardButton("📍 عنوان شام كاش", callback_data="SHOW_SHAM_ADDR")],
+        [InlineKeyboardButton("➕ شحن الحساب", callback_data="TOPUP_START")],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]
+    ])
+    await q.message.edit_text("اختر من خيارات الشحن:", reply_markup=kb)
 
-    if data == "NEWS":
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key=?", ('news_message',))
-        news_message_from_db = cur.fetchone()
-        conn.close()
+@callback("BACK_TO_MAIN")
+async def cb_back_to_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns to the main menu."""
+    q = update.callback_query
+    welcome_message = (
+        f"🖐🏻أهلًا بك في متجرنا🖐🏻\n"+"\n✍🏻الصانع : علي حاج مرعي✍🏻\n" + "\n👇🏻اختر من القائمة بالأسفل👇🏻"
+    )
+    await q.message.edit_text(welcome_message, reply_markup=MAIN_MENU, parse_mode=ParseMode.HTML)
 
-        news_text = news_message_from_db[0] if news_message_from_db else "🗞️ قسم الأخبار\n\nلا توجد أخبار جديدة حالياً. تابعنا للمزيد!"
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]])
-        await q.message.edit_text(news_text, reply_markup=kb, parse_mode='HTML')
+@callback("BUY")
+async def cb_buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists the main categories to buy from."""
+    q = update.callback_query
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.edit_text("لا توجد قوائم بعد. الرجاء مراجعة الأدمن.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]]))
         return
 
+    await q.message.edit_text("👇🏻 اختر اي قائمة تريد 👇🏻:", reply_markup=catalog_kb(snapshot, "buy_root"))
+
+@callback("NEWS")
+async def cb_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the news message."""
+    q = update.callback_query
+    news_message_from_db = get_setting(SETTING_NEWS)
+
+    news_text = news_message_from_db if news_message_from_db else "🗞️ قسم الأخبار\n\nلا توجد أخبار جديدة حالياً. تابعنا للمزيد!"
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")]])
+    await q.message.edit_text(news_text, reply_markup=kb, parse_mode='HTML')
+
 # -----------------------------------------------------------------------------
 # Show Sham Cash Code/Address + Start Top-up Handlers
 # -----------------------------------------------------------------------------
-async def on_topup_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles top-up menu button callbacks."""
+@callback("SHOW_SHAM_CODE")
+async def cb_show_sham_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the Sham Cash QR code."""
     q = update.callback_query
-    await q.answer()
-    data = q.data
-
-    if data == "SHOW_SHAM_CODE":
-        # The user's requested photo ID for the Sham Cash QR code.
-        photo_id = "AgACAgQAAxkBAYkui2ixsUvmCDPQVMDpOvFzFISV2TEIAAKeyjEbDEyQUc4oaicsvccZAQADAgADcwADNgQ" 
-        caption_text = f"👇🏻 عنوان شام كاش 👇🏻:\n \n 9cd65bde642da2496b407f8941dc01 \n إذا كنت تريد تحويل الدولار أو الليرة التركية فحول انا احولهم لحسابك ليصبحوا رصيد بالسوري على البوت لا تقلق😁"
-        if photo_id:
-            await q.message.chat.send_photo(photo=photo_id, caption=caption_text, parse_mode=ParseMode.HTML)
-        else:
-            await q.message.chat.send_message("لم يتم ضبط صورة كود شام كاش بعد. أخبر الأدمن.")
-        return
+    # The user's requested photo ID for the Sham Cash QR code.
+    photo_id = "AgACAgQAAxkBAYkui2ixsUvmCDPQVMDpOvFzFISV2TEIAAKeyjEbDEyQUc4oaicsvccZAQADAgADcwADNgQ" 
+    caption_text = f"👇🏻 عنوان شام كاش 👇🏻:\n \n 9cd65bde642da2496b407f8941dc01 \n إذا كنت تريد تحويل الدولار أو الليرة التركية فحول انا احولهم لحسابك ليصبحوا رصيد بالسوري على البوت لا تقلق😁"
+    if photo_id:
+        await q.message.chat.send_photo(photo=photo_id, caption=caption_text, parse_mode=ParseMode.HTML)
+    else:
+        await q.message.chat.send_message("لم يتم ضبط صورة كود شام كاش بعد. أخبر الأدمن.")
 
-    if data == "SHOW_SHAM_ADDR":
-        addr = get_setting(SETTING_SHAM_ADDR)
-        if addr:
-            await q.message.chat.send_message(f"عنوان شام كاش:\n<code>{addr}</code>", parse_mode=ParseMode.HTML)
-        else:
-            await q.message.chat.send_message("لم يتم ضبط العنوان بعد. أخبر الأدمن.")
-        return
+@callback("SHOW_SHAM_ADDR")
+async def cb_show_sham_addr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sends the Sham Cash address."""
+    q = update.callback_query
+    addr = get_setting(SETTING_SHAM_ADDR)
+    if addr:
+        await q.message.chat.send_message(f"عنوان شام كاش:\n<code>{addr}</code>", parse_mode=ParseMode.HTML)
+    else:
+        await q.message.chat.send_message("لم يتم ضبط العنوان بعد. أخبر الأدمن.")
 
-    if data == "TOPUP_START":
-        context.user_data.clear()
-        context.user_data["flow"] = "topup"
-        await q.message.chat.send_message("🔢 أرسل رقم العملية:")
-        return
+@callback("TOPUP_START")
+async def cb_topup_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Starts the top-up flow."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "topup"
+    await q.message.chat.send_message("🔢 أرسل رقم العملية:")
 
 # -----------------------------------------------------------------------------
 # Buy Flow Handlers
 # -----------------------------------------------------------------------------
-async def on_buy_flow(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles product buying process callbacks."""
+@callback("BUY_BACK")
+async def cb_buy_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Goes one level up in the buying menus."""
     q = update.callback_query
-    await q.answer()
-    data = q.data
-
-    if data == "BUY_BACK":
-        current_cat_id = context.user_data.get("current_cat_id")
-        if current_cat_id is None: 
-            welcome_message = (
-                f"🖐🏻أهلًا بك في متجرنا🖐🏻\n"+"\n✍🏻الصانع : علي حاج مرعي✍🏻\n" + "\n👇🏻اختر من القائمة بالأسفل👇🏻"
-            )
-            await q.message.edit_text(welcome_message, reply_markup=MAIN_MENU, parse_mode=ParseMode.HTML)
-            return
-
-        parent_cat = get_category(current_cat_id)
-        parent_id = parent_cat['parent_id'] if parent_cat else None
-
-        if parent_id is None:
-            cats = get_categories(parent_id=None)
-            rows = []
-            for i in range(0, len(cats), 2):
-                row = [InlineKeyboardButton(f" {cats[i]['name']}", callback_data=f"BUY_CAT:{cats[i]['id']}")]
-                if i + 1 < len(cats):
-                    row.append(InlineKeyboardButton(f" {cats[i+1]['name']}", callback_data=f"BUY_CAT:{cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BACK_TO_MAIN")])
-            await q.message.edit_text("اختر اي قائمة تريد:", reply_markup=InlineKeyboardMarkup(rows))
-            context.user_data["current_cat_id"] = None
-            return
-        else:
-            sub_cats = get_categories(parent_id=parent_id)
-            if sub_cats:
-                rows = []
-                for i in range(0, len(sub_cats), 2):
-                    row = [InlineKeyboardButton(f" {sub_cats[i]['name']}", callback_data=f"BUY_CAT:{sub_cats[i]['id']}")]
-                    if i + 1 < len(sub_cats):
-                        row.append(InlineKeyboardButton(f" {sub_cats[i+1]['name']}", callback_data=f"BUY_CAT:{sub_cats[i+1]['id']}"))
-                    rows.append(row)
-                rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")])
-                await q.message.edit_text("اختر اي قسم تريد:", reply_markup=InlineKeyboardMarkup(rows))
-                context.user_data["current_cat_id"] = parent_id
-            else:
-                await q.message.edit_text("لا توجد قوائم فرعية في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")]]))
-            return
+    current_cat_id = context.user_data.get("current_cat_id")
+    if current_cat_id is None: 
+        welcome_message = (
+            f"🖐🏻أهلًا بك في متجرنا🖐🏻\n"+"\n✍🏻الصانع : علي حاج مرعي✍🏻\n" + "\n👇🏻اختر من القائمة بالأسفل👇🏻"
+        )
+        await q.message.edit_text(welcome_message, reply_markup=MAIN_MENU, parse_mode=ParseMode.HTML)
+        return
 
-    if data.startswith("BUY_CAT:"):
-        cat_id = int(data.split(":", 1)[1])
-        context.user_data["current_cat_id"] = cat_id
+    parent_cat = (await catalog()).category(current_cat_id)
+    parent_id = parent_cat['parent_id'] if parent_cat else None
 
-        sub_cats = get_categories(parent_id=cat_id)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f" {sub_cats[i]['name']}", callback_data=f"BUY_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f" {sub_cats[i+1]['name']}", callback_data=f"BUY_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")])
-            await q.message.edit_text("👇🏻 اختر اي قسم تريد 👇🏻:", reply_markup=InlineKeyboardMarkup(rows))
-            return
-
-        prods = get_products_by_cat(cat_id)
-        if not prods:
-            await q.message.edit_text("❌ لا توجد منتجات في هذه القائمة حالياً ❌", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")]]))
-            return
+    if parent_id is None:
+        snapshot = await catalog()
+        await q.message.edit_text("اختر اي قائمة تريد:", reply_markup=catalog_kb(snapshot, "buy_root"))
+        context.user_data["current_cat_id"] = None
+        return
+    else:
+        snapshot = await catalog()
+        sub_cats = snapshot.categories_under(parent_id)
+        if sub_cats:
+            await q.message.edit_text("اختر اي قسم تريد:", reply_markup=catalog_kb(snapshot, "buy_sub", parent_id))
+            context.user_data["current_cat_id"] = parent_id
+        else:
+            await q.message.edit_text("لا توجد قوائم فرعية في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")]]))
+        return
 
-        rows = []
-        for i in range(0, len(prods), 2):
-            p1 = prods[i]
-            button_text1 = f" {p1['name']} /-/ {money(p1['price'])}" if p1['product_type'] == 'regular' else f" {p1['name']} /-/ {money(p1['price'])} للواحدة"
-            row = [InlineKeyboardButton(button_text1, callback_data=f"BUY_PROD:{p1['id']}")]
+@callback("BUY_CAT", int)
+async def cb_buy_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int):
+    """Lists a category's sub-categories or products."""
+    q = update.callback_query
+    context.user_data["current_cat_id"] = cat_id
 
-            if i + 1 < len(prods):
-                p2 = prods[i+1]
-                button_text2 = f" {p2['name']} /-/ {money(p2['price'])}" if p2['product_type'] == 'regular' else f" {p2['name']} /-/ {money(p2['price'])} للواحدة"
-                row.append(InlineKeyboardButton(button_text2, callback_data=f"BUY_PROD:{p2['id']}"))
-            rows.append(row)
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cat_id)
+    if sub_cats:
+        await q.message.edit_text("👇🏻 اختر اي قسم تريد 👇🏻:", reply_markup=catalog_kb(snapshot, "buy_sub", cat_id))
+        return
 
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")])
-        await q.message.edit_text("👇🏻 اختر منتجاً 👇🏻:", reply_markup=InlineKeyboardMarkup(rows))
+    prods = snapshot.products_in(cat_id)
+    if not prods:
+        await q.message.edit_text("❌ لا توجد منتجات في هذه القائمة حالياً ❌", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="BUY_BACK")]]))
         return
 
-    if data.startswith("BUY_PROD:"):
-        prod_id = int(data.split(":", 1)[1])
-        prow = get_product(prod_id)
-        if not prow:
-            await q.message.chat.send_message("❌ تعذر إيجاد المنتج ❌")
-            return
+    await q.message.edit_text("👇🏻 اختر منتجاً 👇🏻:", reply_markup=catalog_kb(snapshot, "buy_prods", cat_id))
 
-        context.user_data.clear()
-        context.user_data["buy_prod_id"] = prod_id
-        context.user_data["current_cat_id"] = prow['category_id']
+OUT_OF_STOCK_MESSAGE = "❌ لا يوجد كمية كافية من هذا المنتج. يرجى التواصل مع الأدمن."
+PRODUCT_NOT_FOUND_MESSAGE = "❌ تعذر إيجاد المنتج ❌"
 
-        if prow['product_type'] == 'regular':
-            # قم بالتحقق أولا إذا كانت الكمية غير محدودة
-            if prow['stock'] is None:
-                # إذا كانت غير محدودة، لا تفعل شيئًا وانتقل
-                pass
-            # أما إذا كانت الكمية محددة، فتحقق إذا كانت 0 أو أقل
-            elif prow['stock'] <= 0:
-                await q.answer("❌ لا يوجد كمية كافية من هذا المنتج. يرجى التواصل مع الأدمن.", show_alert=True)
-                return
-                await q.message.chat.send_message("هذا المنتج غير متوفر حالياً. الرجاء المحاولة لاحقاً.")
-                return
-            context.user_data["flow"] = "buy_contact"
-            await q.message.chat.send_message("🆔 أرسل الآيدي أو رقم الهاتف المطلوب ربطه بالطلب(إذا رقم هاتف بدون 963+ رجاءاً و إلا طلبك رح ينلغي) 🆔:")
-        elif prow['product_type'] == 'quantity':
-            context.user_data["flow"] = "buy_quantity"
-            await q.message.chat.send_message(f"أدخل الكمية المطلوبة.\nالحد المسموح به هو: {prow['min_qty']} إلى {prow['max_qty']}.")
-        return
+def is_out_of_stock(prow: sqlite3.Row) -> bool:
+    """Tells whether a regular product with limited stock has run out (NULL stock is unlimited)."""
+    return prow['product_type'] == 'regular' and prow['stock'] is not None and prow['stock'] <= 0
 
-    if data == "CHANGE_QTY":
+async def start_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, prow: sqlite3.Row):
+    """Starts the buy flow for a product by asking for the contact or the quantity."""
+    context.user_data.clear()
+    context.user_data["buy_prod_id"] = prow['id']
+    context.user_data["current_cat_id"] = prow['category_id']
+
+    chat = update.effective_chat
+    if prow['product_type'] == 'regular':
+        context.user_data["flow"] = "buy_contact"
+        await chat.send_message("🆔 أرسل الآيدي أو رقم الهاتف المطلوب ربطه بالطلب(إذا رقم هاتف بدون 963+ رجاءاً و إلا طلبك رح ينلغي) 🆔:")
+    elif prow['product_type'] == 'quantity':
         context.user_data["flow"] = "buy_quantity"
-        prod_id = context.user_data.get("buy_prod_id")
-        prow = get_product(prod_id)
-        await q.message.chat.send_message(f"أدخل الكمية الجديدة.\nالحد المسموح به هو: {prow['min_qty']} إلى {prow['max_qty']}.")
+        await chat.send_message(f"أدخل الكمية المطلوبة.\nالحد المسموح به هو: {prow['min_qty']} إلى {prow['max_qty']}.")
+
+async def show_catalog_page(update: Update, view: str, cat_id: int, start_id: int):
+    """Swaps a listing message's keyboard for another page of the same view."""
+    q = update.callback_query
+    snapshot = await catalog()
+    try:
+        await q.message.edit_reply_markup(reply_markup=catalog_kb(snapshot, view, cat_id or None, start_id))
+    except BadRequest:
+        pass  # The page did not change, e.g. a double tap.
+
+@callback("BUY_PAGE", str, int, int)
+async def cb_buy_page(update: Update, context: ContextTypes.DEFAULT_TYPE, view: str, cat_id: int, start_id: int):
+    """Shows another page of a buying menu."""
+    if view in PUBLIC_CATALOG_VIEWS:
+        await show_catalog_page(update, view, cat_id, start_id)
+
+@callback("BUY_PROD", int, answer=False)
+async def cb_buy_prod(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_id: int):
+    """Starts buying a product; answers with an alert when it is out of stock."""
+    q = update.callback_query
+    prow = (await catalog()).product(prod_id)
+    if prow and is_out_of_stock(prow):
+        await q.answer(OUT_OF_STOCK_MESSAGE, show_alert=True)
         return
+    await q.answer()
+    if not prow:
+        await q.message.chat.send_message(PRODUCT_NOT_FOUND_MESSAGE)
+        return
+    await start_purchase(update, context, prow)
 
-    if data == "BUY_CANCEL":
-        msg_id = context.user_data.get("confirm_msg_id")
-        if msg_id:
-            try:
-                await q.message.chat.delete_message(msg_id)
-            except Exception:
-                pass
+@callback("CHANGE_QTY")
+async def cb_change_qty(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for a new quantity."""
+    q = update.callback_query
+    context.user_data["flow"] = "buy_quantity"
+    prod_id = context.user_data.get("buy_prod_id")
+    prow = (await catalog()).product(prod_id)
+    await q.message.chat.send_message(f"أدخل الكمية الجديدة.\nالحد المسموح به هو: {prow['min_qty']} إلى {prow['max_qty']}.")
+
+@callback("BUY_CANCEL")
+async def cb_buy_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancels the pending purchase."""
+    q = update.callback_query
+    msg_id = context.user_data.get("confirm_msg_id")
+    if msg_id:
+        try:
+            await q.message.chat.delete_message(msg_id)
+        except Exception:
+            pass
+    context.user_data.clear()
+    await q.message.chat.send_message("✔ تم إلغاء الطلب ✔")
+
+@callback("BUY_EDIT")
+async def cb_buy_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for a new contact for the pending purchase."""
+    q = update.callback_query
+    await q.message.chat.send_message("🔄 أعد إرسال الآيدي/رقم الهاتف الجديد 🔄:")
+    context.user_data["flow"] = "buy_contact"
+
+@callback("BUY_CONFIRM")
+async def cb_buy_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Places the pending purchase and forwards it to the orders group."""
+    q = update.callback_query
+    prod_id = int(context.user_data.get("buy_prod_id", 0))
+    contact = context.user_data.get("buy_contact")
+    if not (prod_id and contact):
+        await q.message.chat.send_message("⛔ الطلب غير مكتمل أعد المحاولة ⛔")
         context.user_data.clear()
-        await q.message.chat.send_message("✔ تم إلغاء الطلب ✔")
         return
-
-    if data == "BUY_EDIT":
-        await q.message.chat.send_message("🔄 أعد إرسال الآيدي/رقم الهاتف الجديد 🔄:")
-        context.user_data["flow"] = "buy_contact"
+    prow = (await catalog()).product(prod_id)
+    if not prow:
+        await q.message.chat.send_message("🔍 تعذر إيجاد المنتج 🚫")
+        context.user_data.clear()
         return
 
-    if data == "BUY_CONFIRM":
-        urow = get_user(q.from_user.id)
-        prod_id = int(context.user_data.get("buy_prod_id", 0))
-        contact = context.user_data.get("buy_contact")
-        if not (prod_id and contact):
-            await q.message.chat.send_message("⛔ الطلب غير مكتمل أعد المحاولة ⛔")
-            context.user_data.clear()
-            return
-        prow = get_product(prod_id)
-        if not prow:
-            await q.message.chat.send_message("🔍 تعذر إيجاد المنتج 🚫")
-            context.user_data.clear()
+    quantity = 1
+    if prow['product_type'] == 'quantity':
+        quantity = context.user_data.get("buy_quantity", 0)
+        if not quantity:
+            await q.message.chat.send_message("🔄لم يتم تحديد الكمية الرجاء المحاولة مرة أخرى⛔")
             return
 
-        quantity = 1
-        if prow['product_type'] == 'quantity':
-            quantity = context.user_data.get("buy_quantity", 0)
-            if not quantity:
-                await q.message.chat.send_message("🔄لم يتم تحديد الكمية الرجاء المحاولة مرة أخرى⛔")
-                return
-
-        price = float(prow["price"]) * quantity
+    price = float(prow["price"]) * quantity
 
-        # Check if enough balance
-        bal = float(urow["balance"]) if urow else 0.0
-        if bal < price:
+    # Debit the balance, decrement the stock and log the order atomically.
+    try:
+        oid, new_bal = await run_db(purchase, q.from_user.id, prod_id, quantity, contact)
+    except PurchaseError as e:
+        if e.reason == 'balance':
             await q.message.chat.send_message("💔 رصيدك غير كافٍ لهذا الطلب 💔")
-            context.user_data.clear()
-            return
-
-        # Check if enough stock (for regular products)
-        if prow['product_type'] == 'regular' and prow['stock'] < quantity:
+        elif e.reason == 'stock':
             await q.message.chat.send_message("📦 تعذر تنفيذ الطلب الكمية غير كافية 🚫")
-            context.user_data.clear()
-            return
-
-        # Decrement stock and change balance
-        decrement_product_stock(prod_id, quantity)
-        new_bal = change_balance(q.from_user.id, -price)
-
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO orders(user_id, product_id, price, contact, status, created_at) VALUES(?,?,?,?,?,?)",
-            (q.from_user.id, prod_id, price, contact, "pending", datetime.utcnow().isoformat()),
-        )
-        oid = cur.lastrowid
-        conn.commit()
-        conn.close()
-
-        await q.message.chat.send_message("⏳ تم تقديم طلبك. الرجاء الانتظار ريثما يتم التحقق منه.")
-
-        gid = get_setting(SETTING_GROUP_ORDERS)
-        if gid:
-            kb = InlineKeyboardMarkup([[
-                InlineKeyboardButton("✅ قبول", callback_data=f"ORD_ACCEPT:{oid}"),
-                InlineKeyboardButton("❌ رفض", callback_data=f"ORD_REJECT:{oid}"),
-            ]])
-            urow = get_user(q.from_user.id)
-            text = (
-                "🧾 تأكيد طلب شراء\n"
-                f"• المنتج: <b>{prow['name']}</b>\n"
-                f"• السعر: <b>{money(price)}</b>\n"
-                f"• الكمية: <b>{quantity}</b>\n"
-                f"• الآيدي/الهاتف: <code>{contact}</code>\n"
-                f"• اليوزر: @{urow['username'] if urow['username'] else '—'}\n"
-                f"• آيدي المستخدم: <code>{urow['user_id']}</code>\n")
-            try:
-                await context.bot.send_message(int(gid), text, parse_mode=ParseMode.HTML, reply_markup=kb)
-            except Exception as e:
-                logger.error(f"Failed to send order to group: {e}")
         else:
-            await q.message.chat.send_message("⚠️ لم يتم ضبط آيدي مجموعة الطلبات. تواصل مع الأدمن.")
-
+            await q.message.chat.send_message("🔍 تعذر إيجاد المنتج 🚫")
         context.user_data.clear()
         return
 
+    await q.message.chat.send_message("⏳ تم تقديم طلبك. الرجاء الانتظار ريثما يتم التحقق منه.")
+
+    gid = get_setting(SETTING_GROUP_ORDERS)
+    if gid:
+        text = (
+            "🧾 تأكيد طلب شراء\n"
+            f"• المنتج: <b>{notice_field(prow['name'])}</b>\n"
+            f"• السعر: <b>{money(price)}</b>\n"
+            f"• الكمية: <b>{quantity}</b>\n"
+            f"• الآيدي/الهاتف: <code>{notice_field(contact)}</code>\n"
+            f"• اليوزر: @{q.from_user.username if q.from_user.username else '—'}\n"
+            f"• آيدي المستخدم: <code>{q.from_user.id}</code>\n")
+        await group_notifier.notify(context.bot, int(gid), GroupNotice('order', oid, text))
+    else:
+        await q.message.chat.send_message("⚠️ لم يتم ضبط آيدي مجموعة الطلبات. تواصل مع الأدمن.")
+
+    context.user_data.clear()
+
 # -----------------------------------------------------------------------------
-# Message Handler for User Input (Multi-state)
-# This handles text input based on the user's current "flow" state.
+# Message Handler for User Input (Flow Registry)
+# Text input is routed by the user's current "flow" state. Each state is
+# registered with @flow() together with its input validator and the state that
+# follows it, so on_user_message dispatches with one dict lookup however many
+# flows exist. Time spent per state is counted in FLOW_STATS (see /flowstats).
 # -----------------------------------------------------------------------------
 
+class FlowInputError(Exception):
+    """Raised by a flow handler to reject the input with a message; the state is kept."""
+
+class Flow:
+    """A registered flow state: its handler, input validator and next state."""
+
+    __slots__ = ("handler", "validate", "error", "next_state", "admin_only")
+
+    def __init__(self, handler, validate, error, next_state, admin_only):
+        self.handler = handler
+        self.validate = validate
+        self.error = error
+        self.next_state = next_state
+        self.admin_only = admin_only
+
+FLOWS: dict[str, Flow] = {}
+
+# state -> [calls, total seconds, slowest call in seconds]
+FLOW_STATS: dict[str, list[float]] = {}
+
+EMPTY_NAME_ERROR = "🔄 الاسم لا يمكن أن يكون فارغاً، يرجى المحاولة مرة أخرى ❌"
+PRICE_ERROR = "السعر يجب أن يكون رقماً أكبر من صفر، يرجى المحاولة مرة أخرى."
+AMOUNT_ERROR = "المبلغ يجب أن يكون رقماً أكبر من صفر، يرجى المحاولة مرة أخرى."
+
+def flow(state: str, validate=None, error: str | None = None, next_state: str | None = None):
+    """Registers the decorated coroutine as the text handler of a flow state.
+
+    `validate` converts the message text (raising ValueError, answered with
+    `error`); the handler receives the converted value. When the handler leaves
+    the state unchanged, the user moves on to `next_state` if one is given.
+    States starting with "adm_" are for administrators only.
+    """
+    def register(handler):
+        FLOWS[state] = Flow(handler, validate, error, next_state, state.startswith("adm_"))
+        return handler
+    return register
+
+def non_empty(text: str) -> str:
+    """Validator that rejects empty text."""
+    if not text:
+        raise ValueError("empty")
+    return text
+
+def positive_int(text: str) -> int:
+    """Validator for a whole number greater than zero."""
+    value = int(text)
+    if value < 1:
+        raise ValueError(text)
+    return value
+
+def qty_range(text: str) -> tuple[int, int]:
+    """Validator for a quantity range such as 10-20."""
+    min_qty, max_qty = map(int, text.split('-'))
+    if min_qty > max_qty or min_qty < 1:
+        raise ValueError(text)
+    return min_qty, max_qty
+
+def id_list(text: str) -> list[int]:
+    """Validator for comma-separated user IDs."""
+    return [int(i.strip()) for i in text.split(",")]
+
+def record_flow_timing(state: str, elapsed: float, error: bool = False):
+    """Adds one handled message to a state's timing counters and handler metrics."""
+    HANDLER_METRICS.observe(f"flow:{state}", elapsed, error)
+    stats = FLOW_STATS.get(state)
+    if stats is None:
+        stats = FLOW_STATS[state] = [0, 0.0, 0.0]
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] = max(stats[2], elapsed)
+
 async def on_user_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles all text messages from users."""
+    """Handles all text messages from users by dispatching on their flow state."""
     text = (update.message.text or '').strip()
-    user_id = update.effective_user.id
-    current_flow = context.user_data.get("flow")
+    state = context.user_data.get("flow")
+    entry = FLOWS.get(state) if state else None
 
-    if not current_flow:
+    if entry is None:
         await update.message.reply_text("اختر إجراءً من الأزرار.", reply_markup=MAIN_MENU)
         return
+    if entry.admin_only and not is_admin(update.effective_user.id):
+        return
 
-    # Admin actions first
-    if is_admin(user_id):
-        if current_flow.startswith("adm_"):
-            if current_flow == "adm_cat_add":
-                cat_name = text
-                if not cat_name:
-                    await update.message.reply_text("🔄 الاسم لا يمكن أن يكون فارغاً، يرجى المحاولة مرة أخرى ❌")
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("INSERT INTO categories(name, parent_id) VALUES(?,?)", (cat_name, None))
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                await update.message.reply_text(f"✅ تم إضافة الفئة '{cat_name}' بنجاح.")
+    started = time.perf_counter()
+    failed = False
+    token = current_handler.set(f"flow:{state}")
+    try:
+        if entry.validate is not None:
+            try:
+                value = entry.validate(text)
+            except ValueError:
+                await update.message.reply_text(entry.error)
                 return
+        else:
+            value = text
+        try:
+            await entry.handler(update, context, value)
+        except FlowInputError as e:
+            await update.message.reply_text(str(e))
+            return
+        if entry.next_state is not None and context.user_data.get("flow") == state:
+            context.user_data["flow"] = entry.next_state
+    except Exception:
+        failed = True
+        raise
+    finally:
+        current_handler.reset(token)
+        record_flow_timing(state, time.perf_counter() - started, failed)
+
+async def cmd_flowstats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /flowstats, listing the busiest flow states and their latency (admins only)."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("غير مصرح لك بالوصول إلى لوحة التحكم هذه.")
+        return
+    if not FLOW_STATS:
+        await update.message.reply_text("لا توجد إحصائيات بعد.")
+        return
+    lines = ["⏱ الحالات الأكثر استخداماً (العدد، المتوسط، الأقصى بالمللي ثانية):"]
+    for state, (calls, total, slowest) in sorted(FLOW_STATS.items(), key=lambda item: -item[1][0]):
+        lines.append(f"• <code>{state}</code>: {int(calls)}، {total / calls * 1000:.1f}، {slowest * 1000:.1f}")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+async def cmd_sqltop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles /sqltop [N], listing the N statements with the most total time (admins only)."""
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("غير مصرح لك بالوصول إلى لوحة التحكم هذه.")
+        return
+    if sql_tracer is None:
+        await update.message.reply_text("تتبع الاستعلامات غير مفعّل. شغّل البوت مع SQL_TRACE=1.")
+        return
+    try:
+        limit = min(int(context.args[0]), SQL_TOP_MAX) if context.args else SQL_TOP_DEFAULT
+    except ValueError:
+        limit = SQL_TOP_DEFAULT
+    rows = sql_tracer.top(max(limit, 1))
+    if not rows:
+        await update.message.reply_text("لا توجد إحصائيات بعد.")
+        return
+    lines = ["🐢 الاستعلامات الأكثر استهلاكاً للوقت (الإجمالي، العدد، المتوسط، الأقصى بالمللي ثانية):"]
+    for sql, calls, total, slowest, steps, callers in rows:
+        text = sql if len(sql) <= SQL_TOP_TEXT_LIMIT else sql[:SQL_TOP_TEXT_LIMIT] + "…"
+        lines.append(f"\n• {total * 1000:.1f}، {calls}، {total / calls * 1000:.2f}، {slowest * 1000:.1f}"
+                     f" — {html.escape(', '.join(callers))}\n<code>{html.escape(text)}</code>")
+    await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+
+# --- Category management -----------------------------------------------------
+
+@flow("adm_cat_add", validate=non_empty, error=EMPTY_NAME_ERROR)
+async def flow_cat_add(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_name: str):
+    """Creates a main category with the sent name."""
+    await run_db(add_category, cat_name)
+    del context.user_data["flow"]
+    await update.message.reply_text(f"✅ تم إضافة الفئة '{cat_name}' بنجاح.")
+
+@flow("adm_cat_add_sub_name", validate=non_empty, error=EMPTY_NAME_ERROR)
+async def flow_cat_add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_name: str):
+    """Creates a sub-category with the sent name."""
+    parent_id = context.user_data.get("parent_id")
+    await run_db(add_category, cat_name, parent_id)
+    del context.user_data["flow"]
+    del context.user_data["parent_id"]
+    await update.message.reply_text(f"✅ تم إضافة الفئة الفرعية '{cat_name}' بنجاح.")
+
+@flow("adm_cat_rename", validate=non_empty, error=EMPTY_NAME_ERROR)
+async def flow_cat_rename(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    """Renames the selected category."""
+    cid = context.user_data.get("cid")
+    await run_db(rename_category, cid, name)
+    del context.user_data["flow"]
+    del context.user_data["cid"]
+    await update.message.reply_text("✅ تم تعديل اسم القائمة.")
+
+@flow("adm_cat_move_sub_target", validate=int, error="أرسل آيدي القائمة الرئيسية كرقم أو اختر من الأزرار.")
+async def flow_cat_move_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, parent_id: int):
+    """Moves the selected sub-category under the sent parent ID."""
+    cid = context.user_data.get("cid")
+    target = (await catalog()).category(parent_id)
+    if target is None or target['parent_id'] is not None or parent_id == cid:
+        raise FlowInputError("⛔ لا توجد قائمة رئيسية بهذا الآيدي. أرسل آيدي قائمة رئيسية موجودة.")
+    await run_db(move_category, cid, parent_id)
+    del context.user_data["flow"]
+    del context.user_data["cid"]
+    await update.message.reply_text("✅ تم نقل القائمة الفرعية بنجاح.")
+
+# --- Product management ------------------------------------------------------
+
+@flow("adm_prod_add_name", validate=non_empty, error=EMPTY_NAME_ERROR, next_state="adm_prod_add_price")
+async def flow_prod_add_name(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    """Stores the new product's name and asks for its price."""
+    context.user_data["name"] = name
+    await update.message.reply_text("أرسل سعر المنتج الجديد:")
+
+@flow("adm_prod_add_price", validate=parse_amount, error=PRICE_ERROR)
+async def flow_prod_add_price(update: Update, context: ContextTypes.DEFAULT_TYPE, price: float):
+    """Creates the new unlimited-stock product."""
+    name = context.user_data.get("name")
+    cid = context.user_data.get("cid")
+    await run_db(add_product, cid, name, price)
+    context.user_data.clear()
+    await update.message.reply_text("✅ تم إضافة المنتج بنجاح (كمية غير محدودة).")
+
+@flow("adm_prod_add_quantity_name", validate=non_empty, error=EMPTY_NAME_ERROR,
+      next_state="adm_prod_add_quantity_price")
+async def flow_prod_add_quantity_name(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_name: str):
+    """Stores the new quantity product's name and asks for its unit price."""
+    context.user_data["prod_name"] = prod_name
+    await update.message.reply_text("أدخل سعر الوحدة الواحدة:")
+
+@flow("adm_prod_add_quantity_price", validate=parse_amount, error=PRICE_ERROR,
+      next_state="adm_prod_add_quantity_range")
+async def flow_prod_add_quantity_price(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_price: float):
+    """Stores the unit price and asks for the allowed quantity range."""
+    context.user_data["prod_price"] = prod_price
+    await update.message.reply_text("أدخل نطاق الكمية المسموح به (مثلاً: 10-20):")
+
+@flow("adm_prod_add_quantity_range", validate=qty_range, error="الرجاء إدخال نطاق صحيح مثل 10-20.")
+async def flow_prod_add_quantity_range(update: Update, context: ContextTypes.DEFAULT_TYPE, qty: tuple[int, int]):
+    """Creates the new quantity product."""
+    min_qty, max_qty = qty
+    prod_name = context.user_data.get("prod_name")
+    prod_price = context.user_data.get("prod_price")
+    cid = context.user_data.get("cid")
+    await run_db(add_product, cid, prod_name, prod_price, 'quantity', min_qty, max_qty)
+    del context.user_data["flow"]
+    del context.user_data["prod_name"]
+    del context.user_data["prod_price"]
+    del context.user_data["cid"]
+    await update.message.reply_text(f"✅ تم إضافة المنتج بكمية '{prod_name}' بنجاح.")
+
+@flow("adm_prod_rename", validate=non_empty, error=EMPTY_NAME_ERROR)
+async def flow_prod_rename(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    """Renames the selected product."""
+    pid = context.user_data.get("pid")
+    await run_db(rename_product, pid, name)
+    del context.user_data["flow"]
+    del context.user_data["pid"]
+    await update.message.reply_text("✅ تم تعديل اسم المنتج.")
+
+@flow("adm_prod_reprice", validate=parse_amount, error=PRICE_ERROR)
+async def flow_prod_reprice(update: Update, context: ContextTypes.DEFAULT_TYPE, prod_price: float):
+    """Changes the selected product's price."""
+    pid = context.user_data.get("pid")
+    await run_db(reprice_product, pid, prod_price)
+    del context.user_data["flow"]
+    del context.user_data["pid"]
+    await update.message.reply_text("✅ تم تعديل سعر المنتج.")
+
+# --- User balances -----------------------------------------------------------
+
+USER_ID_ERROR = "الآيدي يجب أن يكون رقماً، يرجى المحاولة مرة أخرى."
+
+@flow("adm_usr_credit_id", validate=int, error=USER_ID_ERROR, next_state="adm_usr_credit_amount")
+async def flow_usr_credit_id(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    """Stores the user to credit and asks for the amount."""
+    context.user_data["credit_uid"] = uid
+    await update.message.reply_text("أدخل المبلغ المراد شحنه (رقماً):")
+
+# Notices sent to a user whose balance an admin changed.
+CREDIT_NOTICE = "✅ تم شحن رصيد حسابك بقيمة {amount}. رصيدك الحالي: {balance}"
+DEBIT_NOTICE = "➖ تم سحب رصيد من حسابك بقيمة {amount}. رصيدك الحالي: {balance}"
+USER_NOT_FOUND_MESSAGE = "❌ لا يوجد مستخدم بهذا الآيدي."
+
+@flow("adm_usr_credit_amount", validate=parse_amount, error=AMOUNT_ERROR)
+async def flow_usr_credit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: float):
+    """Credits the user; their notification goes out through the outbox."""
+    credit_uid = int(context.user_data.get("credit_uid"))
+    new_balance = await run_db(adjust_balance, credit_uid, amount, CREDIT_NOTICE)
+    if new_balance is None:
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
+    else:
+        await update.message.reply_text("✅ تم شحن رصيد المستخدم بنجاح.")
+    del context.user_data["flow"]
+    del context.user_data["credit_uid"]
+
+@flow("adm_usr_debit_id", validate=int, error=USER_ID_ERROR, next_state="adm_usr_debit_amount")
+async def flow_usr_debit_id(update: Update, context: ContextTypes.DEFAULT_TYPE, uid: int):
+    """Stores the user to debit and asks for the amount."""
+    context.user_data["debit_uid"] = uid
+    await update.message.reply_text("أدخل المبلغ المراد سحبه (رقماً):")
+
+@flow("adm_usr_debit_amount", validate=parse_amount, error=AMOUNT_ERROR)
+async def flow_usr_debit_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: float):
+    """Debits the user; their notification goes out through the outbox."""
+    debit_uid = int(context.user_data.get("debit_uid"))
+    new_balance = await run_db(adjust_balance, debit_uid, -amount, DEBIT_NOTICE)
+    if new_balance is None:
+        await update.message.reply_text(USER_NOT_FOUND_MESSAGE)
+    else:
+        await update.message.reply_text("✅ تم سحب الرصيد من المستخدم بنجاح.")
+    del context.user_data["flow"]
+    del context.user_data["debit_uid"]
+
+# --- Settings and messages ---------------------------------------------------
+
+# Flows that store the message text as a setting: state -> (setting key, confirmation).
+SETTING_FLOWS = {
+    "adm_set_support": (SETTING_SUPPORT, "✅ تم حفظ يوزر الدعم."),
+    "adm_set_sham_code": (SETTING_SHAM_CODE, "✅ تم حفظ كود شام كاش."),
+    "adm_set_sham_addr": (SETTING_SHAM_ADDR, "✅ تم حفظ عنوان شام كاش."),
+    "adm_set_group_topup": (SETTING_GROUP_TOPUP, "✅ تم حفظ آيدي مجموعة الشحن."),
+    "adm_set_group_orders": (SETTING_GROUP_ORDERS, "✅ تم حفظ آيدي مجموعة الطلبات."),
+}
+
+def _register_setting_flow(state: str, key: str, confirmation: str):
+    @flow(state)
+    async def save_setting(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        """Stores the sent text as the setting."""
+        await run_db(set_setting, key, text)
+        await update.message.reply_text(confirmation)
+        del context.user_data["flow"]
 
-            elif current_flow == "adm_cat_add_sub_name":
-                cat_name = text
-                parent_id = context.user_data.get("parent_id")
-                if not cat_name:
-                    await update.message.reply_text("🔄 الاسم لا يمكن أن يكون فارغاً، يرجى المحاولة مرة أخرى ❌")
-                    return
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("INSERT INTO categories(name, parent_id) VALUES(?,?)", (cat_name, parent_id))
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                del context.user_data["parent_id"]
-                await update.message.reply_text(f"✅ تم إضافة الفئة الفرعية '{cat_name}' بنجاح.")
-                return
+for _state, (_key, _confirmation) in SETTING_FLOWS.items():
+    _register_setting_flow(_state, _key, _confirmation)
+
+@flow("adm_set_admins", validate=id_list, error="الرجاء إرسال الآيديات كأرقام مفصولة بفواصل.")
+async def flow_set_admins(update: Update, context: ContextTypes.DEFAULT_TYPE, admin_ids: list[int]):
+    """Stores the administrator IDs."""
+    await run_db(set_setting, SETTING_ADMINS, ",".join(map(str, admin_ids)))
+    await update.message.reply_text("✅ تم حفظ آيديات الأدمن.")
+    del context.user_data["flow"]
+
+@flow("adm_broadcast")
+async def flow_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Stores the broadcast text and asks for its audience."""
+    context.user_data["flow"] = None
+    context.user_data["broadcast_text"] = text
+    await update.message.reply_text("اختر الفئة التي ستصلها الرسالة:", reply_markup=broadcast_segments_kb())
+
+@flow("adm_edit_news")
+async def flow_edit_news(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Stores the news message."""
+    await run_db(set_setting, SETTING_NEWS, update.message.text)
+    context.user_data.clear()
+    await update.message.reply_text("✅ تم تحديث رسالة الأخبار بنجاح.")
+
+@flow("adm_edit_support_message")
+async def flow_edit_support_message(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Stores the support message."""
+    await run_db(set_setting, SETTING_SUPPORT_MESSAGE, update.message.text)
+    context.user_data.clear()
+    await update.message.reply_text("✅ تم تحديث رسالة الدعم بنجاح.")
+
+# --- Top-up process ----------------------------------------------------------
+
+@flow("topup", next_state="topup_amount")
+async def flow_topup_op(update: Update, context: ContextTypes.DEFAULT_TYPE, op: str):
+    """Stores the top-up operation number and asks for the amount."""
+    context.user_data["topup_op"] = op
+    await update.message.reply_text("💰 الآن أرسل المبلغ (رقماً مثل 1000 أو 10.5):")
+
+@flow("topup_amount", validate=parse_amount, error=AMOUNT_ERROR)
+async def flow_topup_amount(update: Update, context: ContextTypes.DEFAULT_TYPE, amount: float):
+    """Logs the top-up request and forwards it to the top-up group."""
+    op = context.user_data.get("topup_op")
+    user = update.effective_user
+    await run_db(ensure_user, user)
+
+    tid = await run_db(create_topup, user.id, op, amount)
+
+    await update.message.reply_text("⏳ تم إرسال طلب الشحن. الرجاء الانتظار ريثما يتم التحقق منه.")
+    gid = get_setting(SETTING_GROUP_TOPUP)
+    if gid:
+        message_text = (
+            "📩 طلب شحن جديد\n"
+            f"• اليوزر: @{user.username if user.username else '—'}\n"
+            f"• الآيدي: <code>{user.id}</code>\n"
+            f"• رقم العملية: <code>{notice_field(op)}</code>\n"
+            f"• المبلغ: <b>{money(amount)}</b>\n"
+        )
+        await group_notifier.notify(context.bot, int(gid), GroupNotice('topup', tid, message_text))
+    else:
+        await update.message.reply_text("⚠️ لم يتم ضبط آيدي مجموعة الشحن. تواصل مع الأدمن.")
+    context.user_data.clear()
+
+# --- Buy process -------------------------------------------------------------
+
+@flow("search", validate=non_empty, error="أرسل نص البحث.")
+async def flow_search(update: Update, context: ContextTypes.DEFAULT_TYPE, query: str):
+    """Searches the catalog for the text the user sent."""
+    context.user_data["flow"] = None
+    await reply_search_results(update, query)
+
+async def _confirm_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, msg_text: str, kb: InlineKeyboardMarkup):
+    """Sends the purchase confirmation and waits for its buttons."""
+    msg = await update.message.reply_text(msg_text, reply_markup=kb, parse_mode=ParseMode.HTML)
+    context.user_data["confirm_msg_id"] = msg.message_id
+    context.user_data["flow"] = None
+
+@flow("buy_contact")
+async def flow_buy_contact(update: Update, context: ContextTypes.DEFAULT_TYPE, contact: str):
+    """Stores the contact for a regular product and asks for confirmation."""
+    context.user_data["buy_contact"] = contact
+    prod_id = context.user_data.get("buy_prod_id")
+    prow = (await catalog()).product(prod_id)
+    if not prow:
+        await update.message.reply_text("تعذر إيجاد المنتج. الرجاء المحاولة مرة أخرى.")
+        context.user_data.clear()
+        return
 
-            elif current_flow == "adm_cat_rename":
-                cid = context.user_data.get("cid")
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("UPDATE categories SET name=? WHERE id=?", (text, cid))
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                del context.user_data["cid"]
-                await update.message.reply_text("✅ تم تعديل اسم القائمة.")
-                return
+    current_balance = await run_db(get_balance, update.effective_user.id)
+    new_balance = current_balance - prow['price']
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ تأكيد الطلب", callback_data="BUY_CONFIRM") , InlineKeyboardButton("✏️ تعديل الآيدي/الهاتف", callback_data="BUY_EDIT")],
+        [InlineKeyboardButton("❌ إلغاء الطلب", callback_data="BUY_CANCEL")]
+    ])
+    msg_text = (f"❓هل أنت متأكد من معلومات الطلب\n"
+                f"• المنتج: {prow['name']}\n"
+                f"• السعر: {money(prow['price'])}\n"
+                f"• الآيدي/الهاتف: {contact}\n"
+                f"• الرصيد قبل: {money(current_balance)}\n"
+                f"• الرصيد بعد: {money(new_balance)}\n")
+    await _confirm_purchase(update, context, msg_text, kb)
+
+@flow("buy_quantity", validate=int, error="الكمية يجب أن تكون رقماً صحيحاً، يرجى المحاولة مرة أخرى.",
+      next_state="buy_contact_quantity")
+async def flow_buy_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, quantity: int):
+    """Checks the requested quantity against the product's range."""
+    prod_id = context.user_data.get("buy_prod_id")
+    prow = (await catalog()).product(prod_id)
+    if not prow:
+        await update.message.reply_text("تعذر إيجاد المنتج. الرجاء المحاولة مرة أخرى.")
+        context.user_data.clear()
+        return
 
-            elif current_flow == "adm_cat_move_sub_target":
-                cid = context.user_data.get("cid")
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("UPDATE categories SET parent_id=? WHERE id=?", (text, cid))
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                del context.user_data["cid"]
-                await update.message.reply_text("✅ تم نقل القائمة الفرعية بنجاح.")
-                return
+    min_qty = prow['min_qty']
+    max_qty = prow['max_qty']
+    if not (min_qty <= quantity <= max_qty):
+        raise FlowInputError(f"الرجاء إدخال كمية صحيحة.\nالحد المسموح به هو: {min_qty} إلى {max_qty}.")
 
-            if current_flow == "adm_prod_add_name":
-                context.user_data["name"] = update.message.text
-                context.user_data["flow"] = "adm_prod_add_price"
-                await update.message.reply_text("أرسل سعر المنتج الجديد:")
-                return
+    context.user_data["buy_quantity"] = quantity
+    await update.message.reply_text("أرسل الآيدي أو رقم الهاتف المطلوب ربطه بالطلب:")
 
-            elif current_flow == "adm_prod_add_price":
-                try:
-                    price = float(update.message.text)
-                    name = context.user_data.get("name")
-                    cid = context.user_data.get("cid")
-                    conn = sqlite3.connect(DB_PATH)
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO products (name, price, stock, category_id, product_type) VALUES (?, ?, ?, ?, ?)", (name, price, None, cid, 'regular'))
-                    conn.commit()
-                    conn.close()
-                    await update.message.reply_text("✅ تم إضافة المنتج بنجاح (كمية غير محدودة).")
-                except ValueError:
-                    await update.message.reply_text("الرجاء إرسال السعر كقيمة رقمية صحيحة.")
-                finally:
-                    context.user_data.clear()
-                return
+@flow("buy_contact_quantity")
+async def flow_buy_contact_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, contact: str):
+    """Stores the contact for a quantity product and asks for confirmation."""
+    context.user_data["buy_contact"] = contact
 
+    prod_id = context.user_data.get("buy_prod_id")
+    quantity = context.user_data.get("buy_quantity")
+    prow = (await catalog()).product(prod_id)
+    if not prow:
+        await update.message.reply_text("تعذر إيجاد المنتج. الرجاء المحاولة مرة أخرى.")
+        context.user_data.clear()
+        return
 
-            elif current_flow == "adm_prod_add_quantity_name":
-                prod_name = text
-                context.user_data["prod_name"] = prod_name
-                context.user_data["flow"] = "adm_prod_add_quantity_price"
-                await update.message.reply_text("أدخل سعر الوحدة الواحدة:")
-                return
+    total_price = prow['price'] * quantity
+    current_balance = await run_db(get_balance, update.effective_user.id)
+    new_balance = current_balance - total_price
 
-            elif current_flow == "adm_prod_add_quantity_price":
-                try:
-                    prod_price = float(text)
-                except ValueError:
-                    await update.message.reply_text("السعر يجب أن يكون رقماً، يرجى المحاولة مرة أخرى.")
-                    return
-                context.user_data["prod_price"] = prod_price
-                context.user_data["flow"] = "adm_prod_add_quantity_range"
-                await update.message.reply_text("أدخل نطاق الكمية المسموح به (مثلاً: 10-20):")
-                return
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ تأكيد الطلب", callback_data="BUY_CONFIRM") , InlineKeyboardButton("❌ إلغاء الطلب", callback_data="BUY_CANCEL")],
+        [InlineKeyboardButton("✏️ تغيير الكمية/تغيير الرقم", callback_data="CHANGE_QTY")]
+    ])
 
-            elif current_flow == "adm_prod_add_quantity_range":
-                try:
-                    min_qty, max_qty = map(int, text.split('-'))
-                    if min_qty > max_qty or min_qty < 1:
-                        raise ValueError
-                except ValueError:
-                    await update.message.reply_text("الرجاء إدخال نطاق صحيح مثل 10-20.")
-                    return
+    msg_text = (f"❓هل أنت متأكد من معلومات الطلب\n"
+                f"• المنتج: {prow['name']}\n"
+                f"• الكمية: {quantity}\n"
+                f"• السعر الإجمالي: {money(total_price)}\n"
+                f"• الآيدي/الهاتف: {contact}\n"
+                f"• الرصيد قبل: {money(current_balance)}\n"
+                f"• الرصيد بعد: {money(new_balance)}\n")
+    await _confirm_purchase(update, context, msg_text, kb)
 
-                prod_name = context.user_data.get("prod_name")
-                prod_price = context.user_data.get("prod_price")
-                cid = context.user_data.get("cid")
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute(
-                    "INSERT INTO products(name, price, min_qty, max_qty, category_id, product_type) VALUES(?,?,?,?,?,?)",
-                    (prod_name, prod_price, min_qty, max_qty, cid, 'quantity')
-                )
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                del context.user_data["prod_name"]
-                del context.user_data["prod_price"]
-                del context.user_data["cid"]
-                await update.message.reply_text(f"✅ تم إضافة المنتج بكمية '{prod_name}' بنجاح.")
-                return
+# -----------------------------------------------------------------------------
+# Group Action Buttons (Admin Only) Handlers
+# These handle actions taken by admins in the top-up/order groups.
+# -----------------------------------------------------------------------------
 
-            elif current_flow == "adm_prod_reprice":
-                try:
-                    prod_price = float(text)
-                except ValueError:
-                    await update.message.reply_text("السعر يجب أن يكون رقماً، يرجى المحاولة مرة أخرى.")
-                    return
-                pid = context.user_data.get("pid")
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("UPDATE products SET price=? WHERE id=?", (prod_price, pid))
-                conn.commit()
-                conn.close()
-                del context.user_data["flow"]
-                del context.user_data["pid"]
-                await update.message.reply_text("✅ تم تعديل سعر المنتج.")
-                return
+async def mark_digest_item(q, item_id: int, note: str) -> bool:
+    """Marks one request of a digest message as handled, leaving the others' buttons.
 
-            elif current_flow == "adm_usr_credit_id":
-                context.user_data["credit_uid"] = text
-                context.user_data["flow"] = "adm_usr_credit_amount"
-                await update.message.reply_text("أدخل المبلغ المراد شحنه (رقماً):")
-                return
+    Returns False when the message is not a digest, so the caller can update it
+    as a single request.
+    """
+    if not (q.message.text or "").startswith(GROUP_DIGEST_MARK):
+        return False
+    markup = q.message.reply_markup
+    rows = [row for row in (markup.inline_keyboard if markup else ())
+            if not any((decoded := decode_callback(button.callback_data or "")) and decoded[1] == [item_id]
+                       for button in row)]
+    try:
+        await q.message.edit_text(f"{q.message.text_html}\n#{item_id}: {note}", parse_mode=ParseMode.HTML,
+                                  reply_markup=InlineKeyboardMarkup(rows) if rows else None)
+    except Exception:
+        pass
+    return True
+
+async def settle_topup_action(update: Update, context: ContextTypes.DEFAULT_TYPE, tid: int, approve: bool):
+    """Accepts or rejects a top-up request from the top-up group."""
+    q = update.callback_query
+    row, _ = await run_db(settle_topup, tid, approve)
+    if not row:
+        await q.message.reply_text("لم يتم العثور على هذا الطلب.")
+        return
+    if row["status"] != "pending":
+        if not await mark_digest_item(q, row["id"], "تمت معالجته مسبقًا."):
+            await q.message.edit_text("تمت معالجته مسبقًا.")
+        return
 
-            elif current_flow == "adm_usr_credit_amount":
-                try:
-                    amount = float(text)
-                except ValueError:
-                    await update.message.reply_text("المبلغ يجب أن يكون رقماً، يرجى المحاولة مرة أخرى.")
-                    return
-                credit_uid = int(context.user_data.get("credit_uid"))
-                new_balance = change_balance(credit_uid, amount)
-                await update.message.reply_text("✅ تم شحن رصيد المستخدم بنجاح.")
-                try:
-                    await context.bot.send_message(credit_uid, f"✅ تم شحن رصيد حسابك بقيمة {money(amount)}. رصيدك الحالي: {money(new_balance)}")
-                except Exception as e:
-                    logger.error(f"Failed to notify user {credit_uid}: {e}")
-                del context.user_data["flow"]
-                del context.user_data["credit_uid"]
-                return
+    # The user is notified through the outbox, queued by the same transaction.
+    icon, label = ("✅", "تم قبول الشحن") if approve else ("❌", "تم رفض الشحن")
+    if not await mark_digest_item(q, row["id"], f"{icon} {label}"):
+        try:
+            await q.message.edit_text(q.message.text + f"\n\n{icon} **{label}**",
+                                      parse_mode=ParseMode.MARKDOWN, reply_markup=None)
+        except Exception:
+            pass
 
-            elif current_flow == "adm_usr_debit_id":
-                context.user_data["debit_uid"] = text
-                context.user_data["flow"] = "adm_usr_debit_amount"
-                await update.message.reply_text("أدخل المبلغ المراد سحبه (رقماً):")
-                return
+async def settle_order_action(update: Update, context: ContextTypes.DEFAULT_TYPE, oid: int, approve: bool):
+    """Accepts or rejects an order from the orders group."""
+    q = update.callback_query
+    row = await run_db(settle_order, oid, approve)
+    if not row:
+        await q.message.reply_text("لم يتم العثور على الطلب.")
+        return
+    if row["status"] != "pending":
+        if not await mark_digest_item(q, row["id"], "تمت معالجته مسبقًا."):
+            await q.message.edit_text("تمت معالجته مسبقًا.")
+        return
 
-            elif current_flow == "adm_usr_debit_amount":
-                try:
-                    amount = float(text)
-                except ValueError:
-                    await update.message.reply_text("المبلغ يجب أن يكون رقماً، يرجى المحاولة مرة أخرى.")
-                    return
-                debit_uid = int(context.user_data.get("debit_uid"))
-                new_balance = change_balance(debit_uid, -amount)
-                await update.message.reply_text("✅ تم سحب الرصيد من المستخدم بنجاح.")
-                try:
-                    await context.bot.send_message(debit_uid, f"➖ تم سحب رصيد من حسابك بقيمة {money(amount)}. رصيدك الحالي: {money(new_balance)}")
-                except Exception as e:
-                    logger.error(f"Failed to notify user {debit_uid}: {e}")
-                del context.user_data["flow"]
-                del context.user_data["debit_uid"]
-                return
+    # The user is notified through the outbox, queued by the same transaction.
+    icon, label = ("✅", "تم قبول الطلب") if approve else ("❌", "تم رفض الطلب")
+    if not await mark_digest_item(q, row["id"], f"{icon} {label}"):
+        try:
+            await q.message.edit_text(q.message.text + f"\n\n{icon} **{label}**",
+                                      parse_mode=ParseMode.MARKDOWN, reply_markup=None)
+        except Exception:
+            pass
+
+@callback("TP_ACCEPT", int, admin=GROUP_ACTION_DENIED)
+async def cb_tp_accept(update: Update, context: ContextTypes.DEFAULT_TYPE, tid: int):
+    """Accepts a top-up request."""
+    await settle_topup_action(update, context, tid, True)
+
+@callback("TP_REJECT", int, admin=GROUP_ACTION_DENIED)
+async def cb_tp_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, tid: int):
+    """Rejects a top-up request."""
+    await settle_topup_action(update, context, tid, False)
+
+@callback("ORD_ACCEPT", int, admin=GROUP_ACTION_DENIED)
+async def cb_ord_accept(update: Update, context: ContextTypes.DEFAULT_TYPE, oid: int):
+    """Accepts an order."""
+    await settle_order_action(update, context, oid, True)
+
+@callback("ORD_REJECT", int, admin=GROUP_ACTION_DENIED)
+async def cb_ord_reject(update: Update, context: ContextTypes.DEFAULT_TYPE, oid: int):
+    """Rejects an order."""
+    await settle_order_action(update, context, oid, False)
 
-            elif current_flow == "adm_set_support":
-                set_setting(SETTING_SUPPORT, text)
-                await update.message.reply_text("✅ تم حفظ يوزر الدعم.")
-                del context.user_data["flow"]
-                return
+# -----------------------------------------------------------------------------
+# Pending Queue
+# Lists pending top-ups and orders page by page (keyset on id, served by the
+# status indexes) so that admins can select many and settle them at once. A
+# bulk action runs in one transaction, which also queues the users'
+# notifications in the outbox.
+# -----------------------------------------------------------------------------
 
-            elif current_flow == "adm_set_sham_code":
-                set_setting(SETTING_SHAM_CODE, text)
-                await update.message.reply_text("✅ تم حفظ كود شام كاش.")
-                del context.user_data["flow"]
-                return
+PENDING_PAGE_SIZE = 10
+PENDING_KIND_LABELS = {'topup': "💳 طلبات الشحن", 'order': "🧾 طلبات الشراء"}
+MESSAGE_NOT_MODIFIED = "message is not modified"
+
+def pending_line(kind: str, row: sqlite3.Row) -> str:
+    """One HTML line describing a pending top-up or order; user-supplied fields are escaped."""
+    when = datetime.utcfromtimestamp(row['created_at']).strftime('%m-%d %H:%M')
+    if kind == 'topup':
+        return (f"#{row['id']} • {when} • <code>{row['user_id']}</code> • {money(row['amount'])}"
+                f" • عملية {html.escape(str(row['op_number']))}")
+    product = html.escape(row['product_name'] or "منتج محذوف")
+    return (f"#{row['id']} • {when} • <code>{row['user_id']}</code> • {product} • {money(row['price'])}"
+            f" • {html.escape(str(row['contact']))}")
+
+async def show_pending_page(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, after_id: int):
+    """Shows one page of the pending queue with selection toggles and bulk actions."""
+    q = update.callback_query
+    rows = await run_db(get_pending, kind, after_id, PENDING_PAGE_SIZE + 1)
+    has_more = len(rows) > PENDING_PAGE_SIZE
+    rows = rows[:PENDING_PAGE_SIZE]
+    selected = set(context.user_data.get("pending_selected", {}).get(kind, ()))
+
+    lines = [f"{PENDING_KIND_LABELS[kind]} المعلقة:"]
+    if not rows:
+        lines.append("لا توجد طلبات معلقة." if after_id == 0 else "لا توجد طلبات أخرى.")
+    lines += [pending_line(kind, row) for row in rows]
+    lines.append(f"\nالمحدد: {len(selected)}")
+
+    toggles = [InlineKeyboardButton(f"{'☑️' if row['id'] in selected else '⬜'} #{row['id']}",
+                                    callback_data=encode_callback("PENDING_TOGGLE", kind, after_id, row['id']))
+               for row in rows]
+    kb = [toggles[i:i + 2] for i in range(0, len(toggles), 2)]
+    if rows:
+        kb.append([InlineKeyboardButton("☑️ تحديد الصفحة", callback_data=encode_callback("PENDING_PAGE_ALL", kind, after_id)),
+                   InlineKeyboardButton("🔄 إلغاء التحديد", callback_data=encode_callback("PENDING_CLEAR", kind, after_id))])
+    if selected:
+        kb.append([InlineKeyboardButton(f"✅ قبول المحدد ({len(selected)})", callback_data=encode_callback("PENDING_BULK", kind, 1)),
+                   InlineKeyboardButton(f"❌ رفض المحدد ({len(selected)})", callback_data=encode_callback("PENDING_BULK", kind, 0))])
+    nav = []
+    if after_id:
+        nav.append(InlineKeyboardButton("⏮ البداية", callback_data=encode_callback("PENDING_LIST", kind, 0)))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=encode_callback("PENDING_LIST", kind, rows[-1]['id'])))
+    if nav:
+        kb.append(nav)
+    kb.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_PENDING")])
+    try:
+        await q.message.edit_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(kb), parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if MESSAGE_NOT_MODIFIED not in str(e).lower():
+            raise
+
+def pending_selection(context: ContextTypes.DEFAULT_TYPE, kind: str) -> list[int]:
+    """The admin's selected ids for a queue (a list so that it persists as JSON)."""
+    return context.user_data.setdefault("pending_selected", {}).setdefault(kind, [])
+
+@callback("ADM_PENDING", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_pending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows how many top-ups and orders are pending."""
+    q = update.callback_query
+    counts = await run_db(count_pending)
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"{label} ({counts[kind]})", callback_data=encode_callback("PENDING_LIST", kind, 0))]
+        for kind, label in PENDING_KIND_LABELS.items()
+    ] + [[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]])
+    await q.message.edit_text("الطلبات المعلقة:", reply_markup=kb)
+
+@callback("PENDING_LIST", str, int, admin=ADMIN_PANEL_DENIED)
+async def cb_pending_list(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, after_id: int):
+    """Shows a page of pending top-ups or orders."""
+    if kind in PENDING_QUERIES:
+        await show_pending_page(update, context, kind, after_id)
+
+@callback("PENDING_TOGGLE", str, int, int, admin=ADMIN_PANEL_DENIED)
+async def cb_pending_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, after_id: int, item_id: int):
+    """Selects or unselects one pending item."""
+    if kind not in PENDING_QUERIES:
+        return
+    selected = pending_selection(context, kind)
+    if item_id in selected:
+        selected.remove(item_id)
+    else:
+        selected.append(item_id)
+    await show_pending_page(update, context, kind, after_id)
 
-            elif current_flow == "adm_set_sham_addr":
-                set_setting(SETTING_SHAM_ADDR, text)
-                await update.message.reply_text("✅ تم حفظ عنوان شام كاش.")
-                del context.user_data["flow"]
-                return
+@callback("PENDING_PAGE_ALL", str, int, admin=ADMIN_PANEL_DENIED)
+async def cb_pending_page_all(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, after_id: int):
+    """Selects every item on a page of the pending queue."""
+    if kind not in PENDING_QUERIES:
+        return
+    selected = pending_selection(context, kind)
+    rows = await run_db(get_pending, kind, after_id, PENDING_PAGE_SIZE)
+    selected.extend(row['id'] for row in rows if row['id'] not in selected)
+    await show_pending_page(update, context, kind, after_id)
+
+@callback("PENDING_CLEAR", str, int, admin=ADMIN_PANEL_DENIED)
+async def cb_pending_clear(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, after_id: int):
+    """Clears the selection of a pending queue."""
+    if kind not in PENDING_QUERIES:
+        return
+    pending_selection(context, kind).clear()
+    await show_pending_page(update, context, kind, after_id)
 
-            elif current_flow == "adm_set_group_topup":
-                set_setting(SETTING_GROUP_TOPUP, text)
-                await update.message.reply_text("✅ تم حفظ آيدي مجموعة الشحن.")
-                del context.user_data["flow"]
-                return
+@callback("PENDING_BULK", str, int, admin=ADMIN_PANEL_DENIED)
+async def cb_pending_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str, approve: int):
+    """Approves or rejects every selected item in one transaction."""
+    q = update.callback_query
+    if kind not in PENDING_QUERIES:
+        return
+    ids = sorted(pending_selection(context, kind))
+    if not ids:
+        await show_pending_page(update, context, kind, 0)
+        return
+    settled = await run_db(settle_many, kind, ids, bool(approve), timeout=60.0)
+    context.user_data["pending_selected"][kind] = []
+    verb = "قبول" if approve else "رفض"
+    skipped = len(ids) - len(settled)
+    text = f"✅ تم {verb} {len(settled)} طلب."
+    if skipped:
+        text += f"\nتم تجاهل {skipped} طلب تمت معالجته مسبقاً."
+    await q.message.reply_text(text)
+    await show_pending_page(update, context, kind, 0)
 
-            elif current_flow == "adm_set_group_orders":
-                set_setting(SETTING_GROUP_ORDERS, text)
-                await update.message.reply_text("✅ تم حفظ آيدي مجموعة الطلبات.")
-                del context.user_data["flow"]
-                return
+# -----------------------------------------------------------------------------
+# Admin Menu Callback Handlers
+# These functions handle all button clicks within the admin panel.
+# -----------------------------------------------------------------------------
 
-            elif current_flow == "adm_set_admins":
-                admin_ids = [int(i.strip()) for i in text.split(",")]
-                set_setting(SETTING_ADMINS, ",".join(map(str, admin_ids)))
-                await update.message.reply_text("✅ تم حفظ آيديات الأدمن.")
-                del context.user_data["flow"]
-                return
+@callback("ADM_BACK", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns to the admin menu."""
+    q = update.callback_query
+    await q.message.edit_text("أهلاً بك أيها المدير! اختر من القائمة:", reply_markup=admin_menu_kb())
 
-            elif current_flow == "adm_broadcast":
-                message_text = text
-                context.user_data["flow"] = None
-                conn = db()
-                cur = conn.cursor()
-                cur.execute("SELECT user_id FROM users")
-                users = cur.fetchall()
-                conn.close()
-                sent_count = 0
-                blocked_count = 0
-                for user in users:
-                    try:
-                        await context.bot.send_message(chat_id=user['user_id'], text=message_text)
-                        sent_count += 1
-                    except Exception:
-                        blocked_count += 1
-                await update.message.reply_text(
-                    f"✅ تم إرسال الرسالة بنجاح.\n\n"
-                    f"عدد الرسائل المرسلة: {sent_count}\n"
-                    f"عدد المستخدمين المحظورين: {blocked_count}"
-                )
-                return
+@callback("ADM_CATS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_cats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the categories menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة القوائم:", reply_markup=cats_menu_kb())
 
-            elif current_flow == "adm_edit_news":
-                new_news_message = update.message.text
-                conn = sqlite3.connect(DB_PATH)
-                cur = conn.cursor()
-                cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('news_message', new_news_message))
-                conn.commit()
-                conn.close()
-                context.user_data.clear()
-                await update.message.reply_text("✅ تم تحديث رسالة الأخبار بنجاح.")
-                return
+@callback("ADM_BACK_CATS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_back_cats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Returns to the categories menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة القوائم:", reply_markup=cats_menu_kb())
 
-    # Top-up process
-    if current_flow == "topup":
-        stage = context.user_data.get("stage")
-        if stage is None:
-            context.user_data["topup_op"] = text
-            context.user_data["stage"] = "amount"
-            await update.message.reply_text("💰 الآن أرسل المبلغ (رقماً مثل 1000 أو 10.5):")
-            return
-        elif stage == "amount":
-            try:
-                amount = float(text)
-            except ValueError:
-                await update.message.reply_text("الرجاء إرسال المبلغ كرقم صحيح أو عشري.")
-                return
-            op = context.user_data.get("topup_op")
-            user = update.effective_user
-            ensure_user(user)
-
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO topups(user_id, op_number, amount, status, created_at) VALUES(?,?,?,?,?)",
-                (user.id, op, amount, "pending", datetime.utcnow().isoformat()),
-            )
-            tid = cur.lastrowid
-            conn.commit()
-            conn.close()
-
-            await update.message.reply_text("⏳ تم إرسال طلب الشحن. الرجاء الانتظار ريثما يتم التحقق منه.")
-            gid = get_setting(SETTING_GROUP_TOPUP)
-            if gid:
-                kb = InlineKeyboardMarkup([[
-                    InlineKeyboardButton("✅ قبول", callback_data=f"TP_ACCEPT:{tid}"),
-                    InlineKeyboardButton("❌ رفض", callback_data=f"TP_REJECT:{tid}"),
-                ]])
-                urow = get_user(user.id)
-                message_text = (
-                    "📩 طلب شحن جديد\n"
-                    f"• اليوزر: @{urow['username'] if urow['username'] else '—'}\n"
-                    f"• الآيدي: <code>{urow['user_id']}</code>\n"
-                    f"• رقم العملية: <code>{op}</code>\n"
-                    f"• المبلغ: <b>{money(amount)}</b>\n"
-                )
-                try:
-                    await context.bot.send_message(int(gid), message_text, parse_mode=ParseMode.HTML, reply_markup=kb)
-                except Exception as e:
-                    logger.error(f"Failed to send topup to group: {e}")
-            else:
-                await update.message.reply_text("⚠️ لم يتم ضبط آيدي مجموعة الشحن. تواصل مع الأدمن.")
-            context.user_data.clear()
-            return
+@callback("ADM_MAIN_CATS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_main_cats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the main categories menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة القوائم الرئيسية:", reply_markup=main_cats_kb())
 
-    # Buy process
-    if current_flow == "buy_contact":
-        contact = text
-        context.user_data["buy_contact"] = contact
-        prod_id = context.user_data.get("buy_prod_id")
-        prow = get_product(prod_id)
-        if not prow:
-            await update.message.reply_text("تعذر إيجاد المنتج. الرجاء المحاولة مرة أخرى.")
-            context.user_data.clear()
-            return
+@callback("ADM_SUB_CATS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_sub_cats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the sub-categories menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة القوائم الفرعية:", reply_markup=sub_cats_kb())
 
-        current_balance = get_balance(user_id)
-        new_balance = current_balance - prow['price']
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ تأكيد الطلب", callback_data="BUY_CONFIRM") , InlineKeyboardButton("✏️ تعديل الآيدي/الهاتف", callback_data="BUY_EDIT")],
-            [InlineKeyboardButton("❌ إلغاء الطلب", callback_data="BUY_CANCEL")]
-        ])
-        msg_text = (f"❓هل أنت متأكد من معلومات الطلب\n"
-                    f"• المنتج: {prow['name']}\n"
-                    f"• السعر: {money(prow['price'])}\n"
-                    f"• الآيدي/الهاتف: {contact}\n"
-                    f"• الرصيد قبل: {money(current_balance)}\n"
-                    f"• الرصيد بعد: {money(new_balance)}\n")
-        msg = await update.message.reply_text(msg_text, reply_markup=kb, parse_mode=ParseMode.HTML)
-        context.user_data["confirm_msg_id"] = msg.message_id
-        context.user_data["flow"] = None
-        return
-
-    if current_flow == "buy_quantity":
-        try:
-            quantity = int(text)
-        except ValueError:
-            await update.message.reply_text("الكمية يجب أن تكون رقماً صحيحاً، يرجى المحاولة مرة أخرى.")
-            return
+@callback("CAT_ADD_MAIN", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_add_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the name of a new main category."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_cat_add"
+    await q.message.reply_text("أرسل اسم القائمة الرئيسية الجديدة:")
 
-        prod_id = context.user_data.get("buy_prod_id")
-        prow = get_product(prod_id)
-        if not prow:
-            await update.message.reply_text("تعذر إيجاد المنتج. الرجاء المحاولة مرة أخرى.")
-            context.user_data.clear()
-            return
+@callback("CAT_EDIT_MAIN", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_edit_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists main categories to rename."""
+    q = update.callback_query
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.reply_text("لا توجد قوائم رئيسية لتعديلها.")
+        return
+    await q.message.reply_text("اختر قائمة لتعديل اسمها:", reply_markup=catalog_kb(snapshot, "cat_edit_main"))
 
-        if flow == "adm_edit_support_message":
-            new_message = update.message.text
-            conn = sqlite3.connect(DB_PATH)
-            cur = conn.cursor()
-            cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('support_message', new_message))
-            conn.commit()
-            conn.close()
-            context.user_data.clear()
-            await update.message.reply_text("✅ تم تحديث رسالة الدعم بنجاح.")
-            return
+@callback("EDIT_SUPPORT_MESSAGE", admin=ADMIN_PANEL_DENIED)
+async def cb_edit_support_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for a new support message."""
+    q = update.callback_query
+    context.user_data["flow"] = "adm_edit_support_message"
+    await q.message.edit_text("أرسل رسالة الدعم الجديدة الآن.")
 
-        min_qty = prow['min_qty']
-        max_qty = prow['max_qty']
-        if not (min_qty <= quantity <= max_qty):
-            await update.message.reply_text(f"الرجاء إدخال كمية صحيحة.\nالحد المسموح به هو: {min_qty} إلى {max_qty}.")
-            return
+@callback("CAT_DEL_MAIN", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_del_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists main categories to delete."""
+    q = update.callback_query
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.reply_text("لا توجد قوائم رئيسية لحذفها.")
+        return
+    await q.message.reply_text("اختر قائمة لحذفها:", reply_markup=catalog_kb(snapshot, "cat_del_main"))
+
+@callback("CAT_ADD_SUB", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists main categories to add a sub-category to."""
+    q = update.callback_query
+    context.user_data.clear()
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.reply_text("لا توجد قوائم رئيسية لإضافة قائمة فرعية إليها.")
+        return
+    await q.message.reply_text("اختر قائمة رئيسية لإضافة قائمة فرعية إليها:", reply_markup=catalog_kb(snapshot, "cat_add_sub"))
 
-        context.user_data["buy_quantity"] = quantity
-        context.user_data["flow"] = "buy_contact_quantity"
-        await update.message.reply_text("أرسل الآيدي أو رقم الهاتف المطلوب ربطه بالطلب:")
+@callback("CAT_EDIT_SUB", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_edit_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists sub-categories to rename."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.sub_categories()
+    if not sub_cats:
+        await q.message.reply_text("لا توجد قوائم فرعية لتعديلها.")
         return
+    await q.message.reply_text("اختر قائمة فرعية لتعديل اسمها:", reply_markup=catalog_kb(snapshot, "cat_edit_sub"))
 
-    if flow == "adm_edit_news":
-        new_news_message = update.message.text
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ('news_message', new_news_message))
-        conn.commit()
-        conn.close()
-        context.user_data.clear()
-        await update.message.reply_text("✅ تم تحديث رسالة الأخبار بنجاح.")
+@callback("CAT_DEL_SUB", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_del_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists sub-categories to delete."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.sub_categories()
+    if not sub_cats:
+        await q.message.reply_text("لا توجد قوائم فرعية لحذفها.")
+        return
+    await q.message.reply_text("اختر قائمة فرعية لحذفها:", reply_markup=catalog_kb(snapshot, "cat_del_sub"))
+
+@callback("CAT_MOVE_SUB", admin=ADMIN_PANEL_DENIED)
+async def cb_cat_move_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists sub-categories to move."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.sub_categories()
+    if not sub_cats:
+        await q.message.reply_text("لا توجد قوائم فرعية لنقلها.")
         return
+    await q.message.reply_text("اختر قائمة فرعية لنقلها:", reply_markup=catalog_kb(snapshot, "cat_move_sub"))
 
-    if current_flow == "buy_contact_quantity":
-        contact = text
-        context.user_data["buy_contact"] = contact
+@callback("CAT_MOVE", int, admin=ADMIN_PANEL_DENIED)
+async def cb_cat_move(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Lists the main categories a sub-category can move to."""
+    q = update.callback_query
+    context.user_data["flow"] = "adm_cat_move_sub_target"
+    context.user_data["cid"] = cid
+    snapshot = await catalog()
+    await q.message.reply_text("اختر القائمة الرئيسية الجديدة:", reply_markup=catalog_kb(snapshot, "cat_move_target"))
+
+@callback("TARGET_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_target_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, target_id: int):
+    """Moves the selected sub-category under a main category."""
+    q = update.callback_query
+    cid = context.user_data.get("cid")
+    await run_db(move_category, cid, target_id)
+    await q.message.reply_text("✅ تم نقل القائمة الفرعية بنجاح.")
+    del context.user_data["flow"]
+    del context.user_data["cid"]
+
+@callback("EDIT_NEWS", admin=ADMIN_PANEL_DENIED)
+async def cb_edit_news(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for a new news message."""
+    q = update.callback_query
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]])
+    context.user_data["flow"] = "adm_edit_news"
+    await q.message.edit_text("أرسل رسالة الأخبار الجديدة الآن.", reply_markup=kb)
 
-        prod_id = context.user_data.get("buy_prod_id")
-        quantity = context.user_data.get("buy_quantity")
-        prow = get_product(prod_id)
+@callback("CAT_LIST_ADD_SUB", int, admin=ADMIN_PANEL_DENIED)
+async def cb_cat_list_add_sub(update: Update, context: ContextTypes.DEFAULT_TYPE, parent_id: int):
+    """Asks for the name of a new sub-category."""
+    q = update.callback_query
+    context.user_data["flow"] = "adm_cat_add_sub_name"
+    context.user_data["parent_id"] = parent_id
+    await q.message.reply_text("أرسل اسم القائمة الفرعية الجديدة:")
 
-        total_price = prow['price'] * quantity
-        current_balance = get_balance(user_id)
-        new_balance = current_balance - total_price
+@callback("CAT_EDIT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_cat_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Asks for a category's new name."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_cat_rename"
+    context.user_data["cid"] = cid
+    await q.message.reply_text("أرسل الاسم الجديد للقائمة:")
+
+# Product Management
+@callback("CAT_DEL", int, admin=ADMIN_PANEL_DENIED)
+async def cb_cat_del(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Deletes a category."""
+    q = update.callback_query
+    try:
+        await run_db(delete_category, cid)
+    except sqlite3.IntegrityError:
+        await q.message.edit_text("⛔ لا يمكن حذف هذه القائمة لأن منتجاتها مرتبطة بطلبات سابقة.", reply_markup=None)
+        return
+    await q.message.edit_text("✅ تم حذف القائمة بنجاح.", reply_markup=None)
 
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("✅ تأكيد الطلب", callback_data="BUY_CONFIRM") , InlineKeyboardButton("❌ إلغاء الطلب", callback_data="BUY_CANCEL")],
-            [InlineKeyboardButton("✏️ تغيير الكمية/تغيير الرقم", callback_data="CHANGE_QTY")]
-        ])
+@callback("ADM_PRODS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_prods(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the products menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة المنتجات:", reply_markup=prods_menu_kb())
 
-        msg_text = (f"❓هل أنت متأكد من معلومات الطلب\n"
-                    f"• المنتج: {prow['name']}\n"
-                    f"• الكمية: {quantity}\n"
-                    f"• السعر الإجمالي: {money(total_price)}\n"
-                    f"• الآيدي/الهاتف: {contact}\n"
-                    f"• الرصيد قبل: {money(current_balance)}\n"
-                    f"• الرصيد بعد: {money(new_balance)}\n")
+@callback("PROD_ADD", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks which type of product to add."""
+    q = update.callback_query
+    context.user_data.clear()
+    kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("منتج عادي", callback_data="ADD_PROD_REGULAR"), InlineKeyboardButton("منتج بكمية", callback_data="ADD_PROD_QUANTITY")],
+        [InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]
+    ])
+    await q.message.edit_text("ما نوع المنتج الذي تريد إضافته؟", reply_markup=kb)
 
-        msg = await update.message.reply_text(msg_text, reply_markup=kb, parse_mode=ParseMode.HTML)
-        context.user_data["confirm_msg_id"] = msg.message_id
-        context.user_data["flow"] = None
+@callback("ADD_PROD_REGULAR", admin=ADMIN_PANEL_DENIED)
+async def cb_add_prod_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories to add a regular product to."""
+    q = update.callback_query
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]]))
         return
+    await q.message.edit_text("اختر قائمة لإضافة المنتج العادي إليها:", reply_markup=catalog_kb(snapshot, "prod_add_regular"))
 
-# -----------------------------------------------------------------------------
-# Group Action Buttons (Admin Only) Handlers
-# These handle actions taken by admins in the top-up/order groups.
-# -----------------------------------------------------------------------------
+@callback("ADD_PROD_QUANTITY", admin=ADMIN_PANEL_DENIED)
+async def cb_add_prod_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories to add a quantity product to."""
+    q = update.callback_query
+    snapshot = await catalog()
+    cats = snapshot.categories_under(None)
+    if not cats:
+        await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]]))
+        return
+    await q.message.edit_text("اختر قائمة لإضافة المنتج بكمية إليها:", reply_markup=catalog_kb(snapshot, "prod_add_quantity"))
 
-async def on_group_actions(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles admin actions on top-up and order requests."""
+@callback("PROD_ADD_REGULAR_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_add_regular_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int):
+    """Picks the category of a new regular product."""
     q = update.callback_query
-    await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("هذا الإجراء للأدمن فقط.")
-        return
-
-    data = q.data
-    actor_id = q.from_user.id
-
-    if data.startswith("TP_ACCEPT:") or data.startswith("TP_REJECT:"):
-        tid = int(data.split(":", 1)[1])
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM topups WHERE id=?", (tid,))
-        row = cur.fetchone()
-        if not row:
-            await q.message.reply_text("لم يتم العثور على هذا الطلب.")
-            conn.close()
-            return
-        if row["status"] != "pending":
-            await q.message.edit_text("تمت معالجته مسبقًا.")
-            conn.close()
-            return
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cat_id)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لإضافة المنتج إليها:", reply_markup=catalog_kb(snapshot, "prod_add_regular_sub", cat_id))
+    else:
+        context.user_data["cid"] = cat_id
+        context.user_data["flow"] = "adm_prod_add_name"
+        await q.message.reply_text("أرسل اسم المنتج العادي الجديد:")
 
-        if data.startswith("TP_ACCEPT"):
-            new_bal = change_balance(row["user_id"], float(row["amount"]))
-            cur.execute("UPDATE topups SET status='approved' WHERE id=?", (tid,))
-            conn.commit()
-            conn.close()
-            new_text = q.message.text + "\n\n✅ **تم قبول الشحن**"
-            try:
-                await q.message.edit_text(new_text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
-            except Exception:
-                pass
-            try:
-                await context.bot.send_message(row["user_id"],f"✅ تم شحن حسابك بمبلغ {money(row['amount'])}. رصيدك الحالي: {money(new_bal)}")
-            except Exception:
-                pass
-            return
-        else:
-            cur.execute("UPDATE topups SET status='rejected' WHERE id=?", (tid,))
-            conn.commit()
-            conn.close()
-            new_text = q.message.text + "\n\n❌ **تم رفض الشحن**"
-            try:
-                await q.message.edit_text(new_text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
-            except Exception:
-                pass
-            try:
-                await context.bot.send_message(row["user_id"], "❌ تم رفض طلب الشحن.")
-            except Exception:
-                pass
+@callback("PROD_ADD_QUANTITY_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_add_quantity_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cat_id: int):
+    """Picks the category of a new quantity product."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cat_id)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لإضافة المنتج إليها:", reply_markup=catalog_kb(snapshot, "prod_add_quantity_sub", cat_id))
+    else:
+        context.user_data["cid"] = cat_id
+        context.user_data["flow"] = "adm_prod_add_quantity_name"
+        await q.message.reply_text("أرسل اسم المنتج بكمية الجديد:")
+
+@callback("PROD_EDIT_NAME_LIST", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_edit_name_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories whose products can be renamed."""
+    await show_admin_categories_for_edit(update, context, "prod_rename_root")
+
+@callback("EDIT_PROD_NAME_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_edit_prod_name_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Lists a category's products to rename."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cid)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=catalog_kb(snapshot, "prod_rename_sub", cid))
+    else:
+        prods = snapshot.products_in(cid)
+        if not prods:
+            await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_NAME_LIST")]]))
             return
+        await q.message.edit_text("اختر منتجاً لتعديل اسمه:", reply_markup=catalog_kb(snapshot, "prod_rename", cid))
 
-    if data.startswith("ORD_ACCEPT:") or data.startswith("ORD_REJECT:"):
-        oid = int(data.split(":", 1)[1])
-        conn = sqlite3.connect(DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM orders WHERE id=?", (oid,))
-        row = cur.fetchone()
-        if not row:
-            await q.message.reply_text("لم يتم العثور على الطلب.")
-            conn.close()
-            return
-        if row["status"] != "pending":
-            await q.message.edit_text("تمت معالجته مسبقًا.")
-            conn.close()
+@callback("PROD_EDIT_NAME", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    """Asks for a product's new name."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_prod_rename"
+    context.user_data["pid"] = pid
+    await q.message.reply_text("أرسل الاسم الجديد للمنتج:")
+
+@callback("PROD_EDIT_PRICE_LIST", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_edit_price_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories whose products can be repriced."""
+    await show_admin_categories_for_edit(update, context, "prod_reprice_root")
+
+@callback("EDIT_PROD_PRICE_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_edit_prod_price_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Lists a category's products to reprice."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cid)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=catalog_kb(snapshot, "prod_reprice_sub", cid))
+    else:
+        prods = snapshot.products_in(cid)
+        if not prods:
+            await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_PRICE_LIST")]]))
             return
+        await q.message.edit_text("اختر منتجاً لتعديل سعره:", reply_markup=catalog_kb(snapshot, "prod_reprice", cid))
 
-        if data.startswith("ORD_ACCEPT"):
-            cur.execute("UPDATE orders SET status='approved' WHERE id=?", (oid,))
-            conn.commit()
-            conn.close()
-            new_text = q.message.text + "\n\n✅ **تم قبول الطلب**"
-            try:
-                await q.message.edit_text(new_text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
-            except Exception:
-                pass
-            try:
-                await context.bot.send_message(row["user_id"], "✅ تم تنفيذ طلبك.")
-            except Exception:
-                pass
+@callback("PROD_REPRICE", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_reprice(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    """Asks for a product's new price."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_prod_reprice"
+    context.user_data["pid"] = pid
+    await q.message.reply_text("أرسل السعر الجديد للمنتج (رقماً):")
+
+@callback("REPRICE_APPLY", admin=ADMIN_PANEL_DENIED)
+async def cb_reprice_apply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Applies the bulk price change previewed by /reprice."""
+    q = update.callback_query
+    pending = context.user_data.pop("reprice", None)
+    if not pending:
+        await q.message.edit_text("⛔ انتهت صلاحية هذا الطلب، أعد إرسال الأمر.")
+        return
+    count = await run_db(apply_reprice, *pending)
+    if count is None:
+        await q.message.edit_text(q.message.text + f"\n\n{REPRICE_NOT_POSITIVE}")
+        return
+    await q.message.edit_text(q.message.text + f"\n\n✅ تم تعديل أسعار {count} منتج.")
+
+@callback("REPRICE_CANCEL", admin=ADMIN_PANEL_DENIED)
+async def cb_reprice_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Discards the bulk price change previewed by /reprice."""
+    q = update.callback_query
+    context.user_data.pop("reprice", None)
+    await q.message.edit_text("تم إلغاء تعديل الأسعار.")
+
+@callback("PROD_DEL_LIST", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_del_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories whose products can be deleted."""
+    await show_admin_categories_for_edit(update, context, "prod_del_root")
+
+@callback("DEL_PROD_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_del_prod_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Lists a category's products to delete."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cid)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=catalog_kb(snapshot, "prod_del_sub", cid))
+    else:
+        prods = snapshot.products_in(cid)
+        if not prods:
+            await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_DEL_LIST")]]))
             return
-        else:
-            change_balance(row["user_id"], float(row["price"]))
-            cur.execute("UPDATE orders SET status='rejected' WHERE id=?", (oid,))
-            conn.commit()
-            conn.close()
-            new_text = q.message.text + "\n\n❌ **تم رفض الطلب**"
-            try:
-                await q.message.edit_text(new_text, parse_mode=ParseMode.MARKDOWN, reply_markup=None)
-            except Exception:
-                pass
-            try:
-                await context.bot.send_message(row["user_id"], "❌ تم رفض طلبك وتم إرجاع الرصيد.")
-            except Exception:
-                pass
+        await q.message.edit_text("اختر منتجاً لحذفه:", reply_markup=catalog_kb(snapshot, "prod_del", cid))
+
+@callback("PROD_DEL", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_del(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    """Deletes a product."""
+    q = update.callback_query
+    try:
+        await run_db(delete_product, pid)
+    except sqlite3.IntegrityError:
+        await q.message.reply_text("⛔ لا يمكن حذف هذا المنتج لأنه مرتبط بطلبات سابقة.")
+        return
+    await q.message.reply_text("✅ تم حذف المنتج بنجاح.")
+
+@callback("PROD_MOVE_LIST", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_move_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Lists categories whose products can be moved."""
+    await show_admin_categories_for_edit(update, context, "prod_move_root")
+
+@callback("MOVE_PROD_CAT", int, admin=ADMIN_PANEL_DENIED)
+async def cb_move_prod_cat(update: Update, context: ContextTypes.DEFAULT_TYPE, cid: int):
+    """Lists a category's products to move."""
+    q = update.callback_query
+    snapshot = await catalog()
+    sub_cats = snapshot.categories_under(cid)
+    if sub_cats:
+        await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=catalog_kb(snapshot, "prod_move_sub", cid))
+    else:
+        prods = snapshot.products_in(cid)
+        if not prods:
+            await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_MOVE_LIST")]]))
             return
+        await q.message.edit_text("اختر منتجاً لنقله:", reply_markup=catalog_kb(snapshot, "prod_move", cid))
 
-# -----------------------------------------------------------------------------
-# Admin Menu Callback Handlers
-# These functions handle all button clicks within the admin panel.
-# -----------------------------------------------------------------------------
+@callback("PROD_MOVE", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_move(update: Update, context: ContextTypes.DEFAULT_TYPE, pid: int):
+    """Lists the categories a product can move to."""
+    context.user_data["pid"] = pid
+    await show_admin_categories_for_edit(update, context, "prod_move_target")
 
-async def on_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles admin menu button callbacks."""
+@callback("PROD_MOVE_TARGET", int, admin=ADMIN_PANEL_DENIED)
+async def cb_prod_move_target(update: Update, context: ContextTypes.DEFAULT_TYPE, target_cid: int):
+    """Moves the selected product to a category."""
     q = update.callback_query
-    await q.answer()
-    if not is_admin(q.from_user.id):
-        await q.message.reply_text("لوحة الأدمن: الوصول مرفوض.")
-        return
-    data = q.data
+    pid = context.user_data.get("pid")
+    await run_db(move_product, pid, target_cid)
+    await q.message.edit_text("✅ تم نقل المنتج بنجاح.")
+    del context.user_data["pid"]
+
+@callback("ADM_USERS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the users menu."""
+    q = update.callback_query
+    await q.message.edit_text("إدارة المستخدمين:", reply_markup=users_menu_kb())
 
-    if data == "ADM_BACK":
-        await q.message.edit_text("أهلاً بك أيها المدير! اختر من القائمة:", reply_markup=admin_menu_kb())
-        return
+@callback("USR_CREDIT", admin=ADMIN_PANEL_DENIED)
+async def cb_usr_credit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Starts crediting a user's balance."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_usr_credit_id"
+    await q.message.reply_text("أرسل آيدي المستخدم المراد شحنه:")
 
-    if data == "ADM_CATS":
-        await q.message.edit_text("إدارة القوائم:", reply_markup=cats_menu_kb())
-        return
+@callback("USR_DEBIT", admin=ADMIN_PANEL_DENIED)
+async def cb_usr_debit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Starts debiting a user's balance."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_usr_debit_id"
+    await q.message.reply_text("أرسل آيدي المستخدم المراد سحب الرصيد منه:")
 
-    if data == "ADM_BACK_CATS":
-        await q.message.edit_text("إدارة القوائم:", reply_markup=cats_menu_kb())
-        return
+@callback("ADM_SETTINGS", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Shows the settings menu."""
+    q = update.callback_query
+    await q.message.edit_text("إعدادات البوت:", reply_markup=settings_menu_kb())
 
-    if data == "ADM_MAIN_CATS":
-        await q.message.edit_text("إدارة القوائم الرئيسية:", reply_markup=main_cats_kb())
-        return
+@callback("SET_SUPPORT", admin=ADMIN_PANEL_DENIED)
+async def cb_set_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the support username."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_support"
+    await q.message.reply_text("أرسل يوزر الدعم (بدون @):")
 
-    if data == "ADM_SUB_CATS":
-        await q.message.edit_text("إدارة القوائم الفرعية:", reply_markup=sub_cats_kb())
-        return
+@callback("SET_SHAM_CODE", admin=ADMIN_PANEL_DENIED)
+async def cb_set_sham_code(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the Sham Cash code."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_sham_code"
+    await q.message.reply_text("أرسل صورة كود شام كاش:")
 
-    if data == "CAT_ADD_MAIN":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_cat_add"
-        await q.message.reply_text("أرسل اسم القائمة الرئيسية الجديدة:")
-        return
+@callback("SET_SHAM_ADDR", admin=ADMIN_PANEL_DENIED)
+async def cb_set_sham_addr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the Sham Cash address."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_sham_addr"
+    await q.message.reply_text("أرسل عنوان شام كاش:")
 
-    if data == "CAT_EDIT_MAIN":
-        cats = get_categories(parent_id=None)
-        if not cats:
-            await q.message.reply_text("لا توجد قوائم رئيسية لتعديلها.")
-            return
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"✏️ {cats[i]['name']}", callback_data=f"CAT_EDIT:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"✏️ {cats[i+1]['name']}", callback_data=f"CAT_EDIT:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة لتعديل اسمها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "EDIT_SUPPORT_MESSAGE":
-        context.user_data["flow"] = "adm_edit_support_message"
-        await q.message.edit_text("أرسل رسالة الدعم الجديدة الآن.")
-        await q.answer()
-        return
+@callback("SET_GROUP_TOPUP", admin=ADMIN_PANEL_DENIED)
+async def cb_set_group_topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the top-up group ID."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_group_topup"
+    await q.message.reply_text("أرسل آيدي مجموعة الشحن:")
 
-    if data == "CAT_DEL_MAIN":
-        cats = get_categories(parent_id=None)
-        if not cats:
-            await q.message.reply_text("لا توجد قوائم رئيسية لحذفها.")
-            return
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"🗑️ {cats[i]['name']}", callback_data=f"CAT_DEL:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"🗑️ {cats[i+1]['name']}", callback_data=f"CAT_DEL:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة لحذفها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "EDIT_SUPPORT_MESSAGE":
-        context.user_data["flow"] = "adm_edit_support_message"
-        await q.message.edit_text("أرسل رسالة الدعم الجديدة الآن. يمكنك استخدام تنسيق HTML (مثل <b> لخط عريض).")
-        await q.answer()
+@callback("SET_GROUP_ORDERS", admin=ADMIN_PANEL_DENIED)
+async def cb_set_group_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the orders group ID."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_group_orders"
+    await q.message.reply_text("أرسل آيدي مجموعة الطلبات:")
+
+@callback("SET_ADMINS", admin=ADMIN_PANEL_DENIED)
+async def cb_set_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the administrator IDs."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_set_admins"
+    await q.message.reply_text("أرسل آيديات الأدمن مفصولة بفاصلة (,):")
+
+@callback("ADM_BCAST_SEG", str, admin=ADMIN_PANEL_DENIED)
+async def cb_adm_bcast_seg(update: Update, context: ContextTypes.DEFAULT_TYPE, segment: str):
+    """Starts the pending broadcast to the chosen segment."""
+    q = update.callback_query
+    message_text = context.user_data.pop("broadcast_text", None)
+    if not message_text or segment not in BROADCAST_SEGMENTS:
+        await q.message.edit_text("⛔ انتهت صلاحية هذا الطلب، أعد إرسال الرسالة.")
         return
+    await q.message.edit_text("📣 جاري بدء الإرسال...")
+    broadcast_id = await run_db(create_broadcast, message_text, q.message.chat_id, q.message.message_id, segment)
+    schedule_broadcast(context.application, broadcast_id)
 
-    if data == "CAT_ADD_SUB":
-        context.user_data.clear()
-        cats = get_categories(parent_id=None)
-        if not cats:
-            await q.message.reply_text("لا توجد قوائم رئيسية لإضافة قائمة فرعية إليها.")
-            return
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"{cats[i]['name']}", callback_data=f"CAT_LIST_ADD_SUB:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"{cats[i+1]['name']}", callback_data=f"CAT_LIST_ADD_SUB:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة رئيسية لإضافة قائمة فرعية إليها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "CAT_EDIT_SUB":
-        sub_cats = get_categories_with_parent()
-        if not sub_cats:
-            await q.message.reply_text("لا توجد قوائم فرعية لتعديلها.")
-            return
-        rows = []
-        for i in range(0, len(sub_cats), 2):
-            row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"CAT_EDIT:{sub_cats[i]['id']}")]
-            if i + 1 < len(sub_cats):
-                row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"CAT_EDIT:{sub_cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة فرعية لتعديل اسمها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "CAT_DEL_SUB":
-        sub_cats = get_categories_with_parent()
-        if not sub_cats:
-            await q.message.reply_text("لا توجد قوائم فرعية لحذفها.")
-            return
-        rows = []
-        for i in range(0, len(sub_cats), 2):
-            row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"CAT_DEL:{sub_cats[i]['id']}")]
-            if i + 1 < len(sub_cats):
-                row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"CAT_DEL:{sub_cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة فرعية لحذفها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "CAT_MOVE_SUB":
-        sub_cats = get_categories_with_parent()
-        if not sub_cats:
-            await q.message.reply_text("لا توجد قوائم فرعية لنقلها.")
-            return
-        rows = []
-        for i in range(0, len(sub_cats), 2):
-            row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"CAT_MOVE:{sub_cats[i]['id']}")]
-            if i + 1 < len(sub_cats):
-                row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"CAT_MOVE:{sub_cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر قائمة فرعية لنقلها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data.startswith("CAT_MOVE:"):
-        cid = int(data.split(":", 1)[1])
-        context.user_data["flow"] = "adm_cat_move_sub_target"
-        context.user_data["cid"] = cid
-        cats = get_categories(parent_id=None)
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"{cats[i]['name']}", callback_data=f"TARGET_CAT:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"{cats[i+1]['name']}", callback_data=f"TARGET_CAT:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK_CATS")])
-        await q.message.reply_text("اختر القائمة الرئيسية الجديدة:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data.startswith("TARGET_CAT:"):
-        target_id = int(data.split(":", 1)[1])
-        cid = context.user_data.get("cid")
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("UPDATE categories SET parent_id=? WHERE id=?", (target_id, cid))
-        conn.commit()
-        conn.close()
-        await q.message.reply_text("✅ تم نقل القائمة الفرعية بنجاح.")
-        del context.user_data["flow"]
-        del context.user_data["cid"]
+@callback("ADM_BROADCAST", admin=ADMIN_PANEL_DENIED)
+async def cb_adm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the message to broadcast."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_broadcast"
+    await q.message.reply_text("أرسل الرسالة التي تريد إرسالها لجميع المستخدمين.")
+
+@callback("ADM_PAGE", str, int, int, admin=ADMIN_PANEL_DENIED)
+async def cb_adm_page(update: Update, context: ContextTypes.DEFAULT_TYPE, view: str, cat_id: int, start_id: int):
+    """Shows another page of an admin listing."""
+    if view in CATALOG_VIEWS:
+        await show_catalog_page(update, view, cat_id, start_id)
+
+async def show_admin_categories_for_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, view: str):
+    """A helper function to display categories for admin editing purposes."""
+    q = update.callback_query
+    snapshot = await catalog()
+    if not snapshot.categories_under(None):
+        await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_PRODS")]]))
         return
+    await q.message.edit_text("اختر قائمة:", reply_markup=catalog_kb(snapshot, view))
 
-    if data == "EDIT_NEWS":
-        kb = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]])
-        context.user_data["flow"] = "adm_edit_news"
-        await q.message.edit_text("أرسل رسالة الأخبار الجديدة الآن.", reply_markup=kb)
-        await q.answer()
+# -----------------------------------------------------------------------------
+# Catalog Import and Export
+# Admins upload a CSV or JSON Lines file (see CATALOG_FIELDS). The file is first
+# compared against the catalog and the differences are reported; nothing is
+# written until the admin confirms, at which point the file is downloaded again
+# and applied in a single transaction.
+# -----------------------------------------------------------------------------
+
+CATALOG_IMPORT_TIMEOUT = 120.0      # seconds allowed for planning or applying an import
+CATALOG_IMPORT_MAX_BYTES = 20 * 1024 * 1024  # largest file the Bot API lets bots download
+CATALOG_REPORT_LINES = 15           # changed products and errors listed in a report
+
+def catalog_import_report(plan: CatalogImportPlan, applied: bool) -> str:
+    """Summarizes an import plan, listing the first changes and errors."""
+    lines = ["✅ تم الاستيراد:" if applied else "📋 معاينة الاستيراد (لم يتم حفظ أي شيء بعد):",
+             f"• أقسام جديدة: {len(plan.new_categories)}",
+             f"• منتجات جديدة: {len(plan.inserts)}",
+             f"• منتجات معدلة: {len(plan.updates)}",
+             f"• بدون تغيير: {plan.unchanged}",
+             f"• أسطر مرفوضة: {len(plan.errors)}"]
+    for cat_path in plan.new_categories[:CATALOG_REPORT_LINES]:
+        lines.append(f"📂 {CATALOG_PATH_SEPARATOR.join(cat_path)}")
+    for cat_path, values in plan.inserts[:CATALOG_REPORT_LINES]:
+        lines.append(f"➕ {values[0]} ({money(values[1])})")
+    for _, values, changed in plan.updates[:CATALOG_REPORT_LINES]:
+        lines.append(f"✏️ {values[0]}: {', '.join(changed)}")
+    for line_num, reason in plan.errors[:CATALOG_REPORT_LINES]:
+        lines.append(f"⚠️ السطر {line_num}: {reason}")
+    return "\n".join(lines)
+
+async def download_catalog_file(context: ContextTypes.DEFAULT_TYPE, file_id: str, fmt: str) -> str:
+    """Downloads an uploaded catalog file to a temporary path."""
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    file = await context.bot.get_file(file_id)
+    await file.download_to_drive(path)
+    return path
+
+async def on_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Receives a catalog file from an admin who started an import."""
+    if context.user_data.get("flow") != "adm_import" or not is_admin(update.effective_user.id):
+        return
+    document = update.message.document
+    fmt = (document.file_name or "").rsplit(".", 1)[-1].lower()
+    if fmt not in CATALOG_FORMATS:
+        await update.message.reply_text("أرسل ملفاً بصيغة CSV أو JSONL.")
+        return
+    if document.file_size and document.file_size > CATALOG_IMPORT_MAX_BYTES:
+        await update.message.reply_text("الملف أكبر من الحد المسموح (20 ميغابايت).")
         return
 
-    if data.startswith("CAT_LIST_ADD_SUB:"):
-        parent_id = int(data.split(":", 1)[1])
-        context.user_data["flow"] = "adm_cat_add_sub_name"
-        context.user_data["parent_id"] = parent_id
-        await q.message.reply_text("أرسل اسم القائمة الفرعية الجديدة:")
+    path = await download_catalog_file(context, document.file_id, fmt)
+    try:
+        plan = await run_db(plan_catalog_import, path, fmt, timeout=CATALOG_IMPORT_TIMEOUT)
+    except CatalogImportError as e:
+        await update.message.reply_text(f"⛔ {e}")
         return
+    finally:
+        os.remove(path)
 
-    if data.startswith("CAT_EDIT:"):
-        cid = int(data.split(":", 1)[1])
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_cat_rename"
-        context.user_data["cid"] = cid
-        await q.message.reply_text("أرسل الاسم الجديد للقائمة:")
+    context.user_data["flow"] = None
+    if not plan.new_categories and not plan.inserts and not plan.updates:
+        await update.message.reply_text(catalog_import_report(plan, applied=False) + "\n\nلا توجد تغييرات لتطبيقها.")
         return
+    context.user_data["import_file"] = [document.file_id, fmt]
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton("✅ تطبيق", callback_data="IMPORT_APPLY"),
+                                InlineKeyboardButton("❌ إلغاء", callback_data="IMPORT_CANCEL")]])
+    await update.message.reply_text(catalog_import_report(plan, applied=False), reply_markup=kb)
+
+@callback("PROD_IMPORT", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_import(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks for the catalog file to import."""
+    q = update.callback_query
+    context.user_data.clear()
+    context.user_data["flow"] = "adm_import"
+    await q.message.reply_text(
+        "أرسل ملف المنتجات بصيغة CSV أو JSONL.\n"
+        f"الأعمدة: {', '.join(CATALOG_FIELDS)}\n"
+        f"القسم يكتب كمسار، مثلاً: ألعاب{CATALOG_PATH_SEPARATOR}ببجي\n"
+        f"إذا احتوى اسم القسم على {CATALOG_PATH_SEPARATOR.strip()} أو {CATALOG_PATH_ESCAPE} فاكتب قبله {CATALOG_PATH_ESCAPE}\n"
+        "النوع regular أو quantity، والمخزون الفارغ يعني كمية غير محدودة.\n"
+        "سيتم عرض معاينة للتغييرات قبل حفظها."
+    )
 
-    if data.startswith("CAT_DEL:"):
-        cid = int(data.split(":", 1)[1])
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM categories WHERE id=?", (cid,))
-        conn.commit()
-        conn.close()
-        await q.message.edit_text("✅ تم حذف القائمة بنجاح.", reply_markup=None)
+@callback("IMPORT_APPLY", admin=ADMIN_PANEL_DENIED)
+async def cb_import_apply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Applies the previewed catalog import."""
+    q = update.callback_query
+    pending = context.user_data.pop("import_file", None)
+    if not pending:
+        await q.message.edit_text("⛔ انتهت صلاحية هذا الطلب، أعد إرسال الملف.")
         return
+    file_id, fmt = pending
+    await q.message.edit_reply_markup(reply_markup=None)
+    path = await download_catalog_file(context, file_id, fmt)
+    try:
+        plan = await run_db(apply_catalog_import, path, fmt, timeout=CATALOG_IMPORT_TIMEOUT)
+    except CatalogImportError as e:
+        await q.message.reply_text(f"⛔ {e}")
+        return
+    finally:
+        os.remove(path)
+    await q.message.reply_text(catalog_import_report(plan, applied=True))
+
+@callback("IMPORT_CANCEL", admin=ADMIN_PANEL_DENIED)
+async def cb_import_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Discards the previewed catalog import."""
+    q = update.callback_query
+    context.user_data.pop("import_file", None)
+    await q.message.edit_text("تم إلغاء الاستيراد.")
 
-    # Product Management
-    if data == "ADM_PRODS":
-        await q.message.edit_text("إدارة المنتجات:", reply_markup=prods_menu_kb())
+@callback("PROD_EXPORT", admin=ADMIN_PANEL_DENIED)
+async def cb_prod_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Asks which format to export the catalog in."""
+    q = update.callback_query
+    kb = InlineKeyboardMarkup([[InlineKeyboardButton(fmt.upper(), callback_data=encode_callback("EXPORT_FORMAT", fmt))
+                                for fmt in CATALOG_FORMATS],
+                               [InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_PRODS")]])
+    await q.message.edit_text("اختر صيغة ملف التصدير:", reply_markup=kb)
+
+@callback("EXPORT_FORMAT", str, admin=ADMIN_PANEL_DENIED)
+async def cb_export_format(update: Update, context: ContextTypes.DEFAULT_TYPE, fmt: str):
+    """Sends the whole catalog as a document in the chosen format."""
+    q = update.callback_query
+    if fmt not in CATALOG_FORMATS:
         return
+    path = await run_db(export_catalog, fmt, timeout=CATALOG_IMPORT_TIMEOUT)
+    try:
+        with open(path, "rb") as f:
+            await q.message.chat.send_document(f, filename=f"catalog.{fmt}")
+    finally:
+        os.remove(path)
 
-    if data == "PROD_ADD":
-        context.user_data.clear()
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("منتج عادي", callback_data="ADD_PROD_REGULAR"), InlineKeyboardButton("منتج بكمية", callback_data="ADD_PROD_QUANTITY")],
-            [InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]
-        ])
-        await q.message.edit_text("ما نوع المنتج الذي تريد إضافته؟", reply_markup=kb)
+# -----------------------------------------------------------------------------
+# Broadcast Engine
+# Broadcasts run as background jobs, so the admin's handler returns immediately.
+# Users are processed in batches in user_id order. A bounded number of sends run
+# concurrently, paced by a global token bucket, and progress is checkpointed
+# after every batch so that a restarted bot resumes where it stopped.
+# -----------------------------------------------------------------------------
+
+BROADCAST_CONCURRENCY = 8        # messages in flight at once
+BROADCAST_RATE = 25.0            # messages per second across all broadcasts (Telegram allows ~30)
+BROADCAST_BATCH = 200            # users per checkpoint
+BROADCAST_MAX_RETRIES = 3        # RetryAfter retries per message
+BROADCAST_PROGRESS_INTERVAL = 5  # seconds between progress edits
+
+class TokenBucket:
+    """An asyncio token bucket; acquire() waits until a token is available."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Stops handing out tokens for `seconds` (e.g. after a RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        """Takes one token, sleeping until one is available."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+def broadcast_progress_text(row: sqlite3.Row, sent: int, failed: int, done: bool) -> str:
+    """Builds the admin's live progress message for a broadcast."""
+    head = "✅ تم إرسال الرسالة بنجاح." if done else "📣 جاري إرسال الرسالة..."
+    return (f"{head}\n\n"
+            f"عدد الرسائل المرسلة: {sent}\n"
+            f"عدد المستخدمين المحظورين: {failed}\n"
+            f"إجمالي المستخدمين: {row['total']}")
+
+# Delivery outcomes of send_broadcast_message().
+DELIVERED, UNREACHABLE, FAILED = "delivered", "unreachable", "failed"
+
+async def send_broadcast_message(bot, user_id: int, text: str) -> str:
+    """Sends one broadcast message, honoring RetryAfter, and returns its delivery outcome.
+
+    Blocked bots, deactivated accounts and unknown chats are UNREACHABLE; any
+    other error is a transient FAILED that does not change the user's flag.
+    """
+    for _ in range(BROADCAST_MAX_RETRIES + 1):
+        await broadcast_bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return DELIVERED
+        except RetryAfter as e:
+            delay = e.retry_after
+            broadcast_bucket.pause(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+        except Forbidden:
+            return UNREACHABLE
+        except BadRequest as e:
+            return UNREACHABLE if "chat not found" in str(e).lower() else FAILED
+        except Exception:
+            return FAILED
+    return FAILED
+
+async def broadcast_job(context: ContextTypes.DEFAULT_TYPE):
+    """Runs (or resumes) one broadcast until every user has been handled."""
+    broadcast_id = context.job.data
+    row = await run_db(get_broadcast, broadcast_id)
+    if row is None or row['status'] != 'running':
         return
+    bot = context.bot
+    last_user_id, sent, failed = row['last_user_id'], row['sent'], row['failed']
+    slots = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_report = 0.0
 
-    if data == "ADD_PROD_REGULAR":
-        cats = get_categories(parent_id=None)
-        if not cats:
-            await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]]))
-            return
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"{cats[i]['name']}", callback_data=f"PROD_ADD_REGULAR_CAT:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"{cats[i+1]['name']}", callback_data=f"PROD_ADD_REGULAR_CAT:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_ADD")])
-        await q.message.edit_text("اختر قائمة لإضافة المنتج العادي إليها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data == "ADD_PROD_QUANTITY":
-        cats = get_categories(parent_id=None)
-        if not cats:
-            await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_BACK")]]))
+    async def send(user_id: int) -> str:
+        async with slots:
+            return await send_broadcast_message(bot, user_id, row['text'])
+
+    async def report(done: bool = False):
+        if not row['status_message_id']:
             return
-        rows = []
-        for i in range(0, len(cats), 2):
-            row = [InlineKeyboardButton(f"{cats[i]['name']}", callback_data=f"PROD_ADD_QUANTITY_CAT:{cats[i]['id']}")]
-            if i + 1 < len(cats):
-                row.append(InlineKeyboardButton(f"{cats[i+1]['name']}", callback_data=f"PROD_ADD_QUANTITY_CAT:{cats[i+1]['id']}"))
-            rows.append(row)
-        rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_ADD")])
-        await q.message.edit_text("اختر قائمة لإضافة المنتج بكمية إليها:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data.startswith("PROD_ADD_REGULAR_CAT:"):
-        cat_id = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cat_id)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"PROD_ADD_REGULAR_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"PROD_ADD_REGULAR_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADD_PROD_REGULAR")])
-            await q.message.edit_text("اختر قائمة فرعية لإضافة المنتج إليها:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            context.user_data["cid"] = cat_id
-            context.user_data["flow"] = "adm_prod_add_name"
-            await q.message.reply_text("أرسل اسم المنتج العادي الجديد:")
+        try:
+            await bot.edit_message_text(broadcast_progress_text(row, sent, failed, done),
+                                        chat_id=row['admin_chat_id'], message_id=row['status_message_id'])
+        except Exception as e:
+            logger.warning(f"Failed to update broadcast {broadcast_id} progress: {e}")
+
+    while True:
+        user_ids = await run_db(get_segment_user_ids, row['segment'], row['segment_since'],
+                                last_user_id, BROADCAST_BATCH)
+        if not user_ids:
+            break
+        results = await asyncio.gather(*(send(uid) for uid in user_ids))
+        delivered = [uid for uid, res in zip(user_ids, results) if res == DELIVERED]
+        unreachable = [uid for uid, res in zip(user_ids, results) if res == UNREACHABLE]
+        sent += len(delivered)
+        failed += len(user_ids) - len(delivered)
+        last_user_id = user_ids[-1]
+        await run_db(checkpoint_broadcast, broadcast_id, last_user_id, sent, failed, False,
+                     delivered, unreachable)
+        if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            await report()
+
+    await run_db(checkpoint_broadcast, broadcast_id, last_user_id, sent, failed, True)
+    await report(done=True)
+
+def schedule_broadcast(application, broadcast_id: int):
+    """Starts a broadcast on the application's job queue."""
+    application.job_queue.run_once(broadcast_job, 0, data=broadcast_id, name=f"broadcast:{broadcast_id}")
+
+LAST_SEEN_RESOLUTION = 15 * 60  # seconds; last_seen is written at most this often per user
+_last_seen_written: dict[int, float] = {}  # user id -> last write, only for writes within the resolution
+_last_seen_pruned = 0.0
+
+def prune_last_seen(now: float):
+    """Forgets the writes older than LAST_SEEN_RESOLUTION, at most once per resolution period."""
+    global _last_seen_pruned
+    if now - _last_seen_pruned < LAST_SEEN_RESOLUTION:
         return
-
-    if data.startswith("PROD_ADD_QUANTITY_CAT:"):
-        cat_id = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cat_id)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"PROD_ADD_QUANTITY_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"PROD_ADD_QUANTITY_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADD_PROD_QUANTITY")])
-            await q.message.edit_text("اختر قائمة فرعية لإضافة المنتج إليها:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            context.user_data["cid"] = cat_id
-            context.user_data["flow"] = "adm_prod_add_quantity_name"
-            await q.message.reply_text("أرسل اسم المنتج بكمية الجديد:")
+    _last_seen_pruned = now
+    for user_id in [uid for uid, at in _last_seen_written.items() if now - at >= LAST_SEEN_RESOLUTION]:
+        del _last_seen_written[user_id]
+
+async def track_last_seen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Updates the sender's last-seen time (and reachability) for private-chat updates."""
+    user, chat = update.effective_user, update.effective_chat
+    if user is None or chat is None or chat.type != ChatType.PRIVATE:
         return
-
-    if data == "PROD_EDIT_NAME_LIST":
-        await show_admin_categories_for_edit(update, context, "edit_prod_name")
+    now = time.time()
+    prune_last_seen(now)
+    if now - _last_seen_written.get(user.id, 0) < LAST_SEEN_RESOLUTION:
         return
+    _last_seen_written[user.id] = now
+    await run_db(mark_seen, user, int(now))
 
-    if data.startswith("EDIT_PROD_NAME_CAT:"):
-        cid = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cid)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"EDIT_PROD_NAME_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"EDIT_PROD_NAME_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_NAME_LIST")])
-            await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            prods = get_products_by_cat(cid)
-            if not prods:
-                await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_NAME_LIST")]]))
-                return
-            rows = []
-            for i in range(0, len(prods), 2):
-                row = [InlineKeyboardButton(f"{prods[i]['name']}", callback_data=f"PROD_EDIT_NAME:{prods[i]['id']}")]
-                if i + 1 < len(prods):
-                    row.append(InlineKeyboardButton(f"{prods[i+1]['name']}", callback_data=f"PROD_EDIT_NAME:{prods[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_NAME_LIST")])
-            await q.message.edit_text("اختر منتجاً لتعديل اسمه:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data.startswith("PROD_EDIT_NAME:"):
-        pid = int(data.split(":", 1)[1])
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_prod_rename"
-        context.user_data["pid"] = pid
-        await q.message.reply_text("أرسل الاسم الجديد للمنتج:")
-        return
+async def on_startup(app):
+    """Resumes the broadcasts that were interrupted by a restart and starts the metrics endpoint and outbox worker."""
+    await start_metrics_server(app)
+    start_outbox_worker(app.bot)
+    for broadcast_id in await run_db(get_running_broadcast_ids):
+        logger.info("Resuming broadcast %d", broadcast_id)
+        schedule_broadcast(app, broadcast_id)
 
-    if data == "PROD_EDIT_PRICE_LIST":
-        await show_admin_categories_for_edit(update, context, "edit_prod_price")
-        return
+# -----------------------------------------------------------------------------
+# Admin Group Notifier
+# New orders and top-ups are posted to the admin groups one message each while
+# traffic is low. Once a group has received GROUP_DIGEST_THRESHOLD messages in
+# the last minute, further requests are queued and posted every
+# GROUP_DIGEST_INTERVAL seconds as digests of several requests, each with its
+# own accept/reject buttons, never exceeding GROUP_RATE_LIMIT messages a minute.
+# User-supplied fields are escaped and shortened, and a digest holds only as
+# many requests as fit in one message. A digest that Telegram rejects is posted
+# again one request per message, so one bad request cannot hold back the rest.
+# Failed sends are retried; a request that still cannot be posted remains
+# pending in the database and is listed in the admin pending queue.
+# -----------------------------------------------------------------------------
 
-    if data.startswith("EDIT_PROD_PRICE_CAT:"):
-        cid = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cid)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"EDIT_PROD_PRICE_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"EDIT_PROD_PRICE_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_PRICE_LIST")])
-            await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            prods = get_products_by_cat(cid)
-            if not prods:
-                await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_PRICE_LIST")]]))
+GROUP_RATE_LIMIT = 18           # messages per minute per group (Telegram allows about 20)
+GROUP_DIGEST_THRESHOLD = 10     # messages in the last minute before switching to digests
+GROUP_DIGEST_INTERVAL = 10.0    # seconds between digests
+GROUP_DIGEST_MAX_ITEMS = 8      # requests per digest
+GROUP_NOTIFY_MAX_ATTEMPTS = 5   # sends tried per request before giving up
+GROUP_NOTICE_FIELD_MAX = 100    # characters of each user-supplied field in a request
+GROUP_MESSAGE_MAX = 4096        # Telegram's limit for a message's text
+GROUP_DIGEST_MARK = "🗂"
+GROUP_NOTICE_ACTIONS = {'order': ("ORD_ACCEPT", "ORD_REJECT"), 'topup': ("TP_ACCEPT", "TP_REJECT")}
+
+def notice_field(value) -> str:
+    """A user-supplied value shortened to GROUP_NOTICE_FIELD_MAX characters and escaped for HTML."""
+    text = str(value)
+    if len(text) > GROUP_NOTICE_FIELD_MAX:
+        text = text[:GROUP_NOTICE_FIELD_MAX - 1] + "…"
+    return html.escape(text)
+
+class GroupNotice:
+    """A request to post to an admin group: its kind, id and HTML description."""
+    __slots__ = ("kind", "item_id", "text", "attempts")
+
+    def __init__(self, kind: str, item_id: int, text: str):
+        self.kind = kind
+        self.item_id = item_id
+        self.text = text
+        self.attempts = 0
+
+    def digest_entry(self) -> str:
+        """The request's part of a digest message."""
+        return f"<b>#{self.item_id}</b>\n{self.text}"
+
+    def buttons(self, labelled: bool) -> list[InlineKeyboardButton]:
+        """The accept/reject buttons, labelled with the id when part of a digest."""
+        accept, reject = GROUP_NOTICE_ACTIONS[self.kind]
+        suffix = f" #{self.item_id}" if labelled else ""
+        return [InlineKeyboardButton(f"✅ قبول{suffix}", callback_data=encode_callback(accept, self.item_id)),
+                InlineKeyboardButton(f"❌ رفض{suffix}", callback_data=encode_callback(reject, self.item_id))]
+
+class GroupNotifier:
+    """Posts requests to admin groups, switching to periodic digests under load."""
+
+    def __init__(self):
+        self._sent: dict[int, deque] = {}        # chat id -> send times in the last minute
+        self._queues: dict[int, deque] = {}      # chat id -> notices waiting for a digest
+        self._flushers: dict[int, asyncio.Task] = {}
+
+    def _recent(self, chat_id: int) -> deque:
+        """Send times to a group within the last minute."""
+        sent = self._sent.setdefault(chat_id, deque())
+        cutoff = time.monotonic() - 60
+        while sent and sent[0] < cutoff:
+            sent.popleft()
+        return sent
+
+    async def notify(self, bot, chat_id: int, notice: GroupNotice):
+        """Posts a request now, or queues it for the next digest when the group is busy."""
+        queue = self._queues.setdefault(chat_id, deque())
+        if not queue and len(self._recent(chat_id)) < GROUP_DIGEST_THRESHOLD:
+            if not await self._send(bot, chat_id, [notice]):
                 return
-            rows = []
-            for i in range(0, len(prods), 2):
-                row = [InlineKeyboardButton(f"{prods[i]['name']}", callback_data=f"PROD_REPRICE:{prods[i]['id']}")]
-                if i + 1 < len(prods):
-                    row.append(InlineKeyboardButton(f"{prods[i+1]['name']}", callback_data=f"PROD_REPRICE:{prods[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_EDIT_PRICE_LIST")])
-            await q.message.edit_text("اختر منتجاً لتعديل سعره:", reply_markup=InlineKeyboardMarkup(rows))
-        return
-
-    if data.startswith("PROD_REPRICE:"):
-        pid = int(data.split(":", 1)[1])
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_prod_reprice"
-        context.user_data["pid"] = pid
-        await q.message.reply_text("أرسل السعر الجديد للمنتج (رقماً):")
-        return
+        queue.append(notice)
+        flusher = self._flushers.get(chat_id)
+        if flusher is None or flusher.done():
+            self._flushers[chat_id] = asyncio.create_task(self._flush(bot, chat_id))
+
+    @staticmethod
+    def digest_text(notices: list[GroupNotice]) -> str:
+        """The text of a digest of several requests."""
+        return f"{GROUP_DIGEST_MARK} {len(notices)} طلبات جديدة\n\n" + "\n\n".join(
+            n.digest_entry() for n in notices)
+
+    def _take_digest(self, queue: deque) -> list[GroupNotice]:
+        """Takes the next requests off a queue, as many as fit in one digest message."""
+        batch = [queue.popleft()]
+        while queue and len(batch) < GROUP_DIGEST_MAX_ITEMS:
+            if len(self.digest_text(batch + [queue[0]])) > GROUP_MESSAGE_MAX:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    async def _send(self, bot, chat_id: int, notices: list[GroupNotice]) -> list[GroupNotice]:
+        """Sends one request, or a digest of several; returns the requests to retry."""
+        if len(notices) == 1:
+            text = notices[0].text
+            kb = InlineKeyboardMarkup([notices[0].buttons(labelled=False)])
+        else:
+            text = self.digest_text(notices)
+            kb = InlineKeyboardMarkup([n.buttons(labelled=True) for n in notices])
+        self._recent(chat_id).append(time.monotonic())
+        try:
+            await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, reply_markup=kb)
+            return []
+        except RetryAfter as e:
+            delay = e.retry_after
+            # Fill the window so that nothing else is sent to this group until it passes.
+            until = time.monotonic() + (delay.total_seconds() if isinstance(delay, timedelta) else delay) - 60
+            self._sent[chat_id] = deque([until] * GROUP_RATE_LIMIT)
+        except BadRequest as e:
+            if len(notices) > 1:
+                logger.warning("Group %s rejected a digest of %d requests (%s); posting them one by one",
+                               chat_id, len(notices), e)
+                return await self._send_each(bot, chat_id, notices)
+            logger.error("Group %s rejected %s %d: %s", chat_id, notices[0].kind, notices[0].item_id, e)
+        except Exception as e:
+            logger.error("Failed to post %d request(s) to group %s: %s", len(notices), chat_id, e)
+        for notice in notices:
+            notice.attempts += 1
+        return notices
+
+    async def _send_each(self, bot, chat_id: int, notices: list[GroupNotice]) -> list[GroupNotice]:
+        """Sends requests one per message within the rate limit; returns the requests to retry."""
+        retry = []
+        for notice in notices:
+            if len(self._recent(chat_id)) >= GROUP_RATE_LIMIT:
+                retry.append(notice)
+            else:
+                retry += await self._send(bot, chat_id, [notice])
+        return retry
+
+    async def _flush(self, bot, chat_id: int):
+        """Posts queued requests as digests until the queue is empty."""
+        queue = self._queues[chat_id]
+        while queue:
+            await asyncio.sleep(GROUP_DIGEST_INTERVAL)
+            sent = self._recent(chat_id)
+            if len(sent) >= GROUP_RATE_LIMIT:
+                continue
+            failed = await self._send(bot, chat_id, self._take_digest(queue))
+            retry = [n for n in failed if n.attempts < GROUP_NOTIFY_MAX_ATTEMPTS]
+            for notice in failed:
+                if notice.attempts >= GROUP_NOTIFY_MAX_ATTEMPTS:
+                    logger.error("Giving up posting %s %d to group %s; it stays in the pending queue",
+                                 notice.kind, notice.item_id, chat_id)
+            queue.extendleft(reversed(retry))
+
+group_notifier = GroupNotifier()
 
-    if data == "PROD_DEL_LIST":
-        await show_admin_categories_for_edit(update, context, "del_prod")
-        return
+# -----------------------------------------------------------------------------
+# Outbox
+# Messages to users are written to the outbox in the transaction of the change
+# they report, so handlers return once it commits and nothing is lost when a
+# send fails. A single outbox worker, started with the application, delivers
+# them in rounds at most OUTBOX_POLL_INTERVAL seconds apart: at most one message
+# per chat per round, in order, paced by the broadcast bucket. A round that takes
+# longer than the interval is followed by the next one straight away, so rounds
+# never overlap.
+# Failed sends are retried with exponential backoff up to OUTBOX_MAX_ATTEMPTS;
+# a flood-control wait pauses the bucket and does not count as an attempt.
+# -----------------------------------------------------------------------------
 
-    if data.startswith("DEL_PROD_CAT:"):
-        cid = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cid)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"DEL_PROD_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"DEL_PROD_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_DEL_LIST")])
-            await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            prods = get_products_by_cat(cid)
-            if not prods:
-                await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_DEL_LIST")]]))
-                return
-            rows = []
-            for i in range(0, len(prods), 2):
-                row = [InlineKeyboardButton(f"{prods[i]['name']}", callback_data=f"PROD_DEL:{prods[i]['id']}")]
-                if i + 1 < len(prods):
-                    row.append(InlineKeyboardButton(f"{prods[i+1]['name']}", callback_data=f"PROD_DEL:{prods[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_DEL_LIST")])
-            await q.message.edit_text("اختر منتجاً لحذفه:", reply_markup=InlineKeyboardMarkup(rows))
+OUTBOX_POLL_INTERVAL = 1.0      # seconds between rounds, which is also the per-chat pace
+OUTBOX_BATCH = int(BROADCAST_RATE * OUTBOX_POLL_INTERVAL)  # messages per round, what the bucket allows
+OUTBOX_BASE_BACKOFF = 5.0       # seconds before the first retry, doubled for each further one
+OUTBOX_MAX_BACKOFF = 3600.0
+OUTBOX_MAX_ATTEMPTS = 8
+
+async def send_outbox_message(bot, row: sqlite3.Row) -> tuple[str, str | None, float | None]:
+    """Tries to deliver one outbox message.
+
+    Returns its outcome (DELIVERED, UNREACHABLE or FAILED), the error and, after
+    a RetryAfter, the number of seconds Telegram asked to wait.
+    """
+    await broadcast_bucket.acquire()
+    try:
+        await bot.send_message(chat_id=row['chat_id'], text=row['text'], parse_mode=row['parse_mode'])
+        return DELIVERED, None, None
+    except RetryAfter as e:
+        delay = e.retry_after
+        delay = delay.total_seconds() if isinstance(delay, timedelta) else delay
+        broadcast_bucket.pause(delay)
+        return FAILED, str(e), delay
+    except Forbidden as e:
+        return UNREACHABLE, str(e), None
+    except BadRequest as e:
+        return (UNREACHABLE if "chat not found" in str(e).lower() else FAILED), str(e), None
+    except Exception as e:
+        return FAILED, str(e), None
+
+async def deliver_outbox(bot):
+    """Delivers one round of due outbox messages and records the outcome."""
+    rows = await run_db(get_due_outbox, time.time(), OUTBOX_BATCH)
+    if not rows:
         return
+    results = await asyncio.gather(*(send_outbox_message(bot, row) for row in rows))
+    now = time.time()
+    delivered, retried, failed, unreachable = [], [], [], []
+    for row, (outcome, error, wait) in zip(rows, results):
+        if outcome == DELIVERED:
+            delivered.append(row['id'])
+        elif outcome == UNREACHABLE:
+            failed.append((row['id'], error))
+            unreachable.append(row['chat_id'])
+        elif wait is not None:
+            retried.append((row['id'], now + wait, 0, error))
+        elif row['attempts'] + 1 >= OUTBOX_MAX_ATTEMPTS:
+            logger.error("Giving up outbox message %d to %s: %s", row['id'], row['chat_id'], error)
+            failed.append((row['id'], error))
+        else:
+            backoff = min(OUTBOX_MAX_BACKOFF, OUTBOX_BASE_BACKOFF * 2 ** row['attempts'])
+            retried.append((row['id'], now + backoff, 1, error))
+    await run_db(record_outbox_results, delivered, retried, failed, unreachable)
 
-    if data.startswith("PROD_DEL:"):
-        pid = int(data.split(":", 1)[1])
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM products WHERE id=?", (pid,))
-        conn.commit()
-        conn.close()
-        await q.message.reply_text("✅ تم حذف المنتج بنجاح.")
-        return
+_outbox_task: asyncio.Task | None = None
 
-    if data == "PROD_MOVE_LIST":
-        await show_admin_categories_for_edit(update, context, "move_prod")
-        return
+async def outbox_worker(bot):
+    """Runs delivery rounds until cancelled."""
+    while True:
+        started = time.monotonic()
+        try:
+            await deliver_outbox(bot)
+        except Exception:
+            logger.exception("Outbox delivery round failed")
+        await asyncio.sleep(max(0.0, OUTBOX_POLL_INTERVAL - (time.monotonic() - started)))
+
+def start_outbox_worker(bot):
+    """Starts the outbox worker unless it is already running."""
+    global _outbox_task
+    if _outbox_task is None or _outbox_task.done():
+        _outbox_task = asyncio.create_task(outbox_worker(bot))
+
+async def stop_outbox_worker():
+    """Stops the outbox worker, letting a round in progress finish its database calls."""
+    global _outbox_task
+    if _outbox_task is not None:
+        _outbox_task.cancel()
+        try:
+            await _outbox_task
+        except asyncio.CancelledError:
+            pass
+        _outbox_task = None
 
-    if data.startswith("MOVE_PROD_CAT:"):
-        cid = int(data.split(":", 1)[1])
-        sub_cats = get_sub_categories(cid)
-        if sub_cats:
-            rows = []
-            for i in range(0, len(sub_cats), 2):
-                row = [InlineKeyboardButton(f"{sub_cats[i]['name']}", callback_data=f"MOVE_PROD_CAT:{sub_cats[i]['id']}")]
-                if i + 1 < len(sub_cats):
-                    row.append(InlineKeyboardButton(f"{sub_cats[i+1]['name']}", callback_data=f"MOVE_PROD_CAT:{sub_cats[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_MOVE_LIST")])
-            await q.message.edit_text("اختر قائمة فرعية لعرض المنتجات:", reply_markup=InlineKeyboardMarkup(rows))
-        else:
-            prods = get_products_by_cat(cid)
-            if not prods:
-                await q.message.edit_text("لا توجد منتجات في هذه القائمة.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_MOVE_LIST")]]))
-                return
-            rows = []
-            for i in range(0, len(prods), 2):
-                row = [InlineKeyboardButton(f"{prods[i]['name']}", callback_data=f"PROD_MOVE:{prods[i]['id']}")]
-                if i + 1 < len(prods):
-                    row.append(InlineKeyboardButton(f"{prods[i+1]['name']}", callback_data=f"PROD_MOVE:{prods[i+1]['id']}"))
-                rows.append(row)
-            rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="PROD_MOVE_LIST")])
-            await q.message.edit_text("اختر منتجاً لنقله:", reply_markup=InlineKeyboardMarkup(rows))
-        return
+# -----------------------------------------------------------------------------
+# Conversation State Persistence
+# user_data/chat_data hold every multi-step flow, so they are persisted to
+# SQLite and restored at startup. The application hands over the entries that
+# changed once per PERSISTENCE_INTERVAL; they are collected and written in a
+# single transaction, so persistence never costs a disk write per message.
+# -----------------------------------------------------------------------------
 
-    if data.startswith("PROD_MOVE:"):
-        pid = int(data.split(":", 1)[1])
-        context.user_data["pid"] = pid
-        await show_admin_categories_for_edit(update, context, "move_prod_target")
-        return
+PERSISTENCE_INTERVAL = 10  # seconds between batched writes
 
-    if data.startswith("PROD_MOVE_TARGET:"):
-        pid = context.user_data.get("pid")
-        target_cid = int(data.split(":", 1)[1])
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("UPDATE products SET category_id=? WHERE id=?", (target_cid, pid))
-        conn.commit()
-        conn.close()
-        await q.message.edit_text("✅ تم نقل المنتج بنجاح.")
-        del context.user_data["pid"]
-        return
+class SQLitePersistence(BasePersistence):
+    """Persists user_data and chat_data in the conversation_state table."""
 
-    if data == "ADM_USERS":
-        await q.message.edit_text("إدارة المستخدمين:", reply_markup=users_menu_kb())
-        return
+    def __init__(self):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True, callback_data=False),
+            update_interval=PERSISTENCE_INTERVAL,
+        )
+        self._dirty: dict[tuple[str, int], dict | None] = {}
+        self._write_task: asyncio.Task | None = None
+
+    def _mark(self, kind: str, key: int, data: dict | None):
+        """Queues an entry for the next batched write."""
+        self._dirty[(kind, key)] = data
+        if self._write_task is None or self._write_task.done():
+            self._write_task = asyncio.create_task(self._write_soon())
+
+    async def _write_soon(self):
+        # Yield once so that every entry of the current run is queued first.
+        await asyncio.sleep(0)
+        # Entries queued while a batch was being written go out in the next one.
+        while self._dirty and await self._write():
+            pass
+
+    async def _write(self) -> bool:
+        """Writes the queued entries; on failure they are queued again. Returns whether it succeeded."""
+        batch, self._dirty = self._dirty, {}
+        if not batch:
+            return True
+        try:
+            await run_db(save_conversation_state, batch)
+        except Exception:
+            logger.exception("Failed to save conversation state for %d entries", len(batch))
+            # Entries changed since the batch was taken are newer and win.
+            self._dirty = {**batch, **self._dirty}
+            return False
+        return True
 
-    if data == "USR_CREDIT":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_usr_credit_id"
-        await q.message.reply_text("أرسل آيدي المستخدم المراد شحنه:")
-        return
+    async def get_user_data(self) -> dict[int, dict]:
+        """Restores every user's data at startup."""
+        return await run_db(load_conversation_state, 'user')
 
-    if data == "USR_DEBIT":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_usr_debit_id"
-        await q.message.reply_text("أرسل آيدي المستخدم المراد سحب الرصيد منه:")
-        return
+    async def get_chat_data(self) -> dict[int, dict]:
+        """Restores every chat's data at startup."""
+        return await run_db(load_conversation_state, 'chat')
 
-    if data == "ADM_SETTINGS":
-        await q.message.edit_text("إعدادات البوت:", reply_markup=settings_menu_kb())
-        return
+    async def get_bot_data(self) -> dict:
+        """bot_data is not persisted."""
+        return {}
 
-    if data == "SET_SUPPORT":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_support"
-        await q.message.reply_text("أرسل يوزر الدعم (بدون @):")
-        return
+    async def get_callback_data(self):
+        """Callback data is not persisted."""
+        return None
 
-    if data == "SET_SHAM_CODE":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_sham_code"
-        await q.message.reply_text("أرسل صورة كود شام كاش:")
-        return
+    async def get_conversations(self, name: str) -> dict:
+        """No ConversationHandler is used; flows live in user_data."""
+        return {}
 
-    if data == "SET_SHAM_ADDR":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_sham_addr"
-        await q.message.reply_text("أرسل عنوان شام كاش:")
-        return
+    async def update_user_data(self, user_id: int, data: dict):
+        """Queues a user's changed data."""
+        self._mark('user', user_id, data)
 
-    if data == "SET_GROUP_TOPUP":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_group_topup"
-        await q.message.reply_text("أرسل آيدي مجموعة الشحن:")
-        return
+    async def update_chat_data(self, chat_id: int, data: dict):
+        """Queues a chat's changed data."""
+        self._mark('chat', chat_id, data)
 
-    if data == "SET_GROUP_ORDERS":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_group_orders"
-        await q.message.reply_text("أرسل آيدي مجموعة الطلبات:")
-        return
+    async def drop_user_data(self, user_id: int):
+        """Queues a user's data for deletion."""
+        self._mark('user', user_id, None)
 
-    if data == "SET_ADMINS":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_set_admins"
-        await q.message.reply_text("أرسل آيديات الأدمن مفصولة بفاصلة (,):")
-        return
+    async def drop_chat_data(self, chat_id: int):
+        """Queues a chat's data for deletion."""
+        self._mark('chat', chat_id, None)
 
-    if data == "ADM_BROADCAST":
-        context.user_data.clear()
-        context.user_data["flow"] = "adm_broadcast"
-        await q.message.reply_text("أرسل الرسالة التي تريد إرسالها لجميع المستخدمين.")
-        return
+    async def update_bot_data(self, data: dict):
+        """bot_data is not persisted."""
 
-async def show_admin_categories_for_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, next_action: str):
-    """A helper function to display categories for admin editing purposes."""
-    q = update.callback_query
-    cats = get_categories()
-    if not cats:
-        await q.message.edit_text("لا توجد قوائم رئيسية بعد.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_PRODS")]]))
+    async def update_callback_data(self, data):
+        """Callback data is not persisted."""
+
+    async def update_conversation(self, name: str, key, new_state):
+        """No ConversationHandler is used."""
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        """The in-memory copy is authoritative; nothing to refresh."""
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict):
+        """The in-memory copy is authoritative; nothing to refresh."""
+
+    async def refresh_bot_data(self, bot_data: dict):
+        """bot_data is not persisted."""
+
+    async def flush(self):
+        """Writes whatever is still queued; called once at shutdown."""
+        if self._write_task is not None:
+            await self._write_task
+            self._write_task = None
+        await self._write()
+
+# -----------------------------------------------------------------------------
+# Update Processing
+# Updates from different users are handled concurrently. Each user (or, for
+# updates without a sender, each chat) has a lane in which updates still run one
+# at a time and in arrival order, so the user_data["flow"] state machine never
+# sees two messages of the same user at once. The group buttons that settle
+# top-ups and orders share a lane of their own. An update waits for its lane
+# before it takes one of the UPDATE_CONCURRENCY slots, so a busy lane never
+# holds slots that other users' updates could use. python-telegram-bot's own
+# limit, applied before do_process_update(), only bounds the updates admitted
+# at once (UPDATE_BACKLOG), whether running or waiting.
+# -----------------------------------------------------------------------------
+
+UPDATE_CONCURRENCY = 256                 # updates whose handlers run at once, across all lanes
+UPDATE_BACKLOG = 16 * UPDATE_CONCURRENCY  # updates admitted at once, running or waiting for a lane or slot
+ADMIN_ACTIONS_LANE = "admin_actions"
+ADMIN_ACTION_PREFIXES = ("TP_", "ORD_")
+
+class LaneUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently across lanes and sequentially within one."""
+
+    def __init__(self, max_running_updates: int, max_admitted_updates: int):
+        super().__init__(max_admitted_updates)
+        self._slots = asyncio.Semaphore(max_running_updates)
+        # lane key -> [lock, number of updates holding or waiting for it]
+        self._lanes: dict[object, list] = {}
+        self.running_updates = 0
+        self.waiting_updates = 0
+
+    @staticmethod
+    def lane_key(update: object) -> object | None:
+        """Returns the lane an update belongs to, or None if it needs no ordering."""
+        if not isinstance(update, Update):
+            return None
+        q = update.callback_query
+        if q is not None and q.data and callback_action(q.data).startswith(ADMIN_ACTION_PREFIXES):
+            return ADMIN_ACTIONS_LANE
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        if update.effective_chat is not None:
+            return ("chat", update.effective_chat.id)
+        return None
+
+    async def do_process_update(self, update: object, coroutine):
+        """Runs the update once every earlier update of its lane is done and a slot is free."""
+        key = self.lane_key(update)
+        lane = None
+        if key is not None:
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = [asyncio.Lock(), 0]
+            lane[1] += 1
+        self.waiting_updates += 1
+        started = False
+        try:
+            async with lane[0] if lane is not None else nullcontext():
+                async with self._slots:
+                    self.waiting_updates -= 1
+                    started = True
+                    self.running_updates += 1
+                    try:
+                        await coroutine
+                    finally:
+                        self.running_updates -= 1
+        finally:
+            if not started:
+                self.waiting_updates -= 1
+            if lane is not None:
+                lane[1] -= 1
+                if lane[1] == 0:
+                    del self._lanes[key]
+
+    async def initialize(self):
+        """Nothing to set up; lanes are created on demand."""
+
+    async def shutdown(self):
+        """Nothing to release; lanes are removed when they drain."""
+
+# -----------------------------------------------------------------------------
+# Metrics
+# Handlers (per callback route, flow state and command), database helpers and
+# Bot API methods are timed into Prometheus-style latency histograms with an
+# error counter beside each. They are served together with gauges for the
+# pending queue, outbox, broadcasts and update backlog in the Prometheus text
+# format at http://METRICS_LISTEN:METRICS_PORT/metrics; METRICS_PORT=0 turns
+# the endpoint off.
+# -----------------------------------------------------------------------------
+
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9108"))
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+METRICS_READ_TIMEOUT = 5.0      # seconds a scraper may take to send its request
+BOT_API_POOL_SIZE = 256         # connections to the Bot API (python-telegram-bot's default)
+
+def metric_label(value: str) -> str:
+    """Escapes a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class LatencyMetric:
+    """A latency histogram and an error counter, with one series per label value.
+
+    Observations may come from the DB thread as well as the event loop.
+    """
+
+    def __init__(self, name: str, label: str, what: str):
+        self.name = name
+        self.label = label
+        self.what = what
+        self._series: dict[str, list] = {}  # label value -> [bucket counts, sum, count, errors]
+        self._lock = threading.Lock()
+
+    def observe(self, value: str, seconds: float, error: bool = False):
+        """Records one call that took `seconds`."""
+        with self._lock:
+            series = self._series.get(value)
+            if series is None:
+                series = self._series[value] = [[0] * len(METRICS_BUCKETS), 0.0, 0, 0]
+            index = bisect_left(METRICS_BUCKETS, seconds)
+            if index < len(METRICS_BUCKETS):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+            series[3] += error
+
+    @contextmanager
+    def measure(self, value: str):
+        """Observes the enclosed block, counting an exception as an error."""
+        started = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(value, time.perf_counter() - started, error)
+
+    def render(self) -> list[str]:
+        """The histogram and error counter in the Prometheus text format."""
+        with self._lock:
+            snapshot = sorted((value, list(buckets), total, count, errors)
+                              for value, (buckets, total, count, errors) in self._series.items())
+        seconds, errors_total = f"{self.name}_seconds", f"{self.name}_errors_total"
+        lines = [f"# HELP {seconds} Latency of {self.what}.", f"# TYPE {seconds} histogram"]
+        for value, buckets, total, count, _ in snapshot:
+            label = f'{self.label}="{metric_label(value)}"'
+            cumulative = 0
+            for bound, n in zip(METRICS_BUCKETS, buckets):
+                cumulative += n
+                lines.append(f'{seconds}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{seconds}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{seconds}_sum{{{label}}} {total}")
+            lines.append(f"{seconds}_count{{{label}}} {count}")
+        lines += [f"# HELP {errors_total} Number of {self.what} that failed.", f"# TYPE {errors_total} counter"]
+        lines += [f'{errors_total}{{{self.label}="{metric_label(value)}"}} {errors}'
+                  for value, _, _, _, errors in snapshot]
+        return lines
+
+HANDLER_METRICS = LatencyMetric("bot_handler", "handler", "update handler calls")
+DB_METRICS = LatencyMetric("bot_db", "operation", "database helper calls")
+BOT_API_METRICS = LatencyMetric("bot_api", "method", "Bot API requests")
+
+# The handler an update is being processed by, for attributing database calls.
+current_handler: ContextVar[str] = ContextVar("current_handler", default="-")
+
+@contextmanager
+def handler_scope(name: str):
+    """Runs the enclosed block as handler `name`: timed, and named for SQL tracing."""
+    token = current_handler.set(name)
+    try:
+        with HANDLER_METRICS.measure(name):
+            yield
+    finally:
+        current_handler.reset(token)
+
+def measured(handler):
+    """Wraps a handler so that it runs in its handler_scope()."""
+    @wraps(handler)
+    async def wrapper(update, context):
+        with handler_scope(handler.__name__):
+            return await handler(update, context)
+    return wrapper
+
+class MetricsRequest(HTTPXRequest):
+    """Bot API transport that records the latency and outcome of every request."""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> tuple[int, bytes]:
+        """Performs the request, timing it under its Bot API method."""
+        api_method = "download" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        code = 0
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+            return code, payload
+        finally:
+            BOT_API_METRICS.observe(api_method, time.perf_counter() - started, not 200 <= code < 300)
+
+def gauge_lines(name: str, help_text: str, samples: list[tuple[str, float]]) -> list[str]:
+    """A gauge in the Prometheus text format from (labels, value) samples."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    lines += [f"{name}{{{labels}}} {value}" if labels else f"{name} {value}" for labels, value in samples]
+    return lines
+
+async def render_metrics(app) -> str:
+    """Collects the gauges and renders every metric in the Prometheus text format."""
+    sizes = await run_db(get_queue_sizes)
+    lines = gauge_lines("bot_pending_requests", "Top-ups and orders awaiting an admin.",
+                        [(f'kind="{kind}"', n) for kind, n in sizes['pending'].items()])
+    lines += gauge_lines("bot_outbox_messages", "Outbox messages by status.",
+                         [(f'status="{status}"', n) for status, n in sizes['outbox'].items()])
+    lines += gauge_lines("bot_broadcast_messages", "Progress of the running broadcasts.",
+                         [(f'broadcast="{row["id"]}",state="{state}"', row[state])
+                          for row in sizes['broadcasts'] for state in ('total', 'sent', 'failed')])
+    lines += gauge_lines("bot_update_queue_size", "Updates received but not yet picked up.",
+                         [("", app.update_queue.qsize())])
+    lines += gauge_lines("bot_updates_running", "Updates whose handlers are running.",
+                         [("", app.update_processor.running_updates)])
+    lines += gauge_lines("bot_updates_waiting", "Updates waiting for their lane or a free slot.",
+                         [("", app.update_processor.waiting_updates)])
+    for metric in (HANDLER_METRICS, DB_METRICS, BOT_API_METRICS):
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(app, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answers one HTTP request: GET /metrics returns the metrics, anything else 404."""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), METRICS_READ_TIMEOUT)
+        while await asyncio.wait_for(reader.readline(), METRICS_READ_TIMEOUT) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+            status, body = "200 OK", (await render_metrics(app)).encode()
+        else:
+            status, body = "404 Not Found", b"not found\n"
+        writer.write(f"HTTP/1.0 {status}\r\n"
+                     f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Failed to serve metrics: {e}")
+    finally:
+        writer.close()
+
+_metrics_server: asyncio.Server | None = None
+
+async def start_metrics_server(app):
+    """Starts the metrics endpoint unless it is turned off."""
+    global _metrics_server
+    if not METRICS_PORT:
+        return
+    try:
+        _metrics_server = await asyncio.start_server(lambda r, w: serve_metrics(app, r, w),
+                                                     METRICS_LISTEN, METRICS_PORT)
+    except OSError as e:
+        logger.error(f"Metrics endpoint not started on {METRICS_LISTEN}:{METRICS_PORT}: {e}")
         return
+    logger.info("Serving metrics on http://%s:%d/metrics", METRICS_LISTEN, METRICS_PORT)
 
-    rows = []
-    for i in range(0, len(cats), 2):
-        button_text = f"{cats[i]['name']}"
-        callback_data = f"{next_action}_cat:{cats[i]['id']}"
-        row = [InlineKeyboardButton(button_text, callback_data=callback_data)]
-        if i + 1 < len(cats):
-            button_text2 = f"{cats[i+1]['name']}"
-            callback_data2 = f"{next_action}_cat:{cats[i+1]['id']}"
-            row.append(InlineKeyboardButton(button_text2, callback_data=callback_data2))
-        rows.append(row)
-    rows.append([InlineKeyboardButton("⬅️ رجوع", callback_data="ADM_PRODS")])
-    await q.message.edit_text("اختر قائمة:", reply_markup=InlineKeyboardMarkup(rows))
-
-def get_categories_with_parent():
-    """Retrieves all categories that have a parent (i.e., sub-categories)."""
-    conn = db()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM categories WHERE parent_id IS NOT NULL ORDER BY id ASC")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+async def stop_metrics_server():
+    """Closes the metrics endpoint if it is running."""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
 
 # -----------------------------------------------------------------------------
 # Main Application Entry Point
 # -----------------------------------------------------------------------------
 
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Logs handler errors and tells the user when the database was too busy to answer."""
+    logger.error("Error while handling an update", exc_info=context.error)
+    if isinstance(context.error, DatabaseBusyError) and isinstance(update, Update) and update.effective_chat:
+        try:
+            await update.effective_chat.send_message("⏳ الخدمة مشغولة حالياً، يرجى المحاولة بعد قليل.")
+        except Exception:
+            pass
+
+async def ledger_check_job(context: ContextTypes.DEFAULT_TYPE):
+    """Periodically snapshots balances and reports any that disagree with the ledger."""
+    mismatches = await run_db(check_ledger)
+    for row in mismatches:
+        logger.error("Ledger mismatch for user %s: balance %s, ledger %s",
+                     row['user_id'], row['balance_minor'], row['expected_minor'])
+    if mismatches:
+        try:
+            await context.bot.send_message(
+                ADMIN_GROUP_ID, f"⚠️ تم العثور على {len(mismatches)} رصيد لا يطابق سجل الحركات. راجع السجلات.")
+        except Exception as e:
+            logger.error(f"Failed to report ledger mismatches: {e}")
+
+async def on_stop(app):
+    """Stops the outbox worker before the bot's connections are closed."""
+    await stop_outbox_worker()
+
+async def on_shutdown(app):
+    """Drains the DB thread and releases the pooled connections once the application has stopped."""
+    await stop_metrics_server()
+    _db_executor.shutdown(wait=True)
+    close_db()
+
+def build_application(builder: ApplicationBuilder | None = None):
+    """Builds the Telegram application and registers every handler and job."""
+    builder = builder or ApplicationBuilder().request(MetricsRequest(connection_pool_size=BOT_API_POOL_SIZE))
+    app = (builder.token(BOT_TOKEN)
+           .concurrent_updates(LaneUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG))
+           .persistence(SQLitePersistence())
+           .post_init(on_startup)
+           .post_stop(on_stop)
+           .post_shutdown(on_shutdown)
+           .build())
+
+    # Record when users were last seen before any other handler runs.
+    app.add_handler(TypeHandler(Update, track_last_seen), group=-1)
+
+    # Add command handlers, timed for the metrics endpoint.
+    app.add_handler(CommandHandler("start", measured(cmd_start)))
+    app.add_handler(CommandHandler("admin", measured(cmd_admin)))
+    app.add_handler(CommandHandler("ledger", measured(cmd_ledger)))
+    app.add_handler(CommandHandler("flowstats", measured(cmd_flowstats)))
+    app.add_handler(CommandHandler("sqltop", measured(cmd_sqltop)))
+    app.add_handler(CommandHandler("search", measured(cmd_search)))
+    app.add_handler(CommandHandler("reprice", measured(cmd_reprice)))
+
+    # Answer inline product searches.
+    app.add_handler(InlineQueryHandler(measured(on_inline_query)))
+
+    # Add callback query handlers.
+    app.add_handler(CallbackQueryHandler(on_callback))
+
+    # Add a message handler for text messages that are not commands.
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_user_message))
+
+    # Catalog files uploaded for import.
+    app.add_handler(MessageHandler(filters.Document.ALL, measured(on_document)))
+
+    # Report database timeouts to the user instead of failing silently.
+    app.add_error_handler(on_error)
+
+    # Check the balances against the ledger periodically.
+    app.job_queue.run_repeating(ledger_check_job, interval=LEDGER_CHECK_INTERVAL, first=60)
+    return app
+
 def main():
     """The main function that sets up and runs the bot."""
     # Initialize the database and ensure all tables exist.
     init_db()
 
-    # Build the Telegram application instance.
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    # Add command handlers.
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("admin", cmd_admin))
+    # Load the catalog into memory so that browsing never has to touch the disk.
+    catalog_cache.get()
 
-    # Add callback query handlers.
-    app.add_handler(CallbackQueryHandler(on_main_buttons, pattern=r"^(BUY|TOPUP_MENU|SUPPORT|ACCOUNT|NEWS|CHECK_SUB|BACK_TO_MAIN|SUPPORT_CONTACT)$"))
-    app.add_handler(CallbackQueryHandler(on_topup_buttons, pattern=r"^(SHOW_SHAM_CODE|SHOW_SHAM_ADDR|TOPUP_START)$"))
-    app.add_handler(CallbackQueryHandler(on_buy_flow, pattern=r"^BUY_|CHANGE_QTY"))
-    app.add_handler(CallbackQueryHandler(on_admin_buttons, pattern=r"^(ADM_|CAT_|PROD_|USR_|SET_|ADD_PROD_|TARGET_CAT|EDIT_PROD_|DEL_PROD_|MOVE_PROD_|EDIT_NEWS).*$"))
-    app.add_handler(CallbackQueryHandler(on_group_actions, pattern=r"^(TP_|ORD_).*$"))
-
-    # Add a message handler for text messages that are not commands.
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_user_message))
+    app = build_application()
 
     # Run the bot until the user presses Ctrl-C.
-    app.run_polling(drop_pending_updates=True)
-
-    # Start the bot's polling loop.
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("WEBHOOK_URL must be set in webhook mode.")
+        if not WEBHOOK_SECRET:
+            raise SystemExit("WEBHOOK_SECRET must be set in webhook mode.")
+        # The listener acknowledges each request as soon as the update is queued,
+        # so Telegram never waits on a handler.
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,853 @@
+"""Tests of the money paths, schema migrations and callback data formats.
+
+Run with `python -m pytest -q`. Every test works on a fresh SQLite file.
+"""
+
+import asyncio
+import json
+import socket
+import sqlite3
+import urllib.error
+import urllib.request
+from collections import deque
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from telegram.ext import ApplicationBuilder
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+import loadtest
+import main
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A fresh, fully migrated database in a temporary directory."""
+    main.close_db()
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "bot_data.db"))
+    monkeypatch.setattr(main, "_settings", None)
+    # A fresh DB thread, so that run_db() does not reuse a connection closed by close_db().
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+    monkeypatch.setattr(main, "_db_executor", executor)
+    main.catalog_cache.invalidate()
+    yield tmp_path / "bot_data.db"
+    executor.shutdown(wait=True)
+    main.close_db()
+    main.catalog_cache.invalidate()
+
+
+@pytest.fixture
+def shop(database):
+    """A migrated database with one funded user and a stocked product."""
+    main.init_db()
+    main.db().execute("INSERT INTO users(user_id, username) VALUES(?,?)", (1, "buyer"))
+    main.post_ledger(1, main.to_minor(100), 'credit')
+    cat_id = main.add_category("Games")
+    return {
+        "user": 1,
+        "product": main.add_product(cat_id, "60 UC", 30, stock=5),
+        "empty": main.add_product(cat_id, "Gift card", 10, stock=0),
+    }
+
+
+def balance(user_id: int) -> float:
+    return main.get_balance(user_id)
+
+
+def outbox_count(user_id: int) -> int:
+    return main.db().execute("SELECT COUNT(*) FROM outbox WHERE chat_id=?", (user_id,)).fetchone()[0]
+
+
+class FakeMessage:
+    """Records edits; raises `error` from edit_text when set."""
+
+    def __init__(self, error: Exception | None = None):
+        self.error = error
+        self.edits = []
+
+    async def edit_text(self, text, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.edits.append((text, kwargs))
+
+
+def callback_update(message: FakeMessage):
+    return SimpleNamespace(callback_query=SimpleNamespace(message=message))
+
+
+# --- Purchases ------------------------------------------------------------------
+
+def test_purchase_debits_balance_and_stock(shop):
+    order_id, new_balance = main.purchase(shop["user"], shop["product"], 1, "player#1")
+    assert new_balance == 70
+    assert main.db().execute("SELECT stock FROM products WHERE id=?", (shop["product"],)).fetchone()[0] == 4
+    assert main.db().execute("SELECT status FROM orders WHERE id=?", (order_id,)).fetchone()[0] == "pending"
+    assert main.check_ledger() == []
+
+
+def test_purchase_with_insufficient_balance_writes_nothing(shop):
+    with pytest.raises(main.PurchaseError) as exc:
+        main.purchase(shop["user"], shop["product"], 4, "player#1")
+    assert exc.value.reason == 'balance'
+    assert balance(shop["user"]) == 100
+    assert main.db().execute("SELECT stock FROM products WHERE id=?", (shop["product"],)).fetchone()[0] == 5
+    assert main.db().execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+    assert main.check_ledger() == []
+
+
+def test_purchase_with_zero_stock_writes_nothing(shop):
+    with pytest.raises(main.PurchaseError) as exc:
+        main.purchase(shop["user"], shop["empty"], 1, "player#1")
+    assert exc.value.reason == 'stock'
+    assert balance(shop["user"]) == 100
+    assert main.db().execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+    assert main.check_ledger() == []
+
+
+# --- Settling top-ups and orders -------------------------------------------------
+
+def test_settle_topup_twice_credits_once(shop):
+    topup_id = main.create_topup(shop["user"], "12345", 50)
+    row, new_balance = main.settle_topup(topup_id, True)
+    assert row['status'] == 'pending' and new_balance == 150
+
+    row, new_balance = main.settle_topup(topup_id, True)
+    assert row['status'] == 'approved' and new_balance is None
+    assert balance(shop["user"]) == 150
+    assert outbox_count(shop["user"]) == 1
+    assert main.check_ledger() == []
+
+
+def test_settle_rejected_order_twice_refunds_once(shop):
+    order_id, _ = main.purchase(shop["user"], shop["product"], 1, "player#1")
+    assert main.settle_order(order_id, False)['status'] == 'pending'
+    assert main.settle_order(order_id, False)['status'] == 'rejected'
+    assert main.settle_order(order_id, True)['status'] == 'rejected'
+    assert balance(shop["user"]) == 100
+    assert outbox_count(shop["user"]) == 1
+    assert main.check_ledger() == []
+
+
+def test_settle_many_skips_settled_items(shop):
+    ids = [main.create_topup(shop["user"], "12345", amount) for amount in (10, 20)]
+    main.settle_topup(ids[0], False)
+    settled = main.settle_many('topup', ids, True)
+    assert [row['id'] for row, _ in settled] == [ids[1]]
+    assert main.settle_many('topup', ids, True) == []
+    assert balance(shop["user"]) == 120
+    assert main.check_ledger() == []
+
+
+def test_adjust_balance_keeps_ledger_consistent(shop):
+    assert main.adjust_balance(shop["user"], -25.5, "{amount} {balance}") == 74.5
+    assert main.adjust_balance(404, 10, "{amount} {balance}") is None
+    assert main.check_ledger() == []
+
+
+def test_check_ledger_reports_tampered_balance(shop):
+    main.db().execute("UPDATE users SET balance_minor = balance_minor + 1 WHERE user_id=?", (shop["user"],))
+    assert [row['user_id'] for row in main.check_ledger()] == [shop["user"]]
+
+
+# --- Migrations --------------------------------------------------------------------
+
+def test_migrating_populated_baseline_database(database):
+    conn = sqlite3.connect(database)
+    main._migration_base_tables(conn)
+    conn.executescript("""
+        INSERT INTO users(user_id, username, balance) VALUES (1, 'old', 125.5), (2, 'broke', 0);
+        INSERT INTO categories(id, name, parent_id) VALUES (1, 'Games', NULL), (2, 'PUBG', 1);
+        INSERT INTO products(id, category_id, name, price, stock) VALUES (1, 2, '60 UC', 30, 5);
+        INSERT INTO orders(user_id, product_id, price, contact, status, created_at)
+            VALUES (1, 1, 30, 'player#1', 'pending', '2024-05-01 12:00:00');
+        -- An order of a product deleted while foreign keys were not enforced.
+        INSERT INTO orders(user_id, product_id, price, contact, status, created_at)
+            VALUES (1, 99, 10, 'player#1', 'approved', '2024-05-01 12:10:00');
+        INSERT INTO topups(user_id, op_number, amount, status, created_at)
+            VALUES (1, '12345', 50, 'pending', '2024-05-01 12:30:00');
+        INSERT INTO settings(key, value) VALUES ('news', 'hello');
+    """)
+    conn.commit()
+    conn.close()
+
+    main.init_db()
+    assert main.schema_version() == len(main.MIGRATIONS)
+    assert balance(1) == 125.5
+    assert [tuple(row) for row in main.db().execute("SELECT kind, amount_minor FROM ledger WHERE user_id=1")] == [
+        ('opening', main.to_minor(125.5))]
+    assert [tuple(row) for row in main.db().execute("SELECT product_id, created_at FROM orders ORDER BY id")] == [
+        (1, 1714564800), (None, 1714565400)]
+    assert main.db().execute("SELECT created_at FROM topups").fetchone()[0] == 1714566600
+    assert main.get_setting('news') == 'hello'
+    assert main.check_ledger() == []
+
+    # The migrated data works with the current code paths.
+    row, new_balance = main.settle_topup(1, True)
+    assert new_balance == 175.5
+    assert main.settle_order(1, False)['status'] == 'pending'
+    assert balance(1) == 205.5
+    assert main.check_ledger() == []
+
+    # Running the migrations again is a no-op.
+    main.close_db()
+    main.init_db()
+    assert main.schema_version() == len(main.MIGRATIONS)
+
+
+# --- Callback data -------------------------------------------------------------------
+
+@pytest.mark.parametrize("action, args", [
+    ("BUY", []),
+    ("BUY_CAT", [0]),
+    ("BUY_CAT", [123456789]),
+    ("BUY_PAGE", ["buy_root", 0, 35]),
+    ("PENDING_TOGGLE", ["topup", 36, 1295]),
+])
+def test_callback_round_trip(action, args):
+    data = main.encode_callback(action, *args)
+    assert data.startswith(main.CALLBACK_VERSION + main.CALLBACK_VERSION_SEPARATOR)
+    route, decoded = main.decode_callback(data)
+    assert route is main.CALLBACK_ROUTES[action]
+    assert decoded == args
+    assert main.callback_action(data) == action
+
+
+@pytest.mark.parametrize("data, action, args", [
+    ("BUY", "BUY", []),
+    ("BUY_CAT:35", "BUY_CAT", [35]),
+    ("TP_ACCEPT:1001", "TP_ACCEPT", [1001]),
+    ("BUY_CAT.z", "BUY_CAT", [35]),
+    ("PENDING_LIST.topup.a", "PENDING_LIST", ["topup", 10]),
+])
+def test_callback_legacy_formats(data, action, args):
+    route, decoded = main.decode_callback(data)
+    assert route is main.CALLBACK_ROUTES[action]
+    assert decoded == args
+    assert main.callback_action(data) == action
+
+
+@pytest.mark.parametrize("data", [
+    "9|BUY_CAT.z",      # unknown version
+    "1|BUY_CAT",        # missing argument
+    "1|BUY_CAT.z.z",    # extra argument
+    "1|BUY_CAT.!",      # not a number
+    "BUY_CAT:z",        # legacy integers are decimal
+    "NO_SUCH_ACTION",
+    "",
+])
+def test_callback_malformed(data):
+    assert main.decode_callback(data) is None
+
+
+class FakeQuery:
+    """A callback query that records answers and replies."""
+
+    def __init__(self, data: str, user_id: int):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.answers = 0
+        self.message = FakeChatMessage()
+
+    async def answer(self, *args, **kwargs):
+        self.answers += 1
+
+
+def press(data: str, user_id: int) -> FakeQuery:
+    query = FakeQuery(data, user_id)
+    asyncio.run(main.on_callback(SimpleNamespace(callback_query=query), SimpleNamespace(user_data={})))
+    return query
+
+
+def test_callback_router_dispatches_with_converted_arguments(monkeypatch):
+    calls = []
+    monkeypatch.setattr(main, "CALLBACK_ROUTES", dict(main.CALLBACK_ROUTES))
+    monkeypatch.setattr(main, "ADMIN_IDS", {9})
+
+    @main.callback("TEST_OPEN", str, int)
+    async def open_route(update, context, kind, item_id):
+        calls.append(("open", kind, item_id))
+
+    @main.callback("TEST_ADMIN", int, admin="denied")
+    async def admin_route(update, context, item_id):
+        calls.append(("admin", item_id))
+
+    with pytest.raises(ValueError):
+        main.callback("TEST_OPEN")(open_route)
+
+    assert press(main.encode_callback("TEST_OPEN", "topup", 1295), 1).answers == 1
+    denied = press(main.encode_callback("TEST_ADMIN", 5), 1)
+    assert (denied.answers, denied.message.replies) == (1, ["denied"])
+    press(main.encode_callback("TEST_ADMIN", 5), 9)
+    press("TEST_ADMIN:36", 9)                           # legacy payloads carry decimal arguments
+    assert press("1|TEST_ADMIN.zz.zz", 9).answers == 1  # wrong arity: answered, not dispatched
+    assert calls == [("open", "topup", 1295), ("admin", 5), ("admin", 36)]
+
+
+def test_callback_rejects_separators_and_oversized_data():
+    with pytest.raises(ValueError):
+        main.encode_callback("PENDING_LIST", "a.b", 1)
+    with pytest.raises(ValueError):
+        main.encode_callback("PENDING_LIST", "x" * 64, 1)
+
+
+# --- Catalog pages ---------------------------------------------------------------------
+
+def nav_targets(kb) -> list[tuple]:
+    """The (action, view, category, start id) of a keyboard's page buttons."""
+    route_names = {route: name for name, route in main.CALLBACK_ROUTES.items()}
+    targets = []
+    for button in kb.inline_keyboard[-2]:
+        route, args = main.decode_callback(button.callback_data)
+        targets.append((route_names[route], *args))
+    return targets
+
+
+def test_catalog_pages_are_keyed_by_item_id(database):
+    main.init_db()
+    ids = [main.add_category(f"Category {n}") for n in range(main.CATALOG_PAGE_SIZE * 2 + 5)]
+    snapshot = main.catalog_cache.get()
+    page_size = main.CATALOG_PAGE_SIZE
+
+    first = main.catalog_kb(snapshot, "buy_root")
+    assert sum(len(row) for row in first.inline_keyboard[:-2]) == page_size
+    assert nav_targets(first) == [("BUY_PAGE", "buy_root", 0, ids[page_size])]
+
+    middle = main.catalog_kb(snapshot, "buy_root", start_id=ids[page_size])
+    assert nav_targets(middle) == [("BUY_PAGE", "buy_root", 0, ids[0]),
+                                   ("BUY_PAGE", "buy_root", 0, ids[2 * page_size])]
+    last = main.catalog_kb(snapshot, "buy_root", start_id=ids[2 * page_size])
+    assert sum(len(row) for row in last.inline_keyboard[:-2]) == 5
+    assert nav_targets(last) == [("BUY_PAGE", "buy_root", 0, ids[page_size])]
+    assert nav_targets(main.catalog_kb(snapshot, "cat_edit_main"))[0][0] == "ADM_PAGE"
+
+    # A start id between items lands on the next item's page and shares its keyboard.
+    main.delete_category(ids[page_size])
+    snapshot = main.catalog_cache.get()
+    shifted = main.catalog_kb(snapshot, "buy_root", start_id=ids[page_size])
+    assert main.catalog_kb(snapshot, "buy_root", start_id=ids[page_size + 1]) is shifted
+    assert len(snapshot.keyboards) == 1
+
+
+# --- Product search ----------------------------------------------------------------------
+
+def found(query: str) -> list[str]:
+    return [row['name'] for row in main.search_products(query, 10)]
+
+
+def test_search_normalizes_arabic_and_matches_prefixes(database):
+    main.init_db()
+    games = main.add_category("ألعاب")
+    pubg = main.add_category("ببجي موبايل", games)
+    main.add_product(pubg, "شدّة 60", 1)
+    main.add_product(main.add_category("بطاقات"), "بطاقة آيتونز", 10)
+
+    assert found("شده") == ["شدّة 60"]             # diacritics and ta marbuta fold away
+    assert found("العاب") == ["شدّة 60"]           # matches the parent category's name
+    assert found("ببج") == ["شدّة 60"]             # prefix of the sub-category
+    assert found("ايتو") == ["بطاقة آيتونز"]
+    assert found("بطاقه ايتونز") == ["بطاقة آيتونز"]
+    assert found('" OR * NEAR(') == []
+    assert found("   ") == []
+
+
+def test_search_index_follows_catalog_changes(database):
+    main.init_db()
+    games = main.add_category("Games")
+    product = main.add_product(main.add_category("PUBG", games), "60 UC", 1)
+
+    main.rename_product(product, "325 UC")
+    assert (found("60"), found("325")) == ([], ["325 UC"])
+    main.rename_category(games, "Mobile")
+    assert (found("games"), found("mobile")) == ([], ["325 UC"])
+    main.move_category(main.db().execute("SELECT category_id FROM products").fetchone()[0],
+                       main.add_category("Shooters"))
+    assert (found("mobile"), found("shoot")) == ([], ["325 UC"])
+    main.delete_product(product)
+    assert found("325") == []
+
+
+# --- Pending queue ---------------------------------------------------------------------
+
+def test_pending_page_escapes_user_text(shop):
+    main.purchase(shop["user"], shop["product"], 1, "<b>me & you")
+    main.create_topup(shop["user"], "12<34", 10)
+    for kind in ('order', 'topup'):
+        message = FakeMessage()
+        asyncio.run(main.show_pending_page(callback_update(message), SimpleNamespace(user_data={}), kind, 0))
+        text = message.edits[0][0]
+        assert "<b>" not in text and "12<34" not in text
+    assert "&lt;b&gt;me &amp; you" in main.pending_line('order', main.get_pending('order', 0, 1)[0])
+    assert "12&lt;34" in main.pending_line('topup', main.get_pending('topup', 0, 1)[0])
+
+
+def test_pending_page_only_ignores_unmodified_message(shop):
+    context = SimpleNamespace(user_data={})
+    unchanged = FakeMessage(BadRequest("Message is not modified: specified new message content is the same"))
+    asyncio.run(main.show_pending_page(callback_update(unchanged), context, 'order', 0))
+    with pytest.raises(BadRequest):
+        asyncio.run(main.show_pending_page(callback_update(FakeMessage(BadRequest("Can't parse entities"))),
+                                           context, 'order', 0))
+
+
+# --- Admin group notifier -------------------------------------------------------------
+
+class FakeGroupBot:
+    """Records sent messages; rejects any text containing `reject` with BadRequest."""
+
+    def __init__(self, reject: str | None = None):
+        self.reject = reject
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.reject is not None and self.reject in text:
+            raise BadRequest("Can't parse entities")
+        self.sent.append(text)
+
+
+def notices(count: int, text: str = "request") -> list:
+    return [main.GroupNotice('order', item_id, text) for item_id in range(1, count + 1)]
+
+
+def test_notice_field_escapes_and_shortens():
+    assert main.notice_field("<b>&") == "&lt;b&gt;&amp;"
+    field = main.notice_field("x" * 500)
+    assert len(field) == main.GROUP_NOTICE_FIELD_MAX and field.endswith("…")
+
+
+def test_digest_fits_in_one_message():
+    queue = deque(notices(8, "y" * 1500))
+    notifier = main.GroupNotifier()
+    while queue:
+        batch = notifier._take_digest(queue)
+        assert batch and len(main.GroupNotifier.digest_text(batch)) <= main.GROUP_MESSAGE_MAX
+
+
+def test_rejected_digest_falls_back_to_single_messages(monkeypatch):
+    monkeypatch.setattr(main, "GROUP_DIGEST_INTERVAL", 0)
+    bot = FakeGroupBot(reject="bad")
+    batch = notices(3)
+    batch[1].text = "bad"
+    notifier = main.GroupNotifier()
+    notifier._queues[-100] = deque(batch)
+    asyncio.run(notifier._flush(bot, -100))
+    assert bot.sent == ["request", "request"]
+    assert batch[1].attempts == main.GROUP_NOTIFY_MAX_ATTEMPTS
+    assert batch[0].attempts == batch[2].attempts == 0
+
+
+# --- Outbox ----------------------------------------------------------------------------
+
+class FakeOutboxBot:
+    """Delivers messages unless an error is queued for the chat."""
+
+    def __init__(self, errors: dict[int, Exception]):
+        self.errors = errors
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        self.sent.append((chat_id, text))
+
+
+class FakeBucket:
+    """Hands out tokens at once and records flood-control pauses."""
+
+    def __init__(self):
+        self.pauses = []
+
+    async def acquire(self):
+        pass
+
+    def pause(self, seconds: float):
+        self.pauses.append(seconds)
+
+
+def outbox_rows() -> dict[str, tuple]:
+    return {row['text']: (row['status'], row['attempts'], row['next_attempt_at'])
+            for row in main.db().execute("SELECT * FROM outbox")}
+
+
+def test_outbox_delivers_in_order_and_retries_failures(database, monkeypatch):
+    main.init_db()
+    bucket = FakeBucket()
+    monkeypatch.setattr(main, "broadcast_bucket", bucket)
+    for user_id in range(1, 5):
+        main.db().execute("INSERT INTO users(user_id) VALUES(?)", (user_id,))
+    for chat_id, text in [(1, "first"), (1, "second"), (2, "flood"), (3, "blocked"), (4, "flaky")]:
+        main.enqueue_message(chat_id, text)
+    bot = FakeOutboxBot({2: RetryAfter(timedelta(seconds=30)), 3: Forbidden("bot was blocked by the user"), 4: NetworkError("reset")})
+
+    started = main.time.time()
+    asyncio.run(main.deliver_outbox(bot))
+    assert bot.sent == [(1, "first")]                     # one message per chat per round
+    rows = outbox_rows()
+    assert set(rows) == {"second", "flood", "blocked", "flaky"}
+    assert rows["flood"][:2] == ("pending", 0) and rows["flood"][2] >= started + 30
+    assert bucket.pauses == [30]
+    assert rows["blocked"][:2] == ("failed", 1)
+    assert main.db().execute("SELECT reachable FROM users WHERE user_id=3").fetchone()[0] == 0
+    assert rows["flaky"][:2] == ("pending", 1) and rows["flaky"][2] >= started + main.OUTBOX_BASE_BACKOFF
+
+    asyncio.run(main.deliver_outbox(bot))
+    assert bot.sent == [(1, "first"), (1, "second")]      # the others are not due yet
+
+    main.db().execute("UPDATE outbox SET attempts=?, next_attempt_at=0 WHERE text='flaky'",
+                      (main.OUTBOX_MAX_ATTEMPTS - 1,))
+    asyncio.run(main.deliver_outbox(bot))
+    assert outbox_rows()["flaky"][:2] == ("failed", main.OUTBOX_MAX_ATTEMPTS)
+
+
+# --- Update lanes ---------------------------------------------------------------------
+
+def user_update(user_id: int, update_id: int):
+    return main.Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "text": "hi",
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": user_id, "is_bot": False, "first_name": "u"}},
+    }, None)
+
+
+def test_lanes_keep_per_user_order_without_holding_slots():
+    async def scenario():
+        processor = main.LaneUpdateProcessor(2, 100)
+        log = []
+        release = asyncio.Event()
+
+        async def handler(name, wait=None):
+            log.append(f"start {name}")
+            if wait is not None:
+                await wait.wait()
+            log.append(f"end {name}")
+
+        # Two slots: user 1's second update waits for its lane without taking
+        # the free slot, so user 2 runs while user 1's first update is blocked.
+        tasks = [asyncio.create_task(processor.process_update(user_update(1, 1), handler("1a", release))),
+                 asyncio.create_task(processor.process_update(user_update(1, 2), handler("1b"))),
+                 asyncio.create_task(processor.process_update(user_update(2, 3), handler("2a")))]
+        await asyncio.sleep(0.01)
+        assert log == ["start 1a", "start 2a", "end 2a"]
+        assert (processor.running_updates, processor.waiting_updates) == (1, 1)
+        release.set()
+        await asyncio.gather(*tasks)
+        assert log[3:] == ["end 1a", "start 1b", "end 1b"]
+        assert (processor.running_updates, processor.waiting_updates, processor._lanes) == (0, 0, {})
+
+    asyncio.run(scenario())
+
+
+def test_admin_actions_share_one_lane():
+    update = main.Update.de_json({
+        "update_id": 1,
+        "callback_query": {"id": "1", "chat_instance": "1", "data": main.encode_callback("TP_ACCEPT", 5),
+                           "from": {"id": 7, "is_bot": False, "first_name": "a"}},
+    }, None)
+    assert main.LaneUpdateProcessor.lane_key(update) == main.ADMIN_ACTIONS_LANE
+    assert main.LaneUpdateProcessor.lane_key(user_update(7, 2)) == ("user", 7)
+
+
+# --- Metrics -------------------------------------------------------------------------
+
+def test_metrics_report_running_and_waiting_updates(shop):
+    async def scenario():
+        processor = main.LaneUpdateProcessor(1, 100)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(processor.process_update(user_update(1, 1), release.wait())),
+                 asyncio.create_task(processor.process_update(user_update(1, 2), asyncio.sleep(0)))]
+        await asyncio.sleep(0.01)
+        app = SimpleNamespace(update_queue=asyncio.Queue(), update_processor=processor)
+        text = await main.render_metrics(app)
+        release.set()
+        await asyncio.gather(*tasks)
+        return text
+
+    lines = asyncio.run(scenario()).splitlines()
+    assert "bot_updates_running 1" in lines
+    assert "bot_updates_waiting 1" in lines
+    assert 'bot_pending_requests{kind="order"} 0' in lines
+
+
+# --- Webhook mode ----------------------------------------------------------------------
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def post_update(port: int, update: dict, secret: str | None) -> int:
+    """POSTs an update to the local webhook and returns the HTTP status."""
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/{main.WEBHOOK_PATH}",
+                                     data=json.dumps(update).encode(), method="POST",
+                                     headers={"Content-Type": "application/json"})
+    if secret is not None:
+        request.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_webhook_accepts_only_updates_with_the_secret(shop):
+    secret, port = "s3cret-token", free_port()
+    bot_api = loadtest.FakeBotRequest()
+    app = main.build_application(ApplicationBuilder().request(bot_api).get_updates_request(loadtest.FakeBotRequest()))
+
+    async def handled(user_id: int, timeout: float = 2.0) -> bool:
+        """Whether the bot answered the user's /start within `timeout` seconds."""
+        for _ in range(int(timeout / 0.02)):
+            if bot_api.calls.get("sendMessage", 0) and await main.run_db(main.get_user, user_id) is not None:
+                return True
+            await asyncio.sleep(0.02)
+        return False
+
+    async def scenario():
+        async with app:
+            await app.start()
+            await app.updater.start_webhook(listen="127.0.0.1", port=port, url_path=main.WEBHOOK_PATH,
+                                            webhook_url=f"https://example.com/{main.WEBHOOK_PATH}",
+                                            secret_token=secret)
+            try:
+                status = await asyncio.to_thread(post_update, port, loadtest.message_update(501, "/start"), secret)
+                assert status == 200 and await handled(501)
+
+                status = await asyncio.to_thread(post_update, port, loadtest.message_update(502, "/start"), None)
+                assert status == 403 and not await handled(502, 0.3)
+                status = await asyncio.to_thread(post_update, port, loadtest.message_update(503, "/start"), "wrong")
+                assert status == 403 and not await handled(503, 0.3)
+            finally:
+                await app.updater.stop()
+                await app.stop()
+        assert bot_api.calls.get("setWebhook") == 1
+
+    asyncio.run(scenario())
+
+
+# --- SQL tracing -------------------------------------------------------------------------
+
+def test_sql_tracer_times_only_top_level_statements(database, tmp_path, monkeypatch):
+    main.init_db()
+    main.close_db()
+    monkeypatch.setattr(main, "SQL_SLOW_LOG", str(tmp_path / "slow.log"))
+    tracer = main.SQLTracer()
+    monkeypatch.setattr(main, "sql_tracer", tracer)
+    cat_id = main.add_category("Games")
+    with tracer.scope("test"):
+        # The product_search triggers run inside each of these statements.
+        prod_id = main.add_product(cat_id, "60 UC", 30)
+        main.rename_product(prod_id, "120 UC")
+    statements = {sql: calls for sql, calls, *_ in tracer.top(main.SQL_TOP_MAX)}
+    assert not [sql for sql in statements if sql.lstrip().startswith("--")]
+    assert [calls for sql, calls in statements.items() if sql.startswith("INSERT INTO products")] == [1]
+    assert [calls for sql, calls in statements.items() if sql.startswith("UPDATE products")] == [1]
+
+    # Newer sqlite3 modules report the trigger itself as a comment.
+    with tracer.scope("test"):
+        tracer._on_statement("DELETE FROM products WHERE id=1")
+        tracer._on_statement("-- TRIGGER products_search_delete")
+    assert [calls for sql, calls, *_ in tracer.top(main.SQL_TOP_MAX) if sql.startswith("DELETE FROM products")] == [1]
+    assert not [sql for sql, *_ in tracer.top(main.SQL_TOP_MAX) if sql.startswith("--")]
+
+
+# --- Bulk repricing ----------------------------------------------------------------------
+
+class FakeChatMessage:
+    """Records the replies to a command."""
+
+    def __init__(self):
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+def run_command(handler, user_id: int, *args) -> list[str]:
+    message = FakeChatMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), message=message)
+    context = SimpleNamespace(args=list(args), user_data={})
+    asyncio.run(handler(update, context))
+    return message.replies
+
+
+def prices() -> list[float]:
+    return [row[0] for row in main.db().execute("SELECT price FROM products ORDER BY id")]
+
+
+def test_reprice_by_percent_and_step(shop):
+    totals, _ = main.preview_reprice(None, 1.1, 0.0, 5)
+    assert (totals['products'], totals['lowest'], totals['highest']) == (2, 10, 35)
+    assert main.apply_reprice(None, 1.1, 0.0, 5) == 2
+    assert prices() == [35, 10]
+
+
+def test_reprice_refuses_prices_at_or_below_zero(shop, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_IDS", {9})
+    for change in ("-100%", "-10"):
+        assert run_command(main.cmd_reprice, 9, "all", change) == [main.REPRICE_NOT_POSITIVE]
+    assert main.apply_reprice(None, 0.0, 0.0, None) is None
+    assert main.apply_reprice(None, 1.0, -10.0, None) is None
+    assert prices() == [30, 10]
+
+
+def test_reprice_rejects_non_finite_changes(shop, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_IDS", {9})
+    for args in (("all", "+1e400%"), ("all", "+10%", "nan"), ("all", "+10%", "0")):
+        assert run_command(main.cmd_reprice, 9, *args)[0].startswith(main.REPRICE_USAGE)
+    assert prices() == [30, 10]
+
+
+# --- Catalog import and export -----------------------------------------------------------
+
+@pytest.mark.parametrize("names", [("ألعاب", "ببجي"), ("A>B", "C"), ("back\\slash>", "x \\> y")])
+def test_catalog_path_round_trip(names):
+    assert main.split_catalog_path(main.join_catalog_path(names)) == names
+
+
+@pytest.mark.parametrize("fmt", main.CATALOG_FORMATS)
+def test_catalog_export_reimports_unchanged(shop, fmt):
+    parent = main.add_category("A>B")
+    child = main.add_category("C\\D", parent)
+    main.add_product(child, "Pack", 12.5, "quantity", 1, 10)
+    path = main.export_catalog(fmt)
+    plan = main.plan_catalog_import(path, fmt)
+    assert (plan.new_categories, plan.inserts, plan.updates, plan.errors) == ([], [], [], [])
+    assert plan.unchanged == 3
+
+
+def test_catalog_import_creates_and_updates(shop, tmp_path):
+    path = tmp_path / "catalog.csv"
+    path.write_text("category,name,price,type,min_qty,max_qty,stock\n"
+                    "Games,60 UC,35,regular,,,5\n"
+                    "Games > New\\>Sub,Card,5,,,,\n"
+                    "Games,Broken,-1,,,,\n", encoding="utf-8")
+    plan = main.apply_catalog_import(str(path), "csv")
+    assert plan.new_categories == [("Games", "New>Sub")]
+    assert [values[0] for _, values in plan.inserts] == ["Card"]
+    assert [changed for _, _, changed in plan.updates] == [["price"]]
+    assert [line for line, _ in plan.errors] == [4]
+    snapshot = main.catalog_cache.get()
+    games = snapshot.categories_under(None)[0]
+    assert [c['name'] for c in snapshot.categories_under(games['id'])] == ["New>Sub"]
+    assert prices() == [35, 10, 5]
+
+
+# --- Conversation state persistence ------------------------------------------------------
+
+def test_persistence_batches_writes_and_restores(database, monkeypatch):
+    main.init_db()
+    batches = []
+    save = main.save_conversation_state
+    monkeypatch.setattr(main, "save_conversation_state", lambda entries: (batches.append(set(entries)), save(entries)))
+
+    async def scenario():
+        persistence = main.SQLitePersistence()
+        await persistence.update_user_data(1, {"flow": "topup_amount"})
+        await persistence.update_user_data(2, {"flow": "buy_contact"})
+        await persistence.update_chat_data(-5, {"x": 1})
+        await persistence.flush()
+        await persistence.drop_user_data(2)
+        await persistence.flush()
+        return await persistence.get_user_data(), await persistence.get_chat_data()
+
+    users, chats = asyncio.run(scenario())
+    assert batches == [{('user', 1), ('user', 2), ('chat', -5)}, {('user', 2)}]
+    assert users == {1: {"flow": "topup_amount"}} and chats == {-5: {"x": 1}}
+
+
+def test_persistence_requeues_a_failed_batch(database, monkeypatch):
+    main.init_db()
+    save = main.save_conversation_state
+
+    def failing(entries):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    async def scenario():
+        persistence = main.SQLitePersistence()
+        monkeypatch.setattr(main, "save_conversation_state", failing)
+        await persistence.update_user_data(1, {"step": 1})
+        await asyncio.sleep(0.05)
+        assert persistence._dirty == {('user', 1): {"step": 1}}
+        # A newer change made while the batch was failing wins.
+        await persistence.update_user_data(1, {"step": 2})
+        await asyncio.sleep(0.05)
+        monkeypatch.setattr(main, "save_conversation_state", save)
+        await persistence.flush()
+        assert persistence._dirty == {}
+        return await persistence.get_user_data()
+
+    assert asyncio.run(scenario()) == {1: {"step": 2}}
+
+
+# --- Flow engine ---------------------------------------------------------------------------
+
+def send_text(context, user_id: int, text: str) -> list[str]:
+    """Feeds one text message to on_user_message and returns the replies."""
+    message = FakeChatMessage()
+    message.text = text
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=user_id, username="u"))
+    asyncio.run(main.on_user_message(update, context))
+    return message.replies
+
+
+def test_flow_validates_input_and_moves_to_the_next_state(shop):
+    context = SimpleNamespace(user_data={"flow": "topup"})
+    send_text(context, 1, "OP-77")
+    assert context.user_data == {"flow": "topup_amount", "topup_op": "OP-77"}
+    for bad in ("abc", "0", "-5", "nan", "inf"):
+        assert send_text(context, 1, bad) == [main.AMOUNT_ERROR]
+        assert context.user_data["flow"] == "topup_amount"
+    send_text(context, 1, "50")
+    assert [tuple(row) for row in main.db().execute("SELECT user_id, op_number, amount, status FROM topups")] == [
+        (1, "OP-77", 50.0, "pending")]
+    assert main.FLOW_STATS["topup_amount"][0] >= 6
+
+
+def test_flow_input_error_keeps_the_state(shop, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_IDS", {9})
+    main_cat = main.add_category("Main")
+    sub_cat = main.add_category("Sub", main_cat)
+    other = main.add_category("Other")
+    context = SimpleNamespace(user_data={"flow": "adm_cat_move_sub_target", "cid": sub_cat})
+    for target in (str(sub_cat), "999"):
+        assert send_text(context, 9, target)[0].startswith("⛔")
+        assert context.user_data["flow"] == "adm_cat_move_sub_target"
+    send_text(context, 9, str(other))
+    assert "flow" not in context.user_data
+    assert main.catalog_cache.get().category(sub_cat)['parent_id'] == other
+
+
+def test_admin_flows_ignore_other_users_and_unknown_states_show_the_menu(shop, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_IDS", {9})
+    context = SimpleNamespace(user_data={"flow": "adm_cat_add"})
+    assert send_text(context, 1, "Hacked") == []
+    assert [c['name'] for c in main.catalog_cache.get().categories_under(None)] == ["Games"]
+    assert send_text(SimpleNamespace(user_data={}), 1, "hello") == ["اختر إجراءً من الأزرار."]
+
+
+# --- Load test harness -----------------------------------------------------------------------
+
+def test_load_test_runs_both_phases_without_errors(database, monkeypatch):
+    # run() replaces these to record its measurements; restore them afterwards.
+    for name in ("run_db", "UPDATE_CONCURRENCY", "METRICS_PORT"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(main.HANDLER_METRICS, "observe", main.HANDLER_METRICS.observe)
+    monkeypatch.setattr(main.DB_METRICS, "observe", main.DB_METRICS.observe)
+    monkeypatch.setattr(main, "METRICS_PORT", 0)
+    args = SimpleNamespace(users=3, api_latency=0.0, concurrency=4, timeout=30.0)
+
+    results = asyncio.run(loadtest.run(args))
+    assert results["pending"]["topup"] == 3 and results["pending"]["order"] >= 3
+    assert loadtest.pending_ids("topups") == loadtest.pending_ids("orders") == []  # the admin settled them
+    assert [(p["updates"] > 0, p["errors"]) for p in results["phases"].values()] == [(True, 0), (True, 0)]
+    assert results["bot_api_calls"]["sendMessage"] > 0
+    assert "users:" in loadtest.report(results)
+
+
+def test_load_test_refuses_a_database_with_data(shop):
+    with pytest.raises(SystemExit):
+        loadtest.seed_database(3)
+